@@ -4,18 +4,90 @@ import hmac
 import hashlib
 import json
 import base64
-import requests
+import csv
+import io
+import queue
+import re
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+import gzip
+import zlib
+from html import escape
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, send_from_directory, session
+import click
+from flask import Flask, Response, g, request, jsonify, session, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from sqlalchemy import func
+from sqlalchemy import case, event, func, inspect, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, load_only, selectinload
+from sqlalchemy.exc import IntegrityError, OperationalError
+from line_client import RETRY_STATUS, LineClient, PooledHTTPClient
+import text_intent
+from metrics import registry as metrics
+
+try:
+    import brotli  # 選用：安裝後靜態頁面另外提供 br 壓縮
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'teacher-booking-secret-2026')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///teacher_booking.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# 
+# 資料庫：未設定 DATABASE_URL 時使用 SQLite（WAL），正式環境可改用 PostgreSQL
+# 
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///teacher_booking.db')
+if DATABASE_URL.startswith('postgres://'):
+    # Render / Heroku 提供的舊格式，SQLAlchemy 只接受 postgresql://
+    DATABASE_URL = 'postgresql://' + DATABASE_URL[len('postgres://'):]
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', '30'))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '15000'))
+
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+if DATABASE_URL.startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000},
+    }
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    }
+
+
+@event.listens_for(Engine, 'connect')
+def _configure_sqlite(dbapi_connection, connection_record):
+    """
+    SQLite 連線設定：WAL 讓讀取不被寫入擋住，busy_timeout 讓並發寫入排隊等待
+    而不是立刻 database is locked，synchronous=NORMAL 在 WAL 下仍可保證一致性
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    # 只對尚未建立資料表的新資料庫生效；舊資料庫需執行一次 flask archive-bookings --full-vacuum
+    cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
 CORS(app)
 db = SQLAlchemy(app)
 
@@ -25,6 +97,123 @@ LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET', '')
 MAIL_USER = os.environ.get('MAIL_USER', '')
 MAIL_PASS = os.environ.get('MAIL_PASS', '')
 SENDGRID_API_KEY = os.environ.get('SENDGRID_API_KEY', '')
+LINE_API_BASE = os.environ.get('LINE_API_BASE', 'https://api.line.me')
+
+line_api = LineClient(
+    LINE_CHANNEL_ACCESS_TOKEN,
+    base_url=LINE_API_BASE,
+    pool_size=int(os.environ.get('LINE_POOL_SIZE', '10')),
+    max_concurrency=int(os.environ.get('LINE_MAX_CONCURRENCY', '10'))
+)
+
+sendgrid_api = PooledHTTPClient(
+    os.environ.get('SENDGRID_API_BASE', 'https://api.sendgrid.com'),
+    headers={'Authorization': f'Bearer {SENDGRID_API_KEY}', 'Content-Type': 'application/json'},
+    pool_size=4, max_concurrency=4, max_retries=2, timeout=15, name='SendGrid'
+)
+
+# Webhook 事件佇列：WEBHOOK_ASYNC=0 時改回在請求內同步處理（除錯用）
+WEBHOOK_ASYNC = os.environ.get('WEBHOOK_ASYNC', '1') != '0'
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '4'))
+# LINE reply token 約 1 分鐘內有效，預留緩衝，逾時改用 push
+LINE_REPLY_TOKEN_TTL = int(os.environ.get('LINE_REPLY_TOKEN_TTL', '50'))
+
+# 
+# Prometheus 指標（/metrics）：路由延遲、每個請求的 SQL 數與耗時、LINE / SendGrid 呼叫
+# 
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+if os.environ.get('METRICS_DIR'):
+    # 多個 gunicorn worker 時彙總各 process 的數值
+    metrics.enable_multiprocess(os.environ['METRICS_DIR'],
+                                interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', '10')))
+
+SQL_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SQL_TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+http_request_duration = metrics.histogram(
+    'http_request_duration_seconds', 'HTTP 請求處理時間', ('method', 'route', 'status'))
+http_request_sql_queries = metrics.histogram(
+    'http_request_sql_queries', '每個 HTTP 請求執行的 SQL 數', ('route',), SQL_COUNT_BUCKETS)
+http_request_sql_seconds = metrics.histogram(
+    'http_request_sql_seconds', '每個 HTTP 請求的 SQL 總耗時', ('route',), SQL_TIME_BUCKETS)
+line_event_duration = metrics.histogram(
+    'line_event_duration_seconds', 'LINE 事件處理時間（依動作）', ('action', 'result'))
+line_event_sql_queries = metrics.histogram(
+    'line_event_sql_queries', '每個 LINE 事件執行的 SQL 數', ('action',), SQL_COUNT_BUCKETS)
+db_query_duration = metrics.histogram(
+    'db_query_duration_seconds', '單一 SQL 執行時間', ('operation',), SQL_TIME_BUCKETS)
+outbound_request_duration = metrics.histogram(
+    'outbound_request_duration_seconds', '對外 API 呼叫時間（含重試）', ('service', 'endpoint', 'status'))
+outbound_request_retries = metrics.counter(
+    'outbound_request_retries_total', '對外 API 重試次數', ('service', 'endpoint'))
+webhook_duplicates = metrics.counter(
+    'line_webhook_duplicates_total', '略過的重複 LINE 事件', ('kind',))
+
+_SQL_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'}
+_sql_scope = threading.local()
+
+
+def _sql_scope_begin():
+    """開始統計目前執行緒的 SQL 數與耗時；回傳外層範圍，結束時一併累加回去"""
+    outer = getattr(_sql_scope, 'stats', None)
+    _sql_scope.stats = [0, 0.0]
+    return outer
+
+
+def _sql_scope_end(outer):
+    stats = getattr(_sql_scope, 'stats', None) or [0, 0.0]
+    if outer is not None:
+        outer[0] += stats[0]
+        outer[1] += stats[1]
+    _sql_scope.stats = outer
+    return stats
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _sql_timer_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _sql_timer_end(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    head = statement[:12].split(None, 1)
+    operation = head[0].upper() if head else ''
+    db_query_duration.observe(elapsed, operation if operation in _SQL_OPERATIONS else 'OTHER')
+    stats = getattr(_sql_scope, 'stats', None)
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += elapsed
+
+
+def _observe_outbound(service, endpoint, status, elapsed, retries):
+    outbound_request_duration.observe(elapsed, service, endpoint,
+                                      str(status) if status is not None else 'network_error')
+    if retries:
+        outbound_request_retries.inc(service, endpoint, amount=retries)
+
+
+line_api.observers.append(_observe_outbound)
+sendgrid_api.observers.append(_observe_outbound)
+
+
+@app.before_request
+def _metrics_request_start():
+    g.metrics_start = time.perf_counter()
+    _sql_scope.stats = [0, 0.0]
+
+
+@app.after_request
+def _metrics_request_end(response):
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_request_duration.observe(time.perf_counter() - start, request.method, route,
+                                      str(response.status_code))
+        queries, sql_seconds = _sql_scope_end(None)
+        http_request_sql_queries.observe(queries, route)
+        http_request_sql_seconds.observe(sql_seconds, route)
+    return response
 
 # 
 # 
@@ -55,6 +244,7 @@ class Teacher(db.Model):
 
 
 class TimeSlot(db.Model):
+    """可預約的時段，由 materialize_slots 依排班產生；預約時以條件 UPDATE 佔用"""
     __tablename__ = 'time_slots'
     id         = db.Column(db.Integer, primary_key=True)
     teacher_id = db.Column(db.Integer, db.ForeignKey('teachers.id'))
@@ -64,6 +254,41 @@ class TimeSlot(db.Model):
     is_booked  = db.Column(db.Boolean, default=False)
     teacher    = db.relationship('Teacher', backref='slots')
 
+    __table_args__ = (
+        # 查詢某位老師某天（或日期區間）的時段，也讓產生器可以 ON CONFLICT DO NOTHING
+        db.Index('uq_time_slots_teacher_date_time', 'teacher_id', 'date', 'time', unique=True),
+    )
+
+
+class TeacherSchedule(db.Model):
+    """每週排班：weekday 0 = 週一，[start_time, end_time) 內每小時一個時段"""
+    __tablename__ = 'teacher_schedules'
+    id         = db.Column(db.Integer, primary_key=True)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('teachers.id'), nullable=False, index=True)
+    weekday    = db.Column(db.Integer, nullable=False)
+    start_time = db.Column(db.String(5), nullable=False)
+    end_time   = db.Column(db.String(5), nullable=False)
+
+    def to_dict(self):
+        return {'id': self.id, 'teacher_id': self.teacher_id, 'weekday': self.weekday,
+                'start_time': self.start_time, 'end_time': self.end_time}
+
+
+class ScheduleException(db.Model):
+    """排班例外（國定假日、請假）：teacher_id 為空代表所有老師，start/end 為空代表整天"""
+    __tablename__ = 'schedule_exceptions'
+    id         = db.Column(db.Integer, primary_key=True)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('teachers.id'))
+    date       = db.Column(db.String(10), nullable=False, index=True)
+    start_time = db.Column(db.String(5))
+    end_time   = db.Column(db.String(5))
+    reason     = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    def to_dict(self):
+        return {'id': self.id, 'teacher_id': self.teacher_id, 'date': self.date,
+                'start_time': self.start_time, 'end_time': self.end_time, 'reason': self.reason}
+
 
 class Booking(db.Model):
     __tablename__ = 'bookings'
@@ -75,6 +300,7 @@ class Booking(db.Model):
     line_user_id   = db.Column(db.String(100))
     date           = db.Column(db.String(10), nullable=False)
     time           = db.Column(db.String(5), nullable=False)
+    starts_at      = db.Column(db.DateTime, nullable=False)  # date + time，時間區間查詢與排序用
     duration       = db.Column(db.Integer, default=60)
     total_price    = db.Column(db.Integer, default=0)
     status         = db.Column(db.String(20), default='confirmed')
@@ -83,23 +309,103 @@ class Booking(db.Model):
     created_at     = db.Column(db.DateTime, default=datetime.now)
     teacher        = db.relationship('Teacher', backref='bookings')
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'booking_number': self.booking_number,
-            'teacher_id': self.teacher_id,
-            'teacher_name': self.teacher.name if self.teacher else '',
-            'customer_name': self.customer_name,
-            'customer_phone': self.customer_phone,
-            'date': self.date,
-            'time': self.time,
-            'duration': self.duration,
-            'total_price': self.total_price,
-            'status': self.status,
-            'source': self.source,
-            'note': self.note,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M') if self.created_at else ''
+    __table_args__ = (
+        # 可用時段查詢：teacher_id + date + status，time 一併放入索引不需回表
+        db.Index('ix_bookings_teacher_date_status_time', 'teacher_id', 'date', 'status', 'time'),
+        # LINE「我的預約」：line_user_id + status，starts_at 區間掃描並依序取前幾筆
+        db.Index('ix_bookings_line_user_status_starts_at', 'line_user_id', 'status', 'starts_at'),
+        # 後台列表依 created_at, id 倒序分頁
+        db.Index('ix_bookings_created_at_id', 'created_at', 'id'),
+        # 課前提醒（某一天的 confirmed LINE 預約）與封存（早於期限的預約）的 starts_at 區間查詢
+        db.Index('ix_bookings_starts_at_status_line_user', 'starts_at', 'status', 'line_user_id'),
+        # 同一老師同一時段只能有一筆 confirmed 預約
+        db.Index('uq_bookings_teacher_slot_confirmed', 'teacher_id', 'date', 'time', unique=True,
+                 sqlite_where=db.text("status = 'confirmed'"),
+                 postgresql_where=db.text("status = 'confirmed'")),
+    )
+
+    # 欄位名稱 -> 需要載入的欄位（fields= 投影用）
+    FIELD_COLUMNS = {
+        'id': ['id'], 'booking_number': ['booking_number'], 'teacher_id': ['teacher_id'],
+        'teacher_name': ['teacher_id'], 'customer_name': ['customer_name'],
+        'customer_phone': ['customer_phone'], 'date': ['date'], 'time': ['time'],
+        'duration': ['duration'], 'total_price': ['total_price'], 'status': ['status'],
+        'source': ['source'], 'note': ['note'], 'created_at': ['created_at']
+    }
+
+    def to_dict(self, fields=None):
+        getters = {
+            'id': lambda: self.id,
+            'booking_number': lambda: self.booking_number,
+            'teacher_id': lambda: self.teacher_id,
+            'teacher_name': lambda: self.teacher.name if self.teacher else '',
+            'customer_name': lambda: self.customer_name,
+            'customer_phone': lambda: self.customer_phone,
+            'date': lambda: self.date,
+            'time': lambda: self.time,
+            'duration': lambda: self.duration,
+            'total_price': lambda: self.total_price,
+            'status': lambda: self.status,
+            'source': lambda: self.source,
+            'note': lambda: self.note,
+            'created_at': lambda: self.created_at.strftime('%Y-%m-%d %H:%M') if self.created_at else ''
         }
+        return {k: get() for k, get in getters.items() if fields is None or k in fields}
+
+
+class BookingSequence(db.Model):
+    """每日預約編號流水號"""
+    __tablename__ = 'booking_sequences'
+    day      = db.Column(db.String(8), primary_key=True)  # YYYYMMDD
+    last_seq = db.Column(db.Integer, nullable=False, default=0)
+
+
+class DataVersion(db.Model):
+    """跨 process 共用的資料版本號，用來判斷各 worker 的本機快取是否過期"""
+    __tablename__ = 'data_versions'
+    name    = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class BookingArchive(db.Model):
+    """
+    冷資料：上課日早於 ARCHIVE_AFTER_DAYS 天前的預約（已上完或已取消），由 archive_bookings() 分批從
+    bookings 搬入，id 沿用原值。預約、查詢與可用時段等熱路徑只查 bookings，
+    後台列表、匯出與統計重算會同時查兩張表。
+    """
+    __tablename__ = 'bookings_archive'
+    id             = db.Column(db.Integer, primary_key=True)
+    booking_number = db.Column(db.String(20), unique=True)
+    teacher_id     = db.Column(db.Integer, db.ForeignKey('teachers.id'))
+    customer_name  = db.Column(db.String(50), nullable=False)
+    customer_phone = db.Column(db.String(20), nullable=False)
+    line_user_id   = db.Column(db.String(100))
+    date           = db.Column(db.String(10), nullable=False)
+    time           = db.Column(db.String(5), nullable=False)
+    starts_at      = db.Column(db.DateTime, nullable=False)  # date + time，時間區間查詢與排序用
+    duration       = db.Column(db.Integer, default=60)
+    total_price    = db.Column(db.Integer, default=0)
+    status         = db.Column(db.String(20), default='confirmed')
+    source         = db.Column(db.String(20), default='web')
+    note           = db.Column(db.Text)
+    created_at     = db.Column(db.DateTime, default=datetime.now)
+    archived_at    = db.Column(db.DateTime, default=datetime.now)
+    teacher        = db.relationship('Teacher')
+
+    __table_args__ = (
+        # 後台列表與 bookings 合併分頁
+        db.Index('ix_bookings_archive_created_at_id', 'created_at', 'id'),
+    )
+
+    FIELD_COLUMNS = Booking.FIELD_COLUMNS
+    to_dict = Booking.to_dict
+
+
+class BookingReminder(db.Model):
+    """已排入發送的課前提醒；每筆預約只會有一列，重跑或多個 process 同時執行都不會重複提醒"""
+    __tablename__ = 'booking_reminders'
+    booking_id = db.Column(db.Integer, db.ForeignKey('bookings.id'), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
 
 
 class Customer(db.Model):
@@ -118,6 +424,25 @@ class Customer(db.Model):
     pending_teacher_id = db.Column(db.Integer)
     pending_date       = db.Column(db.String(10))
 
+    FIELD_COLUMNS = {
+        'id': ['id'], 'name': ['name'], 'phone': ['phone'], 'email': ['email'],
+        'total_bookings': ['total_bookings'], 'total_hours': ['total_hours'],
+        'total_spent': ['total_spent'], 'created_at': ['created_at']
+    }
+
+    def to_dict(self, fields=None):
+        getters = {
+            'id': lambda: self.id,
+            'name': lambda: self.name,
+            'phone': lambda: self.phone,
+            'email': lambda: self.email,
+            'total_bookings': lambda: self.total_bookings,
+            'total_hours': lambda: self.total_hours,
+            'total_spent': lambda: self.total_spent,
+            'created_at': lambda: self.created_at.strftime('%Y-%m-%d') if self.created_at else ''
+        }
+        return {k: get() for k, get in getters.items() if fields is None or k in fields}
+
 
 class AIConversation(db.Model):
     __tablename__ = 'ai_conversations'
@@ -126,10 +451,203 @@ class AIConversation(db.Model):
     user_message = db.Column(db.Text, nullable=False)
     ai_response  = db.Column(db.Text, nullable=False)
     intent       = db.Column(db.String(50))
-    booking_id   = db.Column(db.Integer, db.ForeignKey('bookings.id'))
+    booking_id   = db.Column(db.Integer)  # bookings 或 bookings_archive 的 id
     created_at   = db.Column(db.DateTime, default=datetime.now)
 
 
+class DailyStat(db.Model):
+    """
+    統計彙總：每日 × 老師 × 來源的計數器，與預約 / 對話在同一個 transaction 內更新。
+    預約以上課日期計，對話以建立日期計（teacher_id = 0）。
+    """
+    __tablename__ = 'stats_daily'
+    day             = db.Column(db.String(10), primary_key=True)
+    teacher_id      = db.Column(db.Integer, primary_key=True, default=0)
+    source          = db.Column(db.String(20), primary_key=True)
+    confirmed_count = db.Column(db.Integer, nullable=False, default=0)
+    revenue         = db.Column(db.Integer, nullable=False, default=0)
+    conversations   = db.Column(db.Integer, nullable=False, default=0)
+
+
+_BUMP_DAILY_STAT_SQL = db.text(
+    'INSERT INTO stats_daily (day, teacher_id, source, confirmed_count, revenue, conversations) '
+    'VALUES (:day, :teacher_id, :source, :confirmed, :revenue, :conversations) '
+    'ON CONFLICT (day, teacher_id, source) DO UPDATE SET '
+    'confirmed_count = stats_daily.confirmed_count + excluded.confirmed_count, '
+    'revenue = stats_daily.revenue + excluded.revenue, '
+    'conversations = stats_daily.conversations + excluded.conversations'
+)
+
+
+def bump_daily_stat(day, teacher_id, source, confirmed=0, revenue=0, conversations=0, conn=None):
+    params = {'day': day, 'teacher_id': teacher_id or 0, 'source': source or 'web',
+              'confirmed': confirmed, 'revenue': revenue or 0, 'conversations': conversations}
+    (conn or db.session).execute(_BUMP_DAILY_STAT_SQL, params)
+
+
+@event.listens_for(AIConversation, 'after_insert')
+def _count_conversation(mapper, connection, target):
+    day = (target.created_at or datetime.now()).strftime('%Y-%m-%d')
+    bump_daily_stat(day, 0, 'line', conversations=1, conn=connection)
+
+
+def bump_customer_totals(phone, bookings, hours, spent):
+    """
+    客戶累計以單一 UPDATE ... SET x = x + :d 在資料庫端加減，並發預約不會互相覆蓋。
+    只由 create_booking_record / cancel_booking_record 呼叫；客戶尚未建立時不做事。
+    """
+    if not phone:
+        return
+    db.session.execute(
+        update(Customer).where(Customer.phone == phone).values(
+            total_bookings=func.coalesce(Customer.total_bookings, 0) + bookings,
+            total_hours=func.coalesce(Customer.total_hours, 0) + hours,
+            total_spent=func.coalesce(Customer.total_spent, 0) + spent
+        ).execution_options(synchronize_session=False)
+    )
+
+
+# 先把沒有 confirmed 預約的客戶歸零，再以一次 GROUP BY 的結果更新其餘客戶（只寫入有差異的列）
+# （已封存的預約也計入累計）
+_CONFIRMED_BOOKINGS_SQL = (
+    "(SELECT customer_phone, duration, total_price FROM bookings WHERE status = 'confirmed' "
+    " UNION ALL "
+    " SELECT customer_phone, duration, total_price FROM bookings_archive WHERE status = 'confirmed')"
+)
+_RECONCILE_CUSTOMERS_SQL = [
+    text(
+        "UPDATE customers SET total_bookings = 0, total_hours = 0, total_spent = 0 "
+        "WHERE (COALESCE(total_bookings, 0) <> 0 OR COALESCE(total_hours, 0) <> 0 "
+        "       OR COALESCE(total_spent, 0) <> 0) "
+        "AND (phone IS NULL OR phone NOT IN ("
+        f"    SELECT customer_phone FROM {_CONFIRMED_BOOKINGS_SQL} AS b))"
+    ),
+    text(
+        "UPDATE customers SET total_bookings = agg.bookings, total_hours = agg.hours, "
+        "total_spent = agg.spent "
+        "FROM (SELECT customer_phone, COUNT(*) AS bookings, "
+        "             COALESCE(SUM(duration), 0) AS hours, COALESCE(SUM(total_price), 0) AS spent "
+        f"      FROM {_CONFIRMED_BOOKINGS_SQL} AS b GROUP BY customer_phone) AS agg "
+        "WHERE customers.phone = agg.customer_phone "
+        "AND (COALESCE(customers.total_bookings, -1) <> agg.bookings "
+        "     OR COALESCE(customers.total_hours, -1) <> agg.hours "
+        "     OR COALESCE(customers.total_spent, -1) <> agg.spent)"
+    ),
+]
+
+
+def reconcile_customer_totals():
+    """從 bookings 重新計算所有客戶的累計（set-based），回傳修正的客戶數"""
+    fixed = sum(db.session.execute(sql).rowcount for sql in _RECONCILE_CUSTOMERS_SQL)
+    db.session.commit()
+    return fixed
+
+
+def rebuild_daily_stats():
+    """從 bookings（含封存）/ ai_conversations 重新計算整張統計表"""
+    DailyStat.query.delete()
+    rows = {}
+    for model in (Booking, BookingArchive):
+        for day, teacher_id, source, count, revenue in db.session.query(
+            model.date, model.teacher_id, model.source, func.count(), func.sum(model.total_price)
+        ).filter(model.status == 'confirmed').group_by(model.date, model.teacher_id, model.source):
+            key = (day, teacher_id or 0, source or 'web')
+            stat = rows.setdefault(key, DailyStat(day=key[0], teacher_id=key[1], source=key[2],
+                                                  confirmed_count=0, revenue=0, conversations=0))
+            stat.confirmed_count += count
+            stat.revenue += revenue or 0
+    conv_day = func.date(AIConversation.created_at)
+    for day, count in db.session.query(conv_day, func.count()).group_by(conv_day):
+        key = (str(day), 0, 'line')
+        stat = rows.setdefault(key, DailyStat(day=key[0], teacher_id=0, source='line',
+                                              confirmed_count=0, revenue=0, conversations=0))
+        stat.conversations += count
+    db.session.add_all(rows.values())
+    db.session.commit()
+    return len(rows)
+
+
+class BookingFeedEvent(db.Model):
+    """後台即時動態：預約建立 / 取消時於同一個 transaction 內寫入，各 worker 輪詢後推送給 SSE 連線"""
+    __tablename__ = 'booking_feed'
+    id         = db.Column(db.Integer, primary_key=True)
+    kind       = db.Column(db.String(30), nullable=False)   # booking_created, booking_cancelled
+    payload    = db.Column(db.Text, nullable=False)         # {"booking": {...}, "stats": {...}}
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now, index=True)
+
+
+class ProcessedWebhookEvent(db.Model):
+    """已收過的 LINE webhookEventId，用來丟棄重送的事件；超過 WEBHOOK_DEDUP_TTL 秒後清除"""
+    __tablename__ = 'webhook_event_ids'
+    webhook_event_id = db.Column(db.String(64), primary_key=True)
+    received_at      = db.Column(db.DateTime, nullable=False, default=datetime.now, index=True)
+
+
+class WebhookEvent(db.Model):
+    """待處理的 LINE webhook 事件（處理完成即刪除；失敗重試用盡後保留為 failed，保存期限後刪除）"""
+    __tablename__ = 'webhook_events'
+    id              = db.Column(db.Integer, primary_key=True)
+    line_user_id    = db.Column(db.String(100), nullable=False)
+    payload         = db.Column(db.Text, nullable=False)
+    status          = db.Column(db.String(20), default='pending')  # pending, processing, failed
+    worker          = db.Column(db.String(100))
+    locked_at       = db.Column(db.DateTime)
+    attempts        = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime)  # 失敗重試的時間，空值代表立即
+    received_at     = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('ix_webhook_events_status_id', 'status', 'id'),
+        db.Index('ix_webhook_events_user_id', 'line_user_id', 'id'),
+    )
+
+
+class OutboxMessage(db.Model):
+    """
+    待發送的通知（Email / LINE push），與預約在同一個 transaction 寫入，
+    由背景 dispatcher 送出；重試用盡或不可重試的錯誤標記為 dead
+    """
+    __tablename__ = 'outbox_messages'
+    id              = db.Column(db.Integer, primary_key=True)
+    channel         = db.Column(db.String(20), nullable=False)   # email, line, line_multicast
+    recipient       = db.Column(db.String(200), nullable=False)  # Email、LINE userId 或 multicast 人數
+    template        = db.Column(db.String(50))                   # Email 模板名稱
+    subject         = db.Column(db.String(200))
+    payload         = db.Column(db.Text, nullable=False)         # Email 代換值 / LINE messages / multicast {to, messages}（JSON）
+    status          = db.Column(db.String(20), default='pending')  # pending, sending, sent, dead
+    attempts        = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.now)
+    worker          = db.Column(db.String(100))
+    locked_at       = db.Column(db.DateTime)
+    last_error      = db.Column(db.Text)
+    created_at      = db.Column(db.DateTime, default=datetime.now)
+    sent_at         = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_outbox_messages_status_next', 'status', 'next_attempt_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id, 'channel': self.channel, 'recipient': self.recipient,
+            'template': self.template, 'subject': self.subject, 'status': self.status,
+            'attempts': self.attempts, 'last_error': self.last_error,
+            'next_attempt_at': self.next_attempt_at.strftime('%Y-%m-%d %H:%M:%S') if self.next_attempt_at else '',
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S') if self.created_at else '',
+            'sent_at': self.sent_at.strftime('%Y-%m-%d %H:%M:%S') if self.sent_at else ''
+        }
+
+
+class ConversationState(db.Model):
+    """LINE 用戶進行中的對話狀態（每人一筆，逾時失效），例如註冊前暫存的預約"""
+    __tablename__ = 'conversation_states'
+    line_user_id = db.Column(db.String(100), primary_key=True)
+    kind         = db.Column(db.String(50), nullable=False)
+    data         = db.Column(db.Text, nullable=False)  # JSON
+    expires_at   = db.Column(db.DateTime, nullable=False, index=True)
+    updated_at   = db.Column(db.DateTime, default=datetime.now)
+
+
 # 
 # 
 # 
@@ -166,80 +684,557 @@ def _build_email_html(title, customer_name, rows, footer_note=''):
     </div>"""
 
 
-def _send_via_sendgrid(to_email, subject, html):
-    """透過 SendGrid API 發送 Email（Render 免費方案可用）"""
-    if not SENDGRID_API_KEY:
-        return False, 'SENDGRID_API_KEY 未設定'
-    if not MAIL_USER:
-        return False, 'MAIL_USER（寄件人）未設定'
-    payload = {
-        'personalizations': [{'to': [{'email': to_email}]}],
-        'from': {'email': MAIL_USER},
-        'subject': subject,
-        'content': [{'type': 'text/html', 'value': html}]
+# Email 模板：內容以 SendGrid substitution 標籤（-key-）表示，
+# 同一模板的多封信可合併成一次 multi-personalization 請求
+EMAIL_TEMPLATES = {
+    'booking_confirm': _build_email_html('K書中心預約確認', '-customer_name-', [
+        ('預約編號', '-booking_number-'),
+        ('老師', '-teacher- 老師'),
+        ('日期', '-date-'),
+        ('時間', '-time-'),
+        ('課程時長', '-duration- 分鐘'),
+        ('費用', 'NT$ -price-'),
+    ]),
+    'booking_cancel': _build_email_html('K書中心預約取消通知', '-customer_name-', [
+        ('預約編號', '-booking_number-'),
+        ('老師', '-teacher- 老師'),
+        ('日期', '-date-'),
+        ('時間', '-time-'),
+    ], footer_note='如需重新預約請透過 LINE 或網頁操作。'),
+}
+
+
+def enqueue_email(to_email, template, subject, values):
+    """在目前 transaction 內寫入一封待寄 Email，commit 後由 outbox dispatcher 寄出"""
+    if not to_email:
+        return False
+    if not SENDGRID_API_KEY or not MAIL_USER:
+        print('Email 未寄出: SENDGRID_API_KEY 或 MAIL_USER（寄件人）未設定')
+        return False
+    db.session.add(OutboxMessage(
+        channel='email', recipient=to_email, template=template, subject=subject,
+        payload=json.dumps({k: escape(str(v)) for k, v in values.items()}, ensure_ascii=False)
+    ))
+    after_commit(outbox.notify)
+    return True
+
+
+def enqueue_line_push(user_id, messages):
+    """在目前 transaction 內寫入一則待送 LINE push"""
+    if not user_id or not LINE_CHANNEL_ACCESS_TOKEN:
+        return False
+    db.session.add(OutboxMessage(
+        channel='line', recipient=user_id,
+        payload=json.dumps(messages, ensure_ascii=False)
+    ))
+    after_commit(outbox.notify)
+    return True
+
+
+def enqueue_line_multicast(user_ids, messages):
+    """在目前 transaction 內寫入 multicast，收件人超過 500 位時拆成多筆"""
+    if not user_ids or not LINE_CHANNEL_ACCESS_TOKEN:
+        return 0
+    limit = LineClient.MULTICAST_LIMIT
+    batches = [user_ids[i:i + limit] for i in range(0, len(user_ids), limit)]
+    for to in batches:
+        db.session.add(OutboxMessage(
+            channel='line_multicast', recipient=f'{len(to)} users',
+            payload=json.dumps({'to': to, 'messages': messages}, ensure_ascii=False)
+        ))
+    after_commit(outbox.notify)
+    return len(batches)
+
+
+def _booking_email_values(customer_name, booking):
+    return {
+        'customer_name': customer_name,
+        'booking_number': booking.booking_number,
+        'teacher': booking.teacher.name if booking.teacher else '',
+        'date': booking.date,
+        'time': booking.time,
+        'duration': booking.duration,
+        'price': f'{booking.total_price:,}',
     }
-    try:
-        r = requests.post(
-            'https://api.sendgrid.com/v3/mail/send',
-            headers={
-                'Authorization': f'Bearer {SENDGRID_API_KEY}',
-                'Content-Type': 'application/json'
-            },
-            json=payload,
-            timeout=15
-        )
-        if r.status_code in (200, 202):
-            return True, 'OK'
-        else:
-            return False, f'SendGrid HTTP {r.status_code}: {r.text}'
-    except Exception as e:
-        return False, str(e)
 
 
 def send_booking_email(to_email, customer_name, booking):
-    """發送預約確認 Email（SendGrid）"""
-    if not to_email:
-        return False
-    teacher_name = booking.teacher.name if booking.teacher else ''
-    subject = f'【K書中心】預約確認 - {booking.booking_number}'
-    rows = [
-        ('預約編號', booking.booking_number),
-        ('老師', f'{teacher_name} 老師'),
-        ('日期', booking.date),
-        ('時間', booking.time),
-        ('課程時長', f'{booking.duration} 分鐘'),
-        ('費用', f'NT$ {booking.total_price:,}'),
-    ]
-    html = _build_email_html('K書中心預約確認', customer_name, rows)
-    ok, msg = _send_via_sendgrid(to_email, subject, html)
-    if ok:
-        print(f'Email 發送成功: {to_email}')
-    else:
-        print(f'Email 發送失敗: {msg}')
-    return ok
+    """預約確認 Email（寫入 outbox）"""
+    return enqueue_email(to_email, 'booking_confirm',
+                         f'【K書中心】預約確認 - {booking.booking_number}',
+                         _booking_email_values(customer_name, booking))
 
 
 def send_cancel_email(to_email, customer_name, booking):
-    """發送取消通知 Email（SendGrid）"""
-    if not to_email:
-        return False
-    teacher_name = booking.teacher.name if booking.teacher else ''
-    subject = f'【K書中心】預約取消通知 - {booking.booking_number}'
-    rows = [
-        ('預約編號', booking.booking_number),
-        ('老師', f'{teacher_name} 老師'),
-        ('日期', booking.date),
-        ('時間', booking.time),
-    ]
-    html = _build_email_html('K書中心預約取消通知', customer_name, rows,
-                             footer_note='如需重新預約請透過 LINE 或網頁操作。')
-    ok, msg = _send_via_sendgrid(to_email, subject, html)
-    if ok:
-        print(f'取消 Email 發送成功: {to_email}')
-    else:
-        print(f'取消 Email 發送失敗: {msg}')
-    return ok
+    """取消通知 Email（寫入 outbox）"""
+    return enqueue_email(to_email, 'booking_cancel',
+                         f'【K書中心】預約取消通知 - {booking.booking_number}',
+                         _booking_email_values(customer_name, booking))
+
+
+class OutboxDispatcher:
+    """
+    背景送出 outbox_messages。
+    每個 process 一條執行緒，以條件式 UPDATE 認領（多個 worker 不會重複認領），
+    同一模板的 Email 合併成 SendGrid multi-personalization 請求；
+    失敗依指數退避重排，重試用盡或不可重試的錯誤標記為 dead。
+    """
+
+    def __init__(self, poll_interval=2.0, lease_seconds=300, batch_size=200,
+                 email_batch_size=100, max_attempts=6, retry_base=30, retry_max=3600,
+                 retention_days=7, push_concurrency=4):
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.email_batch_size = min(email_batch_size, 1000)  # SendGrid 上限 1000
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.retention_days = retention_days
+        self.push_concurrency = push_concurrency
+        self.worker_id = None
+        self._pid = None
+        self._pool = None
+        self._pool_pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._last_maintenance = datetime.min
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.worker_id = f'{socket.gethostname()}:{self._pid}:{uuid.uuid4().hex[:8]}'
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _claim(self):
+        now = datetime.now()
+        candidates = db.session.query(OutboxMessage.id).filter(
+            OutboxMessage.status == 'pending',
+            OutboxMessage.next_attempt_at <= now
+        ).order_by(OutboxMessage.id).limit(self.batch_size)
+        OutboxMessage.query.filter(
+            OutboxMessage.id.in_(candidates.scalar_subquery()),
+            OutboxMessage.status == 'pending'
+        ).update({'status': 'sending', 'worker': self.worker_id, 'locked_at': now},
+                 synchronize_session=False)
+        db.session.commit()
+        return OutboxMessage.query.filter_by(status='sending', worker=self.worker_id) \
+            .order_by(OutboxMessage.id).all()
+
+    def _maintenance(self):
+        """放回租約過期的訊息、清除已送出的舊紀錄"""
+        now = datetime.now()
+        if now - self._last_maintenance < timedelta(seconds=60):
+            return
+        self._last_maintenance = now
+        OutboxMessage.query.filter(
+            OutboxMessage.status == 'sending',
+            OutboxMessage.locked_at < now - timedelta(seconds=self.lease_seconds)
+        ).update({'status': 'pending', 'worker': None}, synchronize_session=False)
+        OutboxMessage.query.filter(
+            OutboxMessage.status == 'sent',
+            OutboxMessage.sent_at < now - timedelta(days=self.retention_days)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+    def _send_emails(self, template, messages):
+        """一次請求寄出同模板的多封信，回傳 Response（網路錯誤為 None）"""
+        return sendgrid_api.post('/v3/mail/send', json={
+            'personalizations': [{
+                'to': [{'email': m.recipient}],
+                'subject': m.subject,
+                'substitutions': {f'-{k}-': v for k, v in json.loads(m.payload).items()}
+            } for m in messages],
+            'from': {'email': MAIL_USER},
+            'content': [{'type': 'text/html', 'value': EMAIL_TEMPLATES[template]}]
+        }, ok_status=(200, 202))
+
+    def _deliver_emails(self, template, messages):
+        if template not in EMAIL_TEMPLATES:
+            return [(m, None, f'未知的 Email 模板: {template}') for m in messages]
+        try:
+            r = self._send_emails(template, messages)
+            rejected = r is not None and r.status_code == 400
+        except Exception as e:
+            # 無法組成請求（例如 payload 損壞）：單封直接記為錯誤，多封時逐封找出是哪一封
+            if len(messages) == 1:
+                return [(messages[0], None, f'{type(e).__name__}: {e}')]
+            r, rejected = None, True
+        if rejected and len(messages) > 1:
+            # 整批被拒（例如其中一個收件人格式錯誤），改為逐封寄送找出問題
+            results = []
+            for m in messages:
+                results.extend(self._deliver_emails(template, [m]))
+            return results
+        return [(m, r, None) for m in messages]
+
+    def _deliver(self, messages):
+        results = []
+        emails = {}
+        pushes = []
+        for m in messages:
+            if m.channel == 'email':
+                emails.setdefault(m.template, []).append(m)
+            elif m.channel in ('line', 'line_multicast'):
+                pushes.append(m)
+            else:
+                results.append((m, None, f'未知的 channel: {m.channel}'))
+        if pushes:
+            # 個別推播透過共用連線池平行送出，同時最多 push_concurrency 個請求
+            jobs = [(m.id, m.channel, m.recipient, m.payload) for m in pushes]
+            for m, (r, error) in zip(pushes, self._push_pool().map(self._send_line, jobs)):
+                results.append((m, r, error))
+        for template, group in emails.items():
+            for i in range(0, len(group), self.email_batch_size):
+                results.extend(self._deliver_emails(template, group[i:i + self.email_batch_size]))
+        return results
+
+    def _push_pool(self):
+        if self._pool_pid != os.getpid():
+            self._pool = ThreadPoolExecutor(self.push_concurrency, thread_name_prefix='outbox-push')
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    @staticmethod
+    def _send_line(job):
+        """回傳 (Response, None)；訊息本身有問題（例如 payload 損壞）時回傳 (None, 錯誤)，只讓這一筆失敗"""
+        message_id, channel, recipient, payload = job
+        # retry key 由訊息 id 決定，重送時 LINE 不會重複推播
+        retry_key = str(uuid.uuid5(uuid.NAMESPACE_URL, f'outbox:{message_id}'))
+        try:
+            data = json.loads(payload)
+            if channel == 'line_multicast':
+                return line_api.multicast(data['to'], data['messages'], retry_key=retry_key), None
+            return line_api.push(recipient, data, retry_key=retry_key), None
+        except Exception as e:
+            return None, f'{type(e).__name__}: {e}'
+
+    def _record(self, results):
+        now = datetime.now()
+        sent = dead = 0
+        for m, r, error in results:
+            m.attempts = (m.attempts or 0) + 1
+            m.worker = None
+            if error is None and r is not None and r.status_code in (200, 202, 409):
+                m.status, m.sent_at, m.last_error = 'sent', now, None
+                sent += 1
+                continue
+            retryable = error is None and (r is None or r.status_code in RETRY_STATUS)
+            if error is None:
+                error = f'HTTP {r.status_code}: {r.text[:500]}' if r is not None else '連線失敗'
+            m.last_error = error
+            if retryable and m.attempts < self.max_attempts:
+                delay = min(self.retry_max, self.retry_base * 2 ** (m.attempts - 1))
+                m.status, m.next_attempt_at = 'pending', now + timedelta(seconds=delay)
+            else:
+                m.status = 'dead'
+                dead += 1
+                print(f'Outbox 訊息 {m.id}（{m.channel} {m.recipient}）無法送出: {error}')
+        db.session.commit()
+        return sent, dead
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            with app.app_context():
+                try:
+                    self._maintenance()
+                    messages = self._claim()
+                    if messages:
+                        self._record(self._deliver(messages))
+                    if len(messages) >= self.batch_size:
+                        self._wakeup.set()
+                except Exception as e:
+                    print(f'Outbox 發送失敗: {e}')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+
+outbox = OutboxDispatcher(
+    email_batch_size=int(os.environ.get('SENDGRID_BATCH_SIZE', '100')),
+    max_attempts=int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '6')),
+    push_concurrency=int(os.environ.get('OUTBOX_PUSH_CONCURRENCY', '4'))
+)
+
+
+class BookingFeedHub:
+    """
+    後台即時動態的 process 內 publish / subscribe。
+    每個 process 一條執行緒輪詢 booking_feed（只在有 SSE 連線時），再分送給本 process 的所有連線；
+    不論開了幾個後台分頁，每個 worker 每次輪詢只查一次。其他 worker 寫入的事件最慢
+    poll_interval 秒後送達，本 process 的 commit 會立即喚醒輪詢。
+    PostgreSQL 的 id 取號順序不一定等於 commit 順序，所以遇到空號時會在 gap_timeout 秒內
+    持續回頭查，超過才視為 rollback 跳過。開始輪詢時起點往回留 seed_window 個 id，
+    比當下最大 id 小、但還沒 commit 的事件之後仍會送出。
+    """
+
+    def __init__(self, poll_interval=1.0, queue_size=1000, gap_timeout=5.0, retention_hours=24,
+                 seed_window=200):
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.gap_timeout = gap_timeout
+        self.retention_hours = retention_hours
+        self.seed_window = seed_window
+        self._subscribers = set()
+        self._floor = None    # 小於等於此 id 的事件都已分送
+        self._seen = set()    # 大於 floor 且已分送的 id
+        self._gaps = {}       # 空號 -> 第一次發現的時間
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._last_purge = datetime.min
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._subscribers = set()
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def subscribe(self):
+        """回傳接收 (id, kind, payload) 的 queue；處理不及塞滿時會被移除，連線端應結束並重連"""
+        self.start()
+        q = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.add(q)
+        self._wakeup.set()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def is_subscribed(self, q):
+        return q in self._subscribers
+
+    def _publish(self, events):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            for ev in events:
+                try:
+                    q.put_nowait(ev)
+                except queue.Full:
+                    self.unsubscribe(q)
+                    break
+
+    def _poll(self):
+        if self._floor is None:
+            # 最近 seed_window 個 id 中已存在的視為已分送，其餘當作空號繼續等待
+            ids = [r.id for r in db.session.query(BookingFeedEvent.id)
+                   .order_by(BookingFeedEvent.id.desc()).limit(self.seed_window)]
+            self._floor = max(ids[0] - self.seed_window, 0) if ids else 0
+            self._seen = {i for i in ids if i > self._floor}
+            self._gaps.clear()
+            return
+        rows = db.session.query(BookingFeedEvent.id, BookingFeedEvent.kind, BookingFeedEvent.payload) \
+            .filter(BookingFeedEvent.id > self._floor).order_by(BookingFeedEvent.id).limit(500).all()
+        fresh = [tuple(r) for r in rows if r.id not in self._seen]
+        self._seen.update(ev[0] for ev in fresh)
+        if fresh:
+            self._publish(fresh)
+        # floor 往前推到第一個仍在等待的空號之前
+        now = time.monotonic()
+        top = max(self._seen, default=self._floor)
+        for missing in range(self._floor + 1, top):
+            if missing not in self._seen:
+                self._gaps.setdefault(missing, now)
+        while self._floor < top:
+            nxt = self._floor + 1
+            if nxt in self._seen:
+                self._seen.discard(nxt)
+            elif now - self._gaps.get(nxt, now) < self.gap_timeout:
+                break
+            self._gaps.pop(nxt, None)
+            self._floor = nxt
+        if len(rows) == 500:
+            self._wakeup.set()
+
+    def _purge(self):
+        now = datetime.now()
+        if now - self._last_purge < timedelta(minutes=10):
+            return
+        self._last_purge = now
+        BookingFeedEvent.query.filter(
+            BookingFeedEvent.created_at < now - timedelta(hours=self.retention_hours)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            if not self._subscribers:
+                self._floor = None   # 沒有連線時不查詢；下次有連線時從最新的事件開始
+                continue
+            with app.app_context():
+                try:
+                    self._poll()
+                    self._purge()
+                except Exception as e:
+                    print(f'即時動態輪詢失敗: {e}')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+
+booking_feed = BookingFeedHub(
+    poll_interval=float(os.environ.get('FEED_POLL_INTERVAL', '1')),
+    retention_hours=int(os.environ.get('FEED_RETENTION_HOURS', '24'))
+)
+
+
+def publish_booking_event(kind, booking, teacher_name, sign):
+    """在目前 transaction 內寫入一筆即時動態（預約內容 + 後台統計的差異），commit 後才會送出"""
+    today = datetime.now().strftime('%Y-%m-%d')
+    data = booking.to_dict(fields=set(Booking.FIELD_COLUMNS) - {'teacher_name', 'note'})
+    data['teacher_name'] = teacher_name
+    stats = {
+        'total_bookings': sign,
+        'today_bookings': sign if booking.date == today else 0,
+        'total_revenue': sign * (booking.total_price or 0),
+        'line_bookings': sign if booking.source == 'line' else 0
+    }
+    db.session.add(BookingFeedEvent(
+        kind=kind, payload=json.dumps({'booking': data, 'stats': stats}, ensure_ascii=False)
+    ))
+    after_commit(booking_feed.notify)
+
 
+def after_commit(fn):
+    """登記 transaction commit 後才執行的函式（rollback 時丟棄）"""
+    db.session.info.setdefault('after_commit', []).append(fn)
+
+
+@event.listens_for(Session, 'after_commit')
+def _run_after_commit(sess):
+    for fn in sess.info.pop('after_commit', []):
+        try:
+            fn()
+        except Exception as e:
+            print(f'after_commit 執行失敗: {e}')
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_commit(sess):
+    sess.info.pop('after_commit', None)
+
+
+_BUMP_VERSION_SQL = db.text(
+    'INSERT INTO data_versions (name, version) VALUES (:name, 1) '
+    'ON CONFLICT (name) DO UPDATE SET version = data_versions.version + 1 '
+    'RETURNING version'
+)
+
+
+def bump_version(name):
+    """在目前 transaction 內遞增版本號並回傳新版本"""
+    return db.session.execute(_BUMP_VERSION_SQL, {'name': name}).scalar()
+
+
+def read_version(name):
+    return db.session.execute(
+        db.text('SELECT version FROM data_versions WHERE name = :name'), {'name': name}
+    ).scalar() or 0
+
+
+class ConversationStore:
+    """
+    conversation_states 的存取介面，前面加一層 process 內 LRU 快取。
+    get() 讀快取（最多 cache_seconds 秒舊，供顯示用）；
+    take() 以 DELETE ... RETURNING 從資料庫取出並刪除，多個 worker 只會有一個拿到。
+    """
+
+    def __init__(self, ttl_seconds=3600, cache_seconds=5, max_entries=10000,
+                 purge_interval=600):
+        self.ttl_seconds = ttl_seconds
+        self.cache_seconds = cache_seconds
+        self.max_entries = max_entries
+        self.purge_interval = purge_interval
+        self._cache = OrderedDict()  # user_id -> (kind, data, expires_at, cached_at)
+        self._lock = threading.Lock()
+        self._last_purge = datetime.min
+
+    def _cache_put(self, user_id, entry):
+        with self._lock:
+            self._cache[user_id] = entry
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _cache_drop(self, user_id):
+        with self._lock:
+            self._cache.pop(user_id, None)
+
+    def set(self, user_id, kind, data, ttl_seconds=None):
+        """在目前 transaction 內寫入（覆蓋）用戶的對話狀態"""
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=ttl_seconds or self.ttl_seconds)
+        payload = json.dumps(data, ensure_ascii=False)
+        db.session.execute(db.text(
+            'INSERT INTO conversation_states (line_user_id, kind, data, expires_at, updated_at) '
+            'VALUES (:user_id, :kind, :data, :expires_at, :now) '
+            'ON CONFLICT (line_user_id) DO UPDATE SET kind = excluded.kind, data = excluded.data, '
+            'expires_at = excluded.expires_at, updated_at = excluded.updated_at'
+        ).bindparams(db.bindparam('expires_at', type_=db.DateTime),
+                     db.bindparam('now', type_=db.DateTime)),
+            {'user_id': user_id, 'kind': kind, 'data': payload, 'expires_at': expires_at, 'now': now})
+        self._purge_expired(now)
+        self._cache_drop(user_id)
+        after_commit(lambda: self._cache_put(user_id, (kind, data, expires_at, datetime.now())))
+
+    def get(self, user_id, kind):
+        now = datetime.now()
+        with self._lock:
+            entry = self._cache.get(user_id)
+        if entry is None or now - entry[3] > timedelta(seconds=self.cache_seconds):
+            row = db.session.query(ConversationState.kind, ConversationState.data,
+                                   ConversationState.expires_at).filter_by(line_user_id=user_id).first()
+            entry = (row.kind, json.loads(row.data), row.expires_at, now) if row else (None, None, now, now)
+            self._cache_put(user_id, entry)
+        if entry[0] != kind or entry[2] <= now:
+            return None
+        return entry[1]
+
+    def take(self, user_id, kind):
+        """取出並刪除未過期的狀態；沒有（或已被其他 worker 取走）時回傳 None"""
+        self._cache_drop(user_id)
+        row = db.session.execute(db.text(
+            'DELETE FROM conversation_states WHERE line_user_id = :user_id AND kind = :kind '
+            'RETURNING data, expires_at'
+        ).columns(data=db.Text, expires_at=db.DateTime), {'user_id': user_id, 'kind': kind}).first()
+        if row is None or row.expires_at <= datetime.now():
+            return None
+        return json.loads(row.data)
+
+    def clear(self, user_id):
+        ConversationState.query.filter_by(line_user_id=user_id).delete(synchronize_session=False)
+        self._cache_drop(user_id)
+
+    def _purge_expired(self, now):
+        if now - self._last_purge < timedelta(seconds=self.purge_interval):
+            return
+        self._last_purge = now
+        ConversationState.query.filter(ConversationState.expires_at <= now) \
+            .delete(synchronize_session=False)
+
+
+conversation_states = ConversationStore(int(os.environ.get('CONVERSATION_STATE_TTL', '3600')))
 
 
 def check_admin():
@@ -249,42 +1244,690 @@ def check_admin():
     return None
 
 
-def generate_booking_number():
-    today = datetime.now().strftime('%Y%m%d')
-    count = Booking.query.filter(Booking.booking_number.like(f'BK{today}%')).count()
-    return f'BK{today}{str(count + 1).zfill(4)}'
+def generate_booking_number(day=None):
+    """
+    以單一 upsert ... RETURNING 取得當日下一個流水號。
+    在呼叫端的 transaction 內執行，多個 gunicorn worker 同時預約也不會拿到相同編號；
+    預約 rollback 時流水號一併 rollback。
+    """
+    day = day or datetime.now().strftime('%Y%m%d')
+    seq = db.session.execute(db.text(
+        'INSERT INTO booking_sequences (day, last_seq) VALUES (:day, 1) '
+        'ON CONFLICT (day) DO UPDATE SET last_seq = booking_sequences.last_seq + 1 '
+        'RETURNING last_seq'
+    ), {'day': day}).scalar()
+    return f'BK{day}{str(seq).zfill(4)}'
+
+
+class SlotTaken(Exception):
+    """時段已被其他人預約"""
+
+
+def create_booking_record(teacher, date, time, customer_name, customer_phone,
+                          duration=60, source='web', line_user_id=None, note=None):
+    """
+    新增一筆 confirmed 預約並 flush（由呼叫端 commit）。
+    先以條件 UPDATE 佔用 time_slots，時段未開放或已被佔用時 rollback 後 raise SlotTaken；
+    bookings 的 partial unique index 是第二道防線。
+    """
+    if not set_slot_booked(teacher.id, date, time, True):
+        db.session.rollback()
+        raise SlotTaken(f'{date} {time}')
+    booking = Booking(
+        booking_number=generate_booking_number(),
+        teacher_id=teacher.id,
+        customer_name=customer_name,
+        customer_phone=customer_phone,
+        line_user_id=line_user_id,
+        date=date,
+        time=time,
+        starts_at=datetime.strptime(f'{date} {time}', '%Y-%m-%d %H:%M'),
+        duration=duration,
+        total_price=int((duration / 60) * teacher.hourly_rate),
+        source=source,
+        note=note
+    )
+    db.session.add(booking)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        if check_availability(teacher.id, date, time):
+            raise
+        raise SlotTaken(f'{date} {time}')
+    availability.record(teacher.id, date, time, booked=True)
+    bump_daily_stat(date, teacher.id, source, confirmed=1, revenue=booking.total_price)
+    bump_customer_totals(customer_phone, 1, duration, booking.total_price)
+    publish_booking_event('booking_created', booking, teacher.name, 1)
+    return booking
+
+
+def set_slot_booked(teacher_id, date, time, booked):
+    """
+    UPDATE time_slots SET is_booked = :booked WHERE ... AND is_booked = NOT :booked；
+    並發搶同一時段時只有一個 transaction 會更新到那一列。成功回傳 True
+    """
+    return db.session.execute(
+        update(TimeSlot).where(
+            TimeSlot.teacher_id == teacher_id,
+            TimeSlot.date == date,
+            TimeSlot.time == time,
+            TimeSlot.is_booked == (not booked)
+        ).values(is_booked=booked).execution_options(synchronize_session=False)
+    ).rowcount == 1
+
+
+def cancel_booking_record(booking):
+    """將 confirmed 預約改為 cancelled（由呼叫端 commit）；原本就不是 confirmed 時回傳 False"""
+    if booking.status != 'confirmed':
+        return False
+    booking.status = 'cancelled'
+    if slot_is_scheduled(booking.teacher_id, booking.date, booking.time):
+        set_slot_booked(booking.teacher_id, booking.date, booking.time, False)
+        availability.record(booking.teacher_id, booking.date, booking.time, booked=False)
+    else:
+        # 預約後排班改變或加了例外（假日、請假）：時段不再開放，刪除而不是重新開放
+        TimeSlot.query.filter_by(teacher_id=booking.teacher_id, date=booking.date, time=booking.time) \
+            .delete(synchronize_session=False)
+        availability.invalidate([(booking.teacher_id, booking.date)])
+    bump_daily_stat(booking.date, booking.teacher_id, booking.source,
+                    confirmed=-1, revenue=-(booking.total_price or 0))
+    bump_customer_totals(booking.customer_phone, -1, -(booking.duration or 0),
+                         -(booking.total_price or 0))
+    teacher = entity_cache.teacher(booking.teacher_id)
+    publish_booking_event('booking_cancelled', booking, teacher.name if teacher else '', -1)
+    return True
+
+
+_teacher_index = None
+_teacher_index_lock = threading.Lock()
+
+
+def teacher_index():
+    """老師名稱索引（process 內快取，'teachers' 版本號變動時重建）"""
+    global _teacher_index
+    version = read_version('teachers')
+    index = _teacher_index
+    if index is None or index.version != version:
+        with _teacher_index_lock:
+            index = _teacher_index
+            if index is None or index.version != version:
+                teachers = db.session.query(Teacher.id, Teacher.name).filter_by(is_active=True).all()
+                index = _teacher_index = text_intent.TeacherIndex(teachers, version)
+    return index
 
 
 def find_teacher_by_name(name):
-    return Teacher.query.filter(
-        Teacher.name.like(f'%{name}%'),
-        Teacher.is_active == True
-    ).first()
+    """依全名、名字或「姓 + 老師」找老師；找不到或有多位同姓老師時回傳 None"""
+    teacher_ids, _ = teacher_index().match(text_intent.normalize(name))
+    return entity_cache.teacher(teacher_ids[0]) if len(teacher_ids) == 1 else None
+
+
+class EntityCache:
+    """
+    Teacher（依 id）與 Customer（依 LINE user id）的 read-through 快取：process 內 LRU + TTL。
+    寫入時於 commit 後移除本 process 的那一筆，並在同一個 transaction 遞增 data_versions 的版本戳；
+    其他 worker 每 stamp_interval 秒讀一次版本戳，變動時清掉該類別的快取。
+    回傳的是不屬於任何 session 的副本，只能讀取，不可修改或加入 session；
+    Customer 只快取身分欄位（累計欄位請直接查詢）。查不到的結果不快取。
+    """
+
+    STAMPS = {'teacher': 'teachers', 'customer': 'customers'}
+    CUSTOMER_FIELDS = ('id', 'name', 'phone', 'email', 'line_user_id')
+
+    def __init__(self, ttl_seconds=300, max_entries=10000, stamp_interval=1.0):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.stamp_interval = stamp_interval
+        self._entries = OrderedDict()  # (kind, key) -> (expires_at, columns)
+        self._stamps = {}
+        self._stamp_checked = 0.0
+        self._lock = threading.Lock()
+        self._counts = {kind: {'hits': 0, 'misses': 0, 'invalidations': 0} for kind in self.STAMPS}
+        self.evictions = 0
+
+    def _check_stamps(self):
+        now = time.monotonic()
+        if now - self._stamp_checked < self.stamp_interval:
+            return
+        self._stamp_checked = now
+        rows = dict(db.session.query(DataVersion.name, DataVersion.version).filter(
+            DataVersion.name.in_(list(self.STAMPS.values()))
+        ).all())
+        with self._lock:
+            for kind, name in self.STAMPS.items():
+                version = rows.get(name, 0)
+                if kind in self._stamps and self._stamps[kind] != version:
+                    self._drop_kind(kind)
+                self._stamps[kind] = version
+
+    def _drop_kind(self, kind):
+        keys = [k for k in self._entries if k[0] == kind]
+        for k in keys:
+            del self._entries[k]
+        self._counts[kind]['invalidations'] += len(keys)
+
+    def _get(self, kind, key, load):
+        self._check_stamps()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            if entry and entry[0] > now:
+                self._entries.move_to_end((kind, key))
+                self._counts[kind]['hits'] += 1
+                return entry[1]
+            self._counts[kind]['misses'] += 1
+            stamp = self._stamps.get(kind)
+        columns = load()
+        if columns is not None:
+            with self._lock:
+                # 讀取期間版本戳變動時不寫入，避免把舊資料放回快取
+                if self._stamps.get(kind) == stamp:
+                    self._entries[(kind, key)] = (now + self.ttl_seconds, columns)
+                    self._entries.move_to_end((kind, key))
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self.evictions += 1
+        return columns
+
+    def teacher(self, teacher_id):
+        """依 id 取得 Teacher 副本，不存在時回傳 None"""
+        try:
+            teacher_id = int(teacher_id)
+        except (TypeError, ValueError):
+            return None
+
+        def load():
+            row = db.session.query(*Teacher.__table__.columns).filter(Teacher.id == teacher_id).first()
+            return dict(row._mapping) if row else None
+        columns = self._get('teacher', teacher_id, load)
+        return Teacher(**columns) if columns else None
+
+    def customer_by_line_id(self, user_id):
+        """依 LINE user id 取得 Customer 副本（只有身分欄位），尚未註冊時回傳 None"""
+        if not user_id:
+            return None
+
+        def load():
+            row = db.session.query(*[getattr(Customer, f) for f in self.CUSTOMER_FIELDS]) \
+                .filter(Customer.line_user_id == user_id).first()
+            return dict(row._mapping) if row else None
+        columns = self._get('customer', user_id, load)
+        return Customer(**columns) if columns else None
+
+    def invalidate(self, kind, entity_id):
+        """commit 後移除本 process 中這筆資料的快取（依 id 比對，改了 LINE user id 的舊 key 也會移除）"""
+        with self._lock:
+            keys = [k for k, (_, columns) in self._entries.items()
+                    if k[0] == kind and columns['id'] == entity_id]
+            for k in keys:
+                del self._entries[k]
+            self._counts[kind]['invalidations'] += len(keys)
+
+    def stats(self):
+        with self._lock:
+            result = {'entries': len(self._entries), 'evictions': self.evictions}
+            for kind, counts in self._counts.items():
+                total = counts['hits'] + counts['misses']
+                result[kind] = dict(counts, hit_rate=round(counts['hits'] / total, 4) if total else 0)
+            return result
+
+
+entity_cache = EntityCache(
+    ttl_seconds=int(os.environ.get('ENTITY_CACHE_TTL', '300')),
+    stamp_interval=float(os.environ.get('ENTITY_CACHE_STAMP_INTERVAL', '1'))
+)
+
+
+def _entity_written(kind, entity_id, connection):
+    """在寫入的 transaction 內遞增版本戳，commit 後移除本 process 的快取"""
+    connection.execute(_BUMP_VERSION_SQL, {'name': EntityCache.STAMPS[kind]})
+    after_commit(lambda: entity_cache.invalidate(kind, entity_id))
+
+
+@event.listens_for(Teacher, 'after_insert')
+@event.listens_for(Teacher, 'after_update')
+@event.listens_for(Teacher, 'after_delete')
+def _teacher_written(mapper, connection, target):
+    _entity_written('teacher', target.id, connection)
+
+
+# 查不到的結果不快取，新增客戶不需要失效
+@event.listens_for(Customer, 'after_update')
+def _customer_updated(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[f].history.has_changes() for f in EntityCache.CUSTOMER_FIELDS):
+        _entity_written('customer', target.id, connection)
+
+
+@event.listens_for(Customer, 'after_delete')
+def _customer_deleted(mapper, connection, target):
+    _entity_written('customer', target.id, connection)
+
+
+# 時段格：每小時一格。實際開放哪些時段由排班（TeacherSchedule）產生的 TimeSlot 決定
+SLOT_TIMES = [f'{h:02d}:00' for h in range(24)]
+SLOT_BITS = {t: 1 << i for i, t in enumerate(SLOT_TIMES)}
+
+
+def mask_times(mask):
+    return [t for t in SLOT_TIMES if mask & SLOT_BITS[t]]
+
+
+class AvailabilityEngine:
+    """
+    每個 (teacher_id, date) 在記憶體中存兩個 bitmap：開放的時段與已預約的時段，
+    第一次查詢時用一次 time_slots 索引查詢載入；建立 / 取消預約時就地更新。
+    每個 key 在 data_versions 有版本號，其他 process 改動後版本不符就重新載入。
+    """
+
+    def __init__(self, max_entries=20000):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()  # (teacher_id, date) -> (version, open_mask, booked_mask)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def version_key(teacher_id, date):
+        return f'avail:{teacher_id}:{date}'
+
+    def _load(self, teacher_id, date):
+        rows = db.session.query(TimeSlot.time, TimeSlot.is_booked).filter(
+            TimeSlot.teacher_id == teacher_id,
+            TimeSlot.date == date
+        ).all()
+        open_mask = booked_mask = 0
+        for t, booked in rows:
+            bit = SLOT_BITS.get(t, 0)
+            open_mask |= bit
+            if booked:
+                booked_mask |= bit
+        return open_mask, booked_mask
+
+    def _store(self, key, version, masks):
+        with self._lock:
+            self._cache[key] = (version,) + masks
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def masks(self, teacher_id, date, version=None):
+        """回傳 (open_mask, booked_mask)；呼叫端已讀過版本號時可傳入 version"""
+        key = (int(teacher_id), date)
+        if version is None:
+            version = read_version(self.version_key(*key))
+        cached = self._cache.get(key)
+        if cached and cached[0] == version:
+            return cached[1:]
+        masks = self._load(*key)
+        self._store(key, version, masks)
+        return masks
+
+    def free_mask(self, teacher_id, date):
+        open_mask, booked_mask = self.masks(teacher_id, date)
+        return open_mask & ~booked_mask
+
+    def versions(self, keys):
+        """一次查詢讀多個 (teacher_id, date) 的版本號，回傳 {key: version}"""
+        names = {self.version_key(*k): k for k in keys}
+        versions = dict.fromkeys(keys, 0)
+        if not keys:
+            return versions
+        rows = db.session.query(DataVersion.name, DataVersion.version).filter(
+            DataVersion.name.in_(list(names))
+        ).all()
+        for name, version in rows:
+            versions[names[name]] = version
+        return versions
+
+    def bulk_masks(self, teacher_ids, dates, versions=None):
+        """
+        多位老師 × 多天的 bitmap：一次查詢讀版本號（或沿用呼叫端已讀的 versions），
+        過期或未載入的部分再用一次區間查詢補齊。回傳 {(teacher_id, date): (open_mask, booked_mask)}
+        """
+        keys = [(int(t), d) for t in teacher_ids for d in dates]
+        if not keys:
+            return {}
+        if versions is None:
+            versions = self.versions(keys)
+
+        result, stale = {}, {}
+        for key in keys:
+            cached = self._cache.get(key)
+            if cached and cached[0] == versions[key]:
+                result[key] = cached[1:]
+            else:
+                stale[key] = [0, 0]
+        if stale:
+            rows = db.session.query(TimeSlot.teacher_id, TimeSlot.date, TimeSlot.time,
+                                    TimeSlot.is_booked).filter(
+                TimeSlot.teacher_id.in_(sorted({k[0] for k in stale})),
+                TimeSlot.date >= min(k[1] for k in stale),
+                TimeSlot.date <= max(k[1] for k in stale)
+            ).all()
+            for t_id, d, t, booked in rows:
+                masks = stale.get((t_id, d))
+                if masks is not None:
+                    bit = SLOT_BITS.get(t, 0)
+                    masks[0] |= bit
+                    if booked:
+                        masks[1] |= bit
+            for key, masks in stale.items():
+                result[key] = tuple(masks)
+                self._store(key, versions[key], result[key])
+        return result
+
+    def free_times(self, teacher_id, date):
+        return mask_times(self.free_mask(teacher_id, date))
+
+    def booked_times(self, teacher_id, date):
+        return mask_times(self.masks(teacher_id, date)[1])
+
+    def is_free(self, teacher_id, date, time):
+        bit = SLOT_BITS.get(time)
+        if bit is None:
+            # 不在時段格上的時間直接查資料表
+            return TimeSlot.query.filter_by(teacher_id=teacher_id, date=date, time=time,
+                                            is_booked=False).first() is not None
+        return bool(self.free_mask(teacher_id, date) & bit)
+
+    def record(self, teacher_id, date, time, booked):
+        """在建立 / 取消預約的 transaction 內呼叫：遞增版本號，commit 後更新本機 bitmap"""
+        key = (int(teacher_id), date)
+        version = bump_version(self.version_key(*key))
+        bit = SLOT_BITS.get(time, 0)
+
+        def apply():
+            with self._lock:
+                cached = self._cache.get(key)
+                if cached and cached[0] == version - 1:
+                    _, open_mask, booked_mask = cached
+                    booked_mask = booked_mask | bit if booked else booked_mask & ~bit
+                    self._cache[key] = (version, open_mask, booked_mask)
+                else:
+                    self._cache.pop(key, None)
+        after_commit(apply)
+
+    def invalidate(self, keys):
+        """時段被重新產生時：一次遞增多個版本號，commit 後丟掉本機快取"""
+        keys = [(int(t), d) for t, d in keys]
+        if not keys:
+            return
+        db.session.execute(_BUMP_VERSION_SQL, [{'name': self.version_key(*k)} for k in keys])
+
+        def apply():
+            with self._lock:
+                for key in keys:
+                    self._cache.pop(key, None)
+        after_commit(apply)
+
+
+availability = AvailabilityEngine()
 
 
 def check_availability(teacher_id, date, time):
-    existing = Booking.query.filter(
-        Booking.teacher_id == teacher_id,
-        Booking.date == date,
-        Booking.time == time,
-        Booking.status == 'confirmed'
-    ).first()
-    return existing is None
+    return availability.is_free(teacher_id, date, time)
 
 
 def get_available_times(teacher_id, date):
-    booked = Booking.query.filter(
-        Booking.teacher_id == teacher_id,
-        Booking.date == date,
+    return availability.free_times(teacher_id, date)
+
+
+# 
+# 排班與時段產生
+# 
+
+SLOT_HORIZON_WEEKS = int(os.environ.get('SLOT_HORIZON_WEEKS', '8'))
+DEFAULT_SCHEDULE = ('09:00', '21:00')  # 新老師的預設排班：每天 09:00 - 21:00
+
+
+def default_schedule(teacher_id):
+    return [TeacherSchedule(teacher_id=teacher_id, weekday=weekday,
+                            start_time=DEFAULT_SCHEDULE[0], end_time=DEFAULT_SCHEDULE[1])
+            for weekday in range(7)]
+
+
+def _times_between(start, end):
+    return [t for t in SLOT_TIMES if start <= t < end]
+
+
+def slot_is_scheduled(teacher_id, date, time):
+    """依目前的每週排班與例外，該時段是否應該開放（與 materialize_slots 的規則相同）"""
+    teacher = entity_cache.teacher(teacher_id)
+    if not teacher or not teacher.is_active:
+        return False
+    weekday = datetime.strptime(date, '%Y-%m-%d').weekday()
+    if not any(time in _times_between(row.start_time, row.end_time) for row in
+               TeacherSchedule.query.filter_by(teacher_id=teacher.id, weekday=weekday)):
+        return False
+    return not any(time in _times_between(ex.start_time or '00:00', ex.end_time or '24:00') for ex in
+                   ScheduleException.query.filter(
+                       ScheduleException.date == date,
+                       db.or_(ScheduleException.teacher_id.is_(None),
+                              ScheduleException.teacher_id == teacher.id)))
+
+
+_INSERT_SLOT_ROW = '(:t{n}, :d{n}, :h{n}, 60, :b{n})'
+
+
+def materialize_slots(teacher_ids=None, start=None, weeks=None, batch_size=500):
+    """
+    依每週排班與例外產生 [start, start + weeks 週) 的 TimeSlot（預設從今天起 SLOT_HORIZON_WEEKS 週）。
+    與既有時段比對後，批次新增缺少的、刪除不再開放且沒有 confirmed 預約的（有預約的保留，
+    預約取消後下次執行時刪除）；
+    區間內已有 confirmed 預約的時段新增時直接標為已預約。回傳 (新增數, 刪除數)
+    """
+    start = start or datetime.now().date()
+    days = [start + timedelta(days=i) for i in range(7 * (weeks or SLOT_HORIZON_WEEKS))]
+    first, last = days[0].strftime('%Y-%m-%d'), days[-1].strftime('%Y-%m-%d')
+    query = db.session.query(Teacher.id, Teacher.is_active)
+    if teacher_ids is not None:
+        query = query.filter(Teacher.id.in_(teacher_ids))
+    active = dict(query.all())
+    if not active:
+        return 0, 0
+    ids = sorted(active)
+
+    templates = {}
+    for row in TeacherSchedule.query.filter(TeacherSchedule.teacher_id.in_(ids)):
+        templates.setdefault((row.teacher_id, row.weekday), set()).update(
+            _times_between(row.start_time, row.end_time))
+    closed = {}
+    for ex in ScheduleException.query.filter(
+        ScheduleException.date >= first, ScheduleException.date <= last,
+        db.or_(ScheduleException.teacher_id.is_(None), ScheduleException.teacher_id.in_(ids))
+    ):
+        closed.setdefault((ex.teacher_id, ex.date), set()).update(
+            _times_between(ex.start_time or '00:00', ex.end_time or '24:00'))
+
+    desired = set()
+    for d in days:
+        ds = d.strftime('%Y-%m-%d')
+        for t_id in ids:
+            times = templates.get((t_id, d.weekday())) if active[t_id] else None
+            if times:
+                off = closed.get((None, ds), set()) | closed.get((t_id, ds), set())
+                desired.update((t_id, ds, t) for t in times - off)
+
+    in_range = (TimeSlot.teacher_id.in_(ids), TimeSlot.date >= first, TimeSlot.date <= last)
+    existing = {(t_id, d, t): (slot_id, is_booked) for slot_id, t_id, d, t, is_booked in
+                db.session.query(TimeSlot.id, TimeSlot.teacher_id, TimeSlot.date, TimeSlot.time,
+                                 TimeSlot.is_booked).filter(*in_range)}
+    booked = set(db.session.query(Booking.teacher_id, Booking.date, Booking.time).filter(
+        Booking.teacher_id.in_(ids), Booking.date >= first, Booking.date <= last,
         Booking.status == 'confirmed'
-    ).all()
-    booked_times = {b.time for b in booked}
-    all_times = [f'{h:02d}:00' for h in range(9, 21)]
-    return [t for t in all_times if t not in booked_times]
+    ))
+    to_insert = sorted(desired - existing.keys())
+    to_delete = sorted(slot_id for key, (slot_id, _) in existing.items()
+                       if key not in desired and key not in booked)
+
+    for i in range(0, len(to_insert), batch_size):
+        rows, params = [], {}
+        for n, (t_id, ds, t) in enumerate(to_insert[i:i + batch_size]):
+            rows.append(_INSERT_SLOT_ROW.format(n=n))
+            params.update({f't{n}': t_id, f'd{n}': ds, f'h{n}': t, f'b{n}': (t_id, ds, t) in booked})
+        db.session.execute(db.text(
+            'INSERT INTO time_slots (teacher_id, date, time, duration, is_booked) VALUES '
+            + ', '.join(rows) + ' ON CONFLICT (teacher_id, date, time) DO NOTHING'
+        ), params)
+    confirmed = db.exists().where(Booking.teacher_id == TimeSlot.teacher_id, Booking.date == TimeSlot.date,
+                                  Booking.time == TimeSlot.time, Booking.status == 'confirmed')
+    for i in range(0, len(to_delete), batch_size):
+        TimeSlot.query.filter(TimeSlot.id.in_(to_delete[i:i + batch_size]), ~confirmed) \
+            .delete(synchronize_session=False)
+
+    deleted = set(to_delete)
+    changed = {(t_id, ds) for t_id, ds, _ in to_insert}
+    changed.update((t_id, ds) for (t_id, ds, _), (slot_id, _) in existing.items() if slot_id in deleted)
+    availability.invalidate(changed)
+    db.session.commit()
+    return len(to_insert), len(to_delete)
+
+
+class SlotHorizon:
+    """每個 process 一條執行緒，定期把時段往後補足 SLOT_HORIZON_WEEKS 週"""
+
+    def __init__(self, interval=3600):
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with app.app_context():
+                try:
+                    materialize_slots()
+                except Exception as e:
+                    print(f'時段產生失敗: {e}')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+
+slot_horizon = SlotHorizon()
+
+
+# 
+# 冷熱資料分離：封存過去的預約
+# 
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '90'))
+ARCHIVE_TIMES = sorted(t.strip() for t in os.environ.get('ARCHIVE_TIMES', '03:30').split(',')
+                       if t.strip())
+VACUUM_STEP_PAGES = int(os.environ.get('VACUUM_STEP_PAGES', '2000'))
+
+_ARCHIVE_COLUMNS = ', '.join(c.name for c in Booking.__table__.columns)
+
+
+def archive_bookings(days=None, batch_size=1000):
+    """
+    把上課日早於 days 天前的預約（已上完的 confirmed 與已取消的）分批搬到 bookings_archive，
+    並刪除同樣早於期限的 time_slots。回傳 (搬移的預約數, 刪除的時段數)。
+    每批一個 transaction：INSERT ... SELECT（已存在的略過）後 DELETE，中斷或多個 process
+    同時執行都不會遺失或重複。最新的一筆預約一律留在 bookings，SQLite 才不會在表清空後重用 id。
+    """
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    cutoff = datetime.combine(datetime.now().date() - timedelta(days=days), datetime.min.time())
+    cutoff_day = cutoff.strftime('%Y-%m-%d')
+    newest = db.session.query(func.max(Booking.id)).scalar_subquery()
+    insert_sql = db.text(
+        f'INSERT INTO bookings_archive ({_ARCHIVE_COLUMNS}, archived_at) '
+        f'SELECT {_ARCHIVE_COLUMNS}, :now FROM bookings WHERE id IN :ids '
+        'ON CONFLICT (id) DO NOTHING'
+    ).bindparams(db.bindparam('ids', expanding=True), db.bindparam('now', type_=db.DateTime))
+
+    moved = 0
+    while True:
+        ids = [booking_id for (booking_id,) in db.session.query(Booking.id).filter(
+            Booking.starts_at < cutoff, Booking.id < newest
+        ).order_by(Booking.id).limit(batch_size)]
+        if not ids:
+            break
+        db.session.execute(insert_sql, {'ids': ids, 'now': datetime.now()})
+        BookingReminder.query.filter(BookingReminder.booking_id.in_(ids)) \
+            .delete(synchronize_session=False)
+        Booking.query.filter(Booking.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        moved += len(ids)
+
+    pruned = 0
+    while True:
+        batch = db.session.query(TimeSlot.id).filter(TimeSlot.date < cutoff_day).limit(batch_size)
+        deleted = TimeSlot.query.filter(TimeSlot.id.in_(batch.scalar_subquery())) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        pruned += deleted
+        if deleted < batch_size:
+            break
+    return moved, pruned
+
+
+def reclaim_space(full=False):
+    """
+    回收封存後留下的空間，回傳釋放的頁數（PostgreSQL 為 None）。
+    SQLite（auto_vacuum=INCREMENTAL）以 incremental_vacuum 每次釋放 VACUUM_STEP_PAGES 頁，
+    中間讓出寫入鎖；full=True 時改為設定 INCREMENTAL 並執行一次完整 VACUUM（舊資料庫轉換用）。
+    PostgreSQL 對搬移過的表執行 VACUUM (ANALYZE)。
+    """
+    if db.engine.url.get_backend_name() != 'sqlite':
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql('VACUUM (ANALYZE) bookings, bookings_archive, time_slots')
+        return None
+    with db.engine.connect() as conn:
+        if full:
+            conn.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+            before = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+            conn.exec_driver_sql('VACUUM')
+            return before
+        if conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+            print('資料庫不是 auto_vacuum=INCREMENTAL，請執行一次 flask archive-bookings --full-vacuum')
+            return 0
+        freed = 0
+        while True:
+            free = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+            if not free:
+                break
+            # sqlite3 的 execute 只會執行 incremental_vacuum 的第一步（一頁），executescript 才會執行完
+            conn.connection.driver_connection.executescript(
+                f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})')
+            freed += min(free, VACUUM_STEP_PAGES)
+            time.sleep(0.05)
+        return freed
+
+
+_CLAIM_DAY_SQL = db.text(
+    'INSERT INTO data_versions (name, version) VALUES (:name, :day) '
+    'ON CONFLICT (name) DO UPDATE SET version = excluded.version '
+    'WHERE data_versions.version < excluded.version '
+    'RETURNING version'
+)
+
+
+def run_archive_job():
+    """每天一次的封存 + 空間回收；以 data_versions 認領當天的執行權，多個 worker 只有一個會執行"""
+    claimed = db.session.execute(_CLAIM_DAY_SQL, {
+        'name': 'job:archive', 'day': datetime.now().date().toordinal()
+    }).scalar()
+    db.session.commit()
+    if claimed is None:
+        return
+    moved, pruned = archive_bookings()
+    freed = reclaim_space()
+    print(f'預約封存：搬移 {moved} 筆、刪除過期時段 {pruned} 筆'
+          + (f'、回收 {freed} 頁' if freed else ''))
 
 
 def get_or_create_customer(user_id, name=None, phone=None):
-    customer = Customer.query.filter_by(line_user_id=user_id).first()
+    customer = entity_cache.customer_by_line_id(user_id)
     if not customer and name and phone:
         customer = Customer(name=name, phone=phone, line_user_id=user_id)
         db.session.add(customer)
@@ -292,94 +1935,110 @@ def get_or_create_customer(user_id, name=None, phone=None):
     return customer
 
 
-def send_flex_message(user_id, alt_text, flex_content):
-    """Push Flex Message"""
+class FlexCache:
+    """
+    已序列化好的 Flex 訊息（messages 陣列的 JSON bytes）。
+    key 由模板名稱加上資料版本組成，資料變動後 key 不同即自然失效；
+    以 LRU 淘汰並限制總位元組數。
+    """
+
+    def __init__(self, max_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, build):
+        """build() 回傳 (alt_text, flex_content)，只在未命中時呼叫"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        alt_text, contents = build()
+        data = LineClient.serialize([{'type': 'flex', 'altText': alt_text, 'contents': contents}])
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = data
+                self._bytes += len(data)
+                while self._bytes > self.max_bytes and len(self._entries) > 1:
+                    _, old = self._entries.popitem(last=False)
+                    self._bytes -= len(old)
+                    self.evictions += 1
+        return data
+
+    def invalidate(self, template):
+        """移除某個模板的所有項目（本 process）"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == template]:
+                self._bytes -= len(self._entries.pop(key))
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries), 'bytes': self._bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': round(self.hits / total, 4) if total else 0
+            }
+
+
+flex_cache = FlexCache(int(os.environ.get('FLEX_CACHE_BYTES', str(4 * 1024 * 1024))))
+
+
+def _push_messages(user_id, messages):
     if not LINE_CHANNEL_ACCESS_TOKEN:
         return False
-    url = 'https://api.line.me/v2/bot/message/push'
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}'
-    }
-    data = {
-        'to': user_id,
-        'messages': [{
-            'type': 'flex',
-            'altText': alt_text,
-            'contents': flex_content
-        }]
-    }
-    try:
-        r = requests.post(url, headers=headers, json=data, timeout=10)
-        return r.status_code == 200
-    except Exception as e:
-        print(f'Push Flex : {e}')
+    return line_api.ok(line_api.push(user_id, messages))
+
+
+def _reply_messages(reply_token, messages):
+    """reply；token 逾時或失效時改用 push。messages 可為 list 或已序列化的 bytes"""
+    if not LINE_CHANNEL_ACCESS_TOKEN:
         return False
+    event = _current_line_event(reply_token)
+    if event and datetime.now() > event['reply_deadline']:
+        return _push_messages(event['user_id'], messages)
+    r = line_api.reply(reply_token, messages)
+    if r is not None and r.status_code == 400 and event:
+        # reply token 已失效，改用 push
+        return _push_messages(event['user_id'], messages)
+    return line_api.ok(r)
+
+
+def send_flex_message(user_id, alt_text, flex_content):
+    """Push Flex Message"""
+    return _push_messages(user_id, [{
+        'type': 'flex',
+        'altText': alt_text,
+        'contents': flex_content
+    }])
 
 
 def reply_flex_message(reply_token, alt_text, flex_content):
     """Reply Flex Message"""
-    if not LINE_CHANNEL_ACCESS_TOKEN:
-        return False
-    url = 'https://api.line.me/v2/bot/message/reply'
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}'
-    }
-    data = {
-        'replyToken': reply_token,
-        'messages': [{
-            'type': 'flex',
-            'altText': alt_text,
-            'contents': flex_content
-        }]
-    }
-    try:
-        r = requests.post(url, headers=headers, json=data, timeout=10)
-        if r.status_code != 200:
-            print(f'Reply Flex : {r.status_code} {r.text}')
-        return r.status_code == 200
-    except Exception as e:
-        print(f'Reply Flex : {e}')
-        return False
+    return _reply_messages(reply_token, [{
+        'type': 'flex',
+        'altText': alt_text,
+        'contents': flex_content
+    }])
+
+
+def reply_cached_flex(reply_token, key, build):
+    """Reply 快取的 Flex Message；build() 回傳 (alt_text, flex_content)"""
+    return _reply_messages(reply_token, flex_cache.get(key, build))
 
 
 def reply_text_message(reply_token, text):
     """Reply """
-    if not LINE_CHANNEL_ACCESS_TOKEN:
-        return False
-    url = 'https://api.line.me/v2/bot/message/reply'
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}'
-    }
-    data = {
-        'replyToken': reply_token,
-        'messages': [{'type': 'text', 'text': text}]
-    }
-    try:
-        r = requests.post(url, headers=headers, json=data, timeout=10)
-        return r.status_code == 200
-    except Exception as e:
-        print(f'Reply Text : {e}')
-        return False
+    return _reply_messages(reply_token, [{'type': 'text', 'text': text}])
 
 
 def send_text_message(user_id, text):
-    if not LINE_CHANNEL_ACCESS_TOKEN:
-        return False
-    url = 'https://api.line.me/v2/bot/message/push'
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}'
-    }
-    data = {'to': user_id, 'messages': [{'type': 'text', 'text': text}]}
-    try:
-        r = requests.post(url, headers=headers, json=data, timeout=10)
-        return r.status_code == 200
-    except Exception as e:
-        print(f'Push Text : {e}')
-        return False
+    return _push_messages(user_id, [{'type': 'text', 'text': text}])
 
 
 def send_admin_notification(message):
@@ -527,15 +2186,48 @@ def build_teacher_carousel(teachers):
     }
 
 
-def build_date_picker_flex(teacher_id, teacher_name):
-    """7"""
+def date_picker_days(teacher_id):
+    """
+    日期選單的 7 天，以及其中不可預約的日期與原因：
+    沒有任何時段（未排班、假日或請假）為「休息」，時段都被預約為「已額滿」
+    """
     today = datetime.now().date()
+    days = [(today + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(1, 8)]
+    masks = availability.bulk_masks([teacher_id], days)
+    unavailable = {}
+    for (_, d), (open_mask, booked_mask) in masks.items():
+        if not open_mask:
+            unavailable[d] = '休息'
+        elif not open_mask & ~booked_mask:
+            unavailable[d] = '已額滿'
+    return days, unavailable
+
+
+def build_date_picker_flex(teacher_id, teacher_name, days=None, unavailable=None):
+    """7"""
+    if days is None:
+        days, unavailable = date_picker_days(teacher_id)
+    unavailable = unavailable or {}
     date_buttons = []
 
-    for i in range(1, 8):
-        d = today + timedelta(days=i)
+    for i, ds in enumerate(days, start=1):
+        d = datetime.strptime(ds, '%Y-%m-%d').date()
         label = d.strftime('%m/%d') + (' (明天)' if i == 1 else '')
         weekday = ['一', '二', '三', '四', '五', '六', '日'][d.weekday()]
+        if ds in unavailable:
+            # 休息 / 已額滿：顯示但不可點選，省去一次來回
+            date_buttons.append({
+                "type": "box",
+                "layout": "vertical",
+                "backgroundColor": "#EEEEEE",
+                "cornerRadius": "md",
+                "paddingAll": "10px",
+                "contents": [
+                    {"type": "text", "text": f"{d.strftime('%m/%d')} ({weekday})  {unavailable[ds]}",
+                     "size": "sm", "color": "#AAAAAA", "align": "center"}
+                ]
+            })
+            continue
         date_buttons.append({
             "type": "button",
             "style": "secondary",
@@ -738,10 +2430,8 @@ def build_confirm_flex(teacher_name, date, time, price, teacher_id):
 def build_booking_success_flex(booking):
     """"""
     teacher_name = booking.teacher.name if booking.teacher else ''
-    d_fmt = datetime.strptime(booking.date, '%Y-%m-%d').strftime('%Y年%m月%d日')
-    weekday = ['一', '二', '三', '四', '五', '六', '日'][
-        datetime.strptime(booking.date, '%Y-%m-%d').weekday()
-    ]
+    d_fmt = booking.starts_at.strftime('%Y年%m月%d日')
+    weekday = ['一', '二', '三', '四', '五', '六', '日'][booking.starts_at.weekday()]
     return {
         "type": "bubble",
         "size": "mega",
@@ -799,6 +2489,18 @@ def build_booking_success_flex(booking):
     }
 
 
+MY_BOOKINGS_LIMIT = 12  # Flex carousel 最多 12 個 bubble
+
+
+def upcoming_bookings(query):
+    """
+    query 中尚未開始的預約，依上課時間排序取前 MY_BOOKINGS_LIMIT 筆；
+    以 line_user_id + status 篩選時是 ix_bookings_line_user_status_starts_at 的區間掃描
+    """
+    return query.filter(Booking.starts_at >= datetime.now()) \
+        .order_by(Booking.starts_at).limit(MY_BOOKINGS_LIMIT).all()
+
+
 def build_my_bookings_flex(bookings):
     """"""
     if not bookings:
@@ -833,7 +2535,7 @@ def build_my_bookings_flex(bookings):
     bubbles = []
     for b in bookings:
         teacher_name = b.teacher.name if b.teacher else ''
-        d_fmt = datetime.strptime(b.date, '%Y-%m-%d').strftime('%m/%d')
+        d_fmt = b.starts_at.strftime('%m/%d')
         bubble = {
             "type": "bubble",
             "size": "kilo",
@@ -963,6 +2665,387 @@ def _info_row(label, value):
     }
 
 
+# 
+# Webhook 事件佇列
+# 
+
+_line_event_ctx = threading.local()
+
+
+def _current_line_event(reply_token):
+    """目前 worker 正在處理的事件（reply token 相符時）"""
+    event = getattr(_line_event_ctx, 'event', None)
+    if event and event['reply_token'] == reply_token:
+        return event
+    return None
+
+
+class WebhookEventQueue:
+    """
+    以 webhook_events 資料表作為持久化佇列。
+    每個 process 一個 dispatcher 認領事件，依 userId 雜湊分派到固定 lane，
+    同一用戶的事件依序處理，不同用戶之間平行處理。
+    跨 process 時，用戶若有較早的事件尚在別的 process 處理中就不會被認領。
+    每個 process 最多持有 workers × lane_depth 筆已認領未完成的事件，lane 開始處理時更新
+    locked_at，並略過已不屬於自己的事件（租約過期被放回、由其他 process 認領）。
+    失敗依指數退避重試，用盡 max_attempts 次或 payload 無法解析時標記為 failed。
+    """
+
+    def __init__(self, workers, poll_interval=0.5, lease_seconds=300, batch_size=100, lane_depth=25,
+                 max_attempts=3, retry_base=10, retention_days=7):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.max_in_flight = workers * lane_depth
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retention_days = retention_days
+        self.worker_id = None
+        self.lanes = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._in_flight = 0
+        self._last_maintenance = datetime.min
+
+    def start(self):
+        """每個 process 啟動一次（gunicorn fork 之後才建立執行緒）"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.worker_id = f'{socket.gethostname()}:{self._pid}:{uuid.uuid4().hex[:8]}'
+            self._in_flight = 0
+            self.lanes = [queue.Queue() for _ in range(self.workers)]
+            for lane in self.lanes:
+                threading.Thread(target=self._run_lane, args=(lane,), daemon=True).start()
+            threading.Thread(target=self._run_dispatcher, daemon=True).start()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _claim(self, limit):
+        """認領最多 limit 筆可處理的 pending 事件，回傳 [(id, user_id, payload, received_at, attempts)]"""
+        earlier = db.aliased(WebhookEvent)
+        blocked = db.session.query(earlier.id).filter(
+            earlier.line_user_id == WebhookEvent.line_user_id,
+            earlier.id < WebhookEvent.id,
+            db.or_(
+                earlier.status == 'pending',
+                db.and_(earlier.status == 'processing', earlier.worker != self.worker_id)
+            )
+        ).exists()
+        now = datetime.now()
+        candidates = db.session.query(WebhookEvent.id).filter(
+            WebhookEvent.status == 'pending',
+            db.or_(WebhookEvent.next_attempt_at.is_(None), WebhookEvent.next_attempt_at <= now)
+        ).order_by(WebhookEvent.id).limit(limit).all()
+        claimed = []
+        for (event_id,) in candidates:
+            updated = WebhookEvent.query.filter(
+                WebhookEvent.id == event_id,
+                WebhookEvent.status == 'pending',
+                ~blocked
+            ).update({'status': 'processing', 'worker': self.worker_id,
+                      'locked_at': now}, synchronize_session=False)
+            if updated:
+                claimed.append(event_id)
+        db.session.commit()
+        if not claimed:
+            return []
+        rows = db.session.query(
+            WebhookEvent.id, WebhookEvent.line_user_id, WebhookEvent.payload, WebhookEvent.received_at,
+            WebhookEvent.attempts
+        ).filter(WebhookEvent.id.in_(claimed)).order_by(WebhookEvent.id).all()
+        return [tuple(r) for r in rows]
+
+    def _maintenance(self):
+        """放回租約過期（process 當掉）的事件、刪除超過保存期限的 failed 事件"""
+        now = datetime.now()
+        if now - self._last_maintenance < timedelta(seconds=30):
+            return
+        self._last_maintenance = now
+        WebhookEvent.query.filter(
+            WebhookEvent.status == 'processing',
+            WebhookEvent.locked_at < now - timedelta(seconds=self.lease_seconds)
+        ).update({'status': 'pending', 'worker': None}, synchronize_session=False)
+        WebhookEvent.query.filter(
+            WebhookEvent.status == 'failed',
+            WebhookEvent.received_at < now - timedelta(days=self.retention_days)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+    def _run_dispatcher(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            room = min(self.batch_size, self.max_in_flight - self._in_flight)
+            try:
+                with app.app_context():
+                    self._maintenance()
+                    claimed = self._claim(room) if room > 0 else []
+            except Exception as e:
+                print(f'Webhook 佇列認領失敗: {e}')
+                continue
+            with self._lock:
+                self._in_flight += len(claimed)
+            for row in claimed:
+                lane = self.lanes[zlib.crc32(row[1].encode('utf-8')) % len(self.lanes)]
+                lane.put(row)
+            if claimed and len(claimed) >= room:
+                self._wakeup.set()
+
+    def _run_lane(self, lane):
+        while True:
+            event_id, _, payload, received_at, attempts = lane.get()
+            with app.app_context():
+                try:
+                    mine = WebhookEvent.query.filter_by(id=event_id, status='processing', worker=self.worker_id)
+                    # 開始處理時更新租約；已被放回或由其他 process 認領就略過
+                    if not mine.update({'locked_at': datetime.now()}, synchronize_session=False):
+                        db.session.commit()
+                        continue
+                    db.session.commit()
+                    retryable = True
+                    try:
+                        ok = process_line_event(json.loads(payload), received_at)
+                    except ValueError:
+                        ok = retryable = False
+                    if ok:
+                        mine.delete(synchronize_session=False)
+                    else:
+                        attempts = (attempts or 0) + 1
+                        if retryable and attempts < self.max_attempts:
+                            delay = self.retry_base * 2 ** (attempts - 1)
+                            values = {'status': 'pending', 'worker': None, 'attempts': attempts,
+                                      'next_attempt_at': datetime.now() + timedelta(seconds=delay)}
+                        else:
+                            values = {'status': 'failed', 'worker': None, 'attempts': attempts}
+                            print(f'Webhook 事件 {event_id} 處理失敗 {attempts} 次，標記為 failed')
+                        mine.update(values, synchronize_session=False)
+                    db.session.commit()
+                except Exception as e:
+                    print(f'Webhook 事件 {event_id} 處理失敗: {e}')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+                    with self._lock:
+                        self._in_flight -= 1
+                    self._wakeup.set()
+
+
+webhook_queue = WebhookEventQueue(
+    WEBHOOK_WORKERS,
+    max_attempts=int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', '3'))
+)
+
+
+class WebhookDeduplicator:
+    """
+    以 webhookEventId 丟棄 LINE 重送（deliveryContext.isRedelivery）的事件。
+    process 內 LRU 先擋掉已看過的 id，其餘以 INSERT ... ON CONFLICT DO NOTHING RETURNING
+    寫入 webhook_event_ids，只有真的新增的 id 才處理；與事件入佇列在同一個 transaction，
+    rollback 時不會留下「已處理」的紀錄。
+    """
+
+    def __init__(self, ttl_seconds=86400, max_entries=50000, purge_interval=600):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.purge_interval = purge_interval
+        self._seen = OrderedDict()  # webhook_event_id -> 收到的時間
+        self._lock = threading.Lock()
+        self._last_purge = datetime.min
+
+    def _remember(self, event_ids, now):
+        with self._lock:
+            for event_id in event_ids:
+                self._seen[event_id] = now
+                self._seen.move_to_end(event_id)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+
+    def filter_new(self, events):
+        """在目前 transaction 內登記事件 id，回傳尚未處理過的事件（沒有 webhookEventId 的一律保留）"""
+        now = datetime.now()
+        horizon = now - timedelta(seconds=self.ttl_seconds)
+        candidates = []
+        with self._lock:
+            for event in events:
+                event_id = event.get('webhookEventId')
+                if event_id and event_id not in candidates:
+                    seen_at = self._seen.get(event_id)
+                    if seen_at is None or seen_at < horizon:
+                        candidates.append(event_id)
+        inserted = set()
+        if candidates:
+            rows = ', '.join(f'(:id{n}, :now)' for n in range(len(candidates)))
+            params = {f'id{n}': event_id for n, event_id in enumerate(candidates)}
+            params['now'] = now
+            inserted = set(db.session.execute(db.text(
+                f'INSERT INTO webhook_event_ids (webhook_event_id, received_at) VALUES {rows} '
+                'ON CONFLICT (webhook_event_id) DO NOTHING RETURNING webhook_event_id'
+            ).bindparams(db.bindparam('now', type_=db.DateTime)), params).scalars())
+            after_commit(lambda: self._remember(candidates, now))
+        self._purge_expired(now, horizon)
+
+        fresh = []
+        for event in events:
+            event_id = event.get('webhookEventId')
+            if event_id is None or event_id in inserted:
+                fresh.append(event)
+                inserted.discard(event_id)  # 同一個 payload 內重複的 id 只處理一次
+            else:
+                webhook_duplicates.inc('redelivery' if event.get('deliveryContext', {})
+                                       .get('isRedelivery') else 'duplicate')
+        return fresh
+
+    def _purge_expired(self, now, horizon):
+        if now - self._last_purge < timedelta(seconds=self.purge_interval):
+            return
+        self._last_purge = now
+        ProcessedWebhookEvent.query.filter(ProcessedWebhookEvent.received_at < horizon) \
+            .delete(synchronize_session=False)
+
+
+webhook_dedup = WebhookDeduplicator(int(os.environ.get('WEBHOOK_DEDUP_TTL', '86400')))
+
+
+@app.before_request
+def _start_background_workers():
+    if WEBHOOK_ASYNC:
+        webhook_queue.start()
+    outbox.start()
+    slot_horizon.start()
+    reminders.start()
+    archiver.start()
+    metrics.start()
+
+
+# 
+# 課前提醒
+# 
+
+REMINDER_TIMES = sorted(t.strip() for t in os.environ.get('REMINDER_TIMES', '20:00').split(',')
+                        if t.strip())
+
+
+def build_reminder_messages(d, times, tomorrow=True):
+    weekday = ['一', '二', '三', '四', '五', '六', '日'][d.weekday()]
+    when = f'{"明天" if tomorrow else "於"} {d.strftime("%m/%d")}（{weekday}）{"、".join(times)}'
+    return [{'type': 'text',
+             'text': f'【課程提醒】\n您{when} 有預約課程，請準時出席。\n\n輸入「查詢預約」可查看老師與預約編號'}]
+
+
+def send_lesson_reminders(day=None, batch_size=500):
+    """
+    為 day（預設明天）的 confirmed LINE 預約排入課前提醒，回傳 (提醒人數, multicast 筆數, push 筆數)。
+    先以一次索引區間查詢取出還沒提醒過的預約，再以 INSERT ... ON CONFLICT DO NOTHING RETURNING
+    登記到 booking_reminders，只有登記成功的才發送；登記與 outbox 在同一個 transaction，
+    重跑、重啟或多個 process 同時執行都不會重複提醒。
+    訊息相同的用戶合併成 multicast（每批最多 500 人），其餘以個別 push 送出。
+    """
+    if not LINE_CHANNEL_ACCESS_TOKEN:
+        return 0, 0, 0
+    tomorrow = (datetime.now().date() + timedelta(days=1)).strftime('%Y-%m-%d')
+    day = day or tomorrow
+    start = datetime.strptime(day, '%Y-%m-%d')
+    rows = db.session.query(Booking.id, Booking.line_user_id, Booking.time).filter(
+        Booking.starts_at >= start,
+        Booking.starts_at < start + timedelta(days=1),
+        Booking.status == 'confirmed',
+        Booking.line_user_id.isnot(None),
+        ~db.exists().where(BookingReminder.booking_id == Booking.id)
+    ).all()
+
+    claimed = set()
+    now = datetime.now()
+    for i in range(0, len(rows), batch_size):
+        chunk = [r.id for r in rows[i:i + batch_size]]
+        values = ', '.join(f'(:b{n}, :now)' for n in range(len(chunk)))
+        params = {f'b{n}': booking_id for n, booking_id in enumerate(chunk)}
+        params['now'] = now
+        claimed.update(db.session.execute(db.text(
+            f'INSERT INTO booking_reminders (booking_id, created_at) VALUES {values} '
+            'ON CONFLICT (booking_id) DO NOTHING RETURNING booking_id'
+        ).bindparams(db.bindparam('now', type_=db.DateTime)), params).scalars())
+
+    times_by_user = {}
+    for r in rows:
+        if r.id in claimed:
+            times_by_user.setdefault(r.line_user_id, []).append(r.time)
+    users_by_message = {}
+    for user_id, times in times_by_user.items():
+        key = tuple(sorted(times))
+        users_by_message.setdefault(key, []).append(user_id)
+
+    multicasts = pushes = 0
+    for times, user_ids in users_by_message.items():
+        messages = build_reminder_messages(start, times, tomorrow=day == tomorrow)
+        if len(user_ids) > 1:
+            multicasts += enqueue_line_multicast(sorted(user_ids), messages)
+        elif enqueue_line_push(user_ids[0], messages):
+            pushes += 1
+    db.session.commit()
+    if times_by_user:
+        print(f'{day} 課前提醒：{len(times_by_user)} 位用戶，multicast {multicasts} 筆，push {pushes} 筆')
+    return len(times_by_user), multicasts, pushes
+
+
+class DailyScheduler:
+    """
+    每個 process 一條執行緒，在 times（HH:MM）的每個時間點執行 job。
+    啟動時若今天已過某個時間點就先補跑一次，所以 job 必須可以重複執行（例如課前提醒
+    已排入的不會重複、封存以 data_versions 認領當天的執行權）。
+    """
+
+    def __init__(self, times, job, label):
+        self.times = times
+        self.job = job
+        self.label = label
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if not self.times or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _next_run(self, now):
+        for day in (now.date(), now.date() + timedelta(days=1)):
+            for t in self.times:
+                at = datetime.combine(day, datetime.strptime(t, '%H:%M').time())
+                if at > now:
+                    return at
+
+    def _run_once(self):
+        with app.app_context():
+            try:
+                self.job()
+            except Exception as e:
+                print(f'{self.label}失敗: {e}')
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+    def _run(self):
+        if datetime.now().strftime('%H:%M') >= self.times[0]:
+            self._run_once()
+        while True:
+            time.sleep(max(0.0, (self._next_run(datetime.now()) - datetime.now()).total_seconds()))
+            self._run_once()
+
+
+reminders = DailyScheduler(REMINDER_TIMES, send_lesson_reminders, '課前提醒')
+archiver = DailyScheduler(ARCHIVE_TIMES if ARCHIVE_AFTER_DAYS > 0 else [], run_archive_job, '預約封存')
+
+
 # 
 # LINE Webhook
 # 
@@ -970,16 +3053,14 @@ def _info_row(label, value):
 @app.route('/webhook/line', methods=['POST'])
 def line_webhook():
     signature = request.headers.get('X-Line-Signature', '')
-    body = request.get_data(as_text=True)
+    body = request.get_data()
 
     if LINE_CHANNEL_SECRET:
-        hash_value = hmac.new(
-            LINE_CHANNEL_SECRET.encode('utf-8'),
-            body.encode('utf-8'),
-            hashlib.sha256
-        ).digest()
-        expected_signature = base64.b64encode(hash_value).decode('utf-8')
-        if signature != expected_signature:
+        # 直接對原始 bytes 計算簽章，並以固定時間比較
+        expected_signature = base64.b64encode(hmac.new(
+            LINE_CHANNEL_SECRET.encode('utf-8'), body, hashlib.sha256
+        ).digest())
+        if not hmac.compare_digest(expected_signature, signature.encode('utf-8')):
             print('LINE ')
             return 'Invalid signature', 403
 
@@ -993,58 +3074,123 @@ def line_webhook():
     if not events:
         return 'OK', 200
 
-    for event in events:
-        try:
-            reply_token = event.get('replyToken')
-            user_id = event.get('source', {}).get('userId')
-            if not user_id:
-                continue
+    # LINE 在回應太慢時會重送同一個 webhookEventId，已收過的直接略過
+    events = webhook_dedup.filter_new(events)
 
-            event_type = event.get('type')
+    if not WEBHOOK_ASYNC:
+        db.session.commit()
+        for event in events:
+            process_line_event(event)
+        return 'OK', 200
 
-            #   
-            if event_type == 'message' and event.get('message', {}).get('type') == 'text':
-                text = event['message']['text'].strip()
-                handle_text_event(reply_token, user_id, text)
+    # 先寫入佇列即回 200，由背景 worker 依 userId 順序處理
+    queued = [
+        WebhookEvent(
+            line_user_id=event['source']['userId'],
+            payload=json.dumps(event, ensure_ascii=False)
+        )
+        for event in events if event.get('source', {}).get('userId')
+    ]
+    db.session.add_all(queued)
+    db.session.commit()  # 事件 id 與佇列一起寫入
+    if queued:
+        webhook_queue.notify()
+    return 'OK', 200
 
-            #  Postback
-            elif event_type == 'postback':
-                data = event.get('postback', {}).get('data', '')
-                handle_postback_event(reply_token, user_id, data)
 
-            #   
-            elif event_type == 'follow':
-                flex = build_welcome_flex()
-                reply_flex_message(reply_token, 'K書中心服務選單', flex)
+def process_line_event(event, received_at=None):
+    """處理單一 LINE 事件；reply token 逾時時 reply_* 會自動改用 push。失敗回傳 False"""
+    start = time.perf_counter()
+    outer_sql = _sql_scope_begin()
+    result = 'error'
+    try:
+        reply_token = event.get('replyToken')
+        user_id = event.get('source', {}).get('userId')
+        if not user_id:
+            result = 'ignored'
+            return True
+
+        if event.get('timestamp'):
+            sent_at = datetime.fromtimestamp(event['timestamp'] / 1000)
+        else:
+            sent_at = received_at or datetime.now()
+        event_type = event.get('type')
+        _line_event_ctx.event = {
+            'reply_token': reply_token,
+            'user_id': user_id,
+            'reply_deadline': sent_at + timedelta(seconds=LINE_REPLY_TOKEN_TTL),
+            'action': event_type if event_type in ('message', 'postback', 'follow', 'unfollow') else 'other'
+        }
 
-        except Exception as e:
-            print(f' event : {e}')
-            import traceback; traceback.print_exc()
+        #   
+        if event_type == 'message' and event.get('message', {}).get('type') == 'text':
+            text = event['message']['text'].strip()
+            handle_text_event(reply_token, user_id, text)
 
-    return 'OK', 200
+        #  Postback
+        elif event_type == 'postback':
+            data = event.get('postback', {}).get('data', '')
+            handle_postback_event(reply_token, user_id, data)
 
+        #   
+        elif event_type == 'follow':
+            reply_cached_flex(reply_token, ('welcome',),
+                              lambda: ('K書中心服務選單', build_welcome_flex()))
+        result = 'ok'
+        return True
 
-def handle_text_event(reply_token, user_id, text):
-    """"""
+    except Exception as e:
+        print(f' event : {e}')
+        traceback.print_exc()
+        db.session.rollback()
+        return False
+    finally:
+        action = (_line_event_ctx.event or {}).get('action', 'other')
+        _line_event_ctx.event = None
+        queries, _ = _sql_scope_end(outer_sql)
+        line_event_duration.observe(time.perf_counter() - start, action, result)
+        line_event_sql_queries.observe(queries, action)
 
-    # 
-    if '' in text or '' in text:
-        teachers = Teacher.query.filter_by(is_active=True).all()
-        flex = build_teacher_carousel(teachers)
-        reply_flex_message(reply_token, f'老師名單，共 {len(teachers)} 位', flex)
+
+def _label_line_event(action):
+    """指標用：標記目前事件的動作（postback action 或文字意圖）"""
+    event = getattr(_line_event_ctx, 'event', None)
+    if event is not None:
+        event['action'] = action
+
+
+def handle_text_event(reply_token, user_id, text):
+    """文字訊息：解析意圖後回覆"""
+    intent = text_intent.parse(text, teacher_index(), datetime.now().date())
+    _label_line_event(f'text_{intent.kind or "other"}')
+
+    # 老師名單
+    if intent.kind == 'teachers':
+        def build():
+            teachers = Teacher.query.filter_by(is_active=True).all()
+            return f'老師名單，共 {len(teachers)} 位', build_teacher_carousel(teachers)
+        reply_cached_flex(reply_token, ('teacher_carousel', read_version('teachers')), build)
         return
 
-    # 
-    if '' in text or '' in text:
-        bookings = Booking.query.filter_by(
-            line_user_id=user_id, status='confirmed'
-        ).order_by(Booking.date, Booking.time).all()
+    # 查詢預約
+    if intent.kind == 'query':
+        bookings = upcoming_bookings(Booking.query.filter_by(line_user_id=user_id, status='confirmed'))
         flex = build_my_bookings_flex(bookings)
-        reply_flex_message(reply_token, f'我的預約，共 {len(bookings)} 筆', flex)
+        reply_flex_message(reply_token, f'我的預約，近期 {len(bookings)} 筆', flex)
         return
 
-    #   
-    if text.startswith(''):
+    # 取消預約
+    if intent.kind == 'cancel':
+        reply_cancel_request(reply_token, user_id, intent)
+        return
+
+    # 文字預約，例如「預約 陳老師 2/20 15:00」
+    if intent.kind == 'book':
+        reply_booking_request(reply_token, intent)
+        return
+
+    # 註冊 姓名 手機號碼
+    if intent.kind == 'register':
         parts = text.split()
         if len(parts) >= 3:
             name = parts[1]
@@ -1058,91 +3204,142 @@ def handle_text_event(reply_token, user_id, text):
                 customer = Customer(name=name, phone=phone, line_user_id=user_id)
                 db.session.add(customer)
                 db.session.commit()
-            # 查詢是否有待完成的預約
-            pending = AIConversation.query.filter_by(
-                line_user_id=user_id, intent='pending_booking'
-            ).order_by(AIConversation.id.desc()).first()
-
+            # 取出註冊前暫存的預約，自動完成
+            pending = conversation_states.take(user_id, 'pending_booking')
             if pending:
-                try:
-                    _, t_id, p_date, p_time = pending.user_message.split(':')
-                    teacher = Teacher.query.get(int(t_id))
-                    if teacher and check_availability(int(t_id), p_date, p_time):
-                        duration = 60
-                        total_price = int((duration / 60) * teacher.hourly_rate)
-                        booking = Booking(
-                            booking_number=generate_booking_number(),
-                            teacher_id=teacher.id,
-                            customer_name=customer.name,
-                            customer_phone=customer.phone,
-                            line_user_id=user_id,
-                            date=p_date,
-                            time=p_time,
-                            duration=duration,
-                            total_price=total_price,
-                            source='line'
+                p_date, p_time = pending['date'], pending['time']
+                teacher = entity_cache.teacher(pending['teacher_id'])
+                booking = None
+                if teacher and check_availability(teacher.id, p_date, p_time):
+                    try:
+                        booking = create_booking_record(
+                            teacher, p_date, p_time, customer.name, customer.phone,
+                            source='line', line_user_id=user_id
                         )
-                        db.session.add(booking)
-                        customer.total_bookings += 1
-                        customer.total_hours += duration
-                        customer.total_spent += total_price
-                        # 清除 pending
-                        pending.intent = 'pending_booking_done'
-                        db.session.commit()
-                        flex = build_booking_success_flex(booking)
-                        reply_flex_message(reply_token, f'預約成功 {booking.booking_number}', flex)
-                        return
-                    else:
-                        reply_text_message(reply_token, f'註冊成功！{name}\n\n很抱歉，您選擇的時段 {p_date} {p_time} 剛剛已被預約，請重新選擇時段。')
-                        pending.intent = 'pending_booking_done'
-                        db.session.commit()
-                        return
-                except Exception as e:
-                    print(f'自動完成預約失敗: {e}')
+                    except SlotTaken:
+                        # rollback 會把取出的暫存一併還原，這裡明確清除
+                        conversation_states.clear(user_id)
+                        booking = None
+                if booking:
+                    db.session.commit()
+                    flex = build_booking_success_flex(booking)
+                    reply_flex_message(reply_token, f'預約成功 {booking.booking_number}', flex)
+                    return
+                db.session.commit()
+                reply_text_message(reply_token, f'註冊成功！{name}\n\n很抱歉，您選擇的時段 {p_date} {p_time} 剛剛已被預約，請重新選擇時段。')
+                return
 
             reply_text_message(reply_token, f'註冊成功！歡迎 {name}\n\n請傳送「老師名單」開始預約課程')
         else:
-            reply_text_message(reply_token, '格式錯誤\n請輸入：註冊 姓名 手機號碼\n範例：註冊 張小明 0912345678')
+            message = '格式錯誤\n請輸入：註冊 姓名 手機號碼\n範例：註冊 張小明 0912345678'
+            pending = conversation_states.get(user_id, 'pending_booking')
+            if pending:
+                message += f'\n\n註冊完成後將自動預約 {pending["date"]} {pending["time"]}'
+            reply_text_message(reply_token, message)
         return
 
     # 
-    flex = build_welcome_flex()
-    reply_flex_message(reply_token, 'K書中心服務選單', flex)
+    reply_cached_flex(reply_token, ('welcome',),
+                      lambda: ('K書中心服務選單', build_welcome_flex()))
+
+
+def reply_date_picker(reply_token, teacher):
+    days, unavailable = date_picker_days(teacher.id)
+    reply_cached_flex(
+        reply_token, ('date_picker', teacher.id, teacher.name, days[0], frozenset(unavailable.items())),
+        lambda: (f'預約 {teacher.name} 老師 - 選擇日期',
+                 build_date_picker_flex(teacher.id, teacher.name, days, unavailable))
+    )
+
+
+def reply_time_picker(reply_token, teacher, date):
+    free = availability.free_mask(teacher.id, date)
+    reply_cached_flex(
+        reply_token, ('time_picker', teacher.id, teacher.name, date, free),
+        lambda: (f'{date} 可預約時段', build_time_picker_flex(
+            teacher.id, teacher.name, date, mask_times(free)))
+    )
+
+
+def reply_booking_request(reply_token, intent):
+    """文字預約：依缺少的資訊接續日期 / 時段選擇，資訊齊全時顯示確認畫面"""
+    if not intent.teacher_ids:
+        reply_text_message(reply_token, '請告訴我要預約哪位老師\n範例：預約 陳老師 2/20 15:00\n\n傳送「老師名單」查看所有老師')
+        return
+    if len(intent.teacher_ids) > 1:
+        names = [t.name for t in Teacher.query.filter(Teacher.id.in_(intent.teacher_ids))]
+        reply_text_message(reply_token, f'有多位老師符合：{"、".join(names)}\n請輸入老師全名')
+        return
+    teacher = entity_cache.teacher(intent.teacher_ids[0])
+    if not teacher:
+        reply_text_message(reply_token, '找不到這位老師，請傳送「老師名單」查看')
+        return
+    if not intent.date or intent.date < datetime.now().strftime('%Y-%m-%d'):
+        reply_date_picker(reply_token, teacher)
+        return
+    if intent.time not in SLOT_BITS or not check_availability(teacher.id, intent.date, intent.time):
+        reply_time_picker(reply_token, teacher, intent.date)
+        return
+    flex = build_confirm_flex(teacher.name, intent.date, intent.time, teacher.hourly_rate, teacher.id)
+    reply_flex_message(reply_token, '確認預約資訊', flex)
+
+
+def reply_cancel_request(reply_token, user_id, intent):
+    """文字取消：指定預約編號時直接取消，否則列出符合的預約供點選取消"""
+    query = Booking.query.filter_by(line_user_id=user_id, status='confirmed')
+    if intent.booking_number:
+        booking = query.filter_by(booking_number=intent.booking_number).first()
+        if not booking or not cancel_booking_record(booking):
+            reply_text_message(reply_token, f'找不到預約 {intent.booking_number}')
+            return
+        db.session.commit()
+        reply_text_message(reply_token, f'已取消預約 {booking.booking_number}\n{booking.date} {booking.time}')
+        return
+    if len(intent.teacher_ids) == 1:
+        query = query.filter_by(teacher_id=intent.teacher_ids[0])
+    if intent.date:
+        query = query.filter_by(date=intent.date)
+    if intent.time:
+        query = query.filter_by(time=intent.time)
+    bookings = upcoming_bookings(query)
+    flex = build_my_bookings_flex(bookings)
+    reply_flex_message(reply_token, f'請選擇要取消的預約，共 {len(bookings)} 筆', flex)
+
+
+POSTBACK_ACTIONS = ('select_teacher', 'select_date', 'select_time', 'confirm_booking', 'cancel_booking')
 
 
 def handle_postback_event(reply_token, user_id, data):
     """ Postback"""
     params = dict(p.split('=', 1) for p in data.split('&') if '=' in p)
     action = params.get('action', '')
+    _label_line_event(action if action in POSTBACK_ACTIONS else 'unknown')
 
     # 1. 選擇老師 -> 顯示日期選擇
     if action == 'select_teacher':
         teacher_id = int(params.get('teacher_id', 0))
-        teacher = Teacher.query.get(teacher_id)
+        teacher = entity_cache.teacher(teacher_id)
         if not teacher:
             reply_text_message(reply_token, '')
             return
-        flex = build_date_picker_flex(teacher.id, teacher.name)
-        reply_flex_message(reply_token, f'預約 {teacher.name} 老師 - 選擇日期', flex)
+        reply_date_picker(reply_token, teacher)
 
     # 2. 選擇日期 -> 顯示時段
     elif action == 'select_date':
         teacher_id = int(params.get('teacher_id', 0))
         date = params.get('date', '')
-        teacher = Teacher.query.get(teacher_id)
+        teacher = entity_cache.teacher(teacher_id)
         if not teacher or not date:
             reply_text_message(reply_token, '')
             return
-        available = get_available_times(teacher_id, date)
-        flex = build_time_picker_flex(teacher_id, teacher.name, date, available)
-        reply_flex_message(reply_token, f'{date} 可預約時段', flex)
+        reply_time_picker(reply_token, teacher, date)
 
     # 3. 選擇時段 -> 顯示確認畫面
     elif action == 'select_time':
         teacher_id = int(params.get('teacher_id', 0))
         date = params.get('date', '')
         time = params.get('time', '')
-        teacher = Teacher.query.get(teacher_id)
+        teacher = entity_cache.teacher(teacher_id)
         if not teacher:
             reply_text_message(reply_token, '')
             return
@@ -1155,50 +3352,40 @@ def handle_postback_event(reply_token, user_id, data):
         teacher_id = int(params.get('teacher_id', 0))
         date = params.get('date', '')
         time = params.get('time', '')
-        teacher = Teacher.query.get(teacher_id)
+        teacher = entity_cache.teacher(teacher_id)
 
         if not teacher:
             reply_text_message(reply_token, '')
             return
 
         if not check_availability(teacher_id, date, time):
-            reply_text_message(reply_token, f' {date} {time} ')
+            reply_text_message(reply_token, f'很抱歉，{date} {time} 已被預約，請選擇其他時段')
             return
 
-        customer = Customer.query.filter_by(line_user_id=user_id).first()
+        customer = entity_cache.customer_by_line_id(user_id)
         if not customer:
-            # 暫存預約資訊到 AIConversation，等用戶註冊完後自動完成
-            pending = AIConversation(
+            # 暫存預約資訊，等用戶註冊完後自動完成
+            conversation_states.set(user_id, 'pending_booking',
+                                    {'teacher_id': teacher_id, 'date': date, 'time': time})
+            db.session.add(AIConversation(
                 line_user_id=user_id,
-                user_message=f'pending_booking:{teacher_id}:{date}:{time}',
+                user_message=f'Postback confirm: teacher={teacher_id} date={date} time={time}',
                 ai_response='等待註冊',
                 intent='pending_booking'
-            )
-            db.session.add(pending)
+            ))
             db.session.commit()
             flex = build_register_flex(teacher_id, date, time)
             reply_flex_message(reply_token, '首次預約請先完成註冊', flex)
             return
 
-        duration = 60
-        total_price = int((duration / 60) * teacher.hourly_rate)
-
-        booking = Booking(
-            booking_number=generate_booking_number(),
-            teacher_id=teacher.id,
-            customer_name=customer.name,
-            customer_phone=customer.phone,
-            line_user_id=user_id,
-            date=date,
-            time=time,
-            duration=duration,
-            total_price=total_price,
-            source='line'
-        )
-        db.session.add(booking)
-        customer.total_bookings += 1
-        customer.total_hours += duration
-        customer.total_spent += total_price
+        try:
+            booking = create_booking_record(
+                teacher, date, time, customer.name, customer.phone,
+                source='line', line_user_id=user_id
+            )
+        except SlotTaken:
+            reply_text_message(reply_token, f'很抱歉，{date} {time} 已被預約，請選擇其他時段')
+            return
         db.session.commit()
 
         conv = AIConversation(
@@ -1225,7 +3412,7 @@ def handle_postback_event(reply_token, user_id, data):
         if not booking or booking.line_user_id != user_id:
             reply_text_message(reply_token, '')
             return
-        booking.status = 'cancelled'
+        cancel_booking_record(booking)
         db.session.commit()
         reply_text_message(
             reply_token,
@@ -1236,19 +3423,94 @@ def handle_postback_event(reply_token, user_id, data):
         reply_text_message(reply_token, '')
 
 
+# 
+# 條件式 GET 與預先壓縮的靜態頁面
+# 
+
+def conditional_response(etag, build, cache_control='no-cache'):
+    """
+    If-None-Match 與 etag 相符時直接回 304（不呼叫 build，不查詢也不序列化），
+    否則回傳 build() 的 Response；兩者都帶 ETag 與 Cache-Control
+    """
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = build()
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = cache_control
+    return resp
+
+
+class StaticPages:
+    """
+    static/ 的 HTML 讀入記憶體並預先壓縮成 gzip（有安裝 brotli 時另有 br），依 Accept-Encoding
+    回傳對應版本。ETag 取自內容的 hash（不同壓縮版本加上編碼後綴），檔案修改後自動重新載入。
+    """
+
+    ENCODINGS = ('br', 'gzip')
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._files = {}  # filename -> (mtime_ns, digest, {encoding: bytes})
+        self._lock = threading.Lock()
+
+    def _load(self, filename):
+        path = os.path.join(self.directory, filename)
+        mtime = os.stat(path).st_mtime_ns
+        entry = self._files.get(filename)
+        if entry and entry[0] == mtime:
+            return entry
+        with open(path, 'rb') as f:
+            raw = f.read()
+        variants = {'identity': raw, 'gzip': gzip.compress(raw, 9, mtime=0)}
+        if brotli is not None:
+            variants['br'] = brotli.compress(raw, quality=11)
+        entry = (mtime, hashlib.sha256(raw).hexdigest()[:20], variants)
+        with self._lock:
+            self._files[filename] = entry
+        return entry
+
+    def warm(self):
+        """啟動時預先壓縮所有 HTML"""
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.html'):
+                self._load(filename)
+
+    def send(self, filename, mimetype='text/html'):
+        _, digest, variants = self._load(filename)
+        encoding = next((e for e in self.ENCODINGS
+                         if e in variants and request.accept_encodings[e]), 'identity')
+        etag = digest if encoding == 'identity' else f'{digest}-{encoding}'
+        body = variants[encoding]
+
+        def build():
+            resp = Response(body, mimetype=mimetype)
+            if encoding != 'identity':
+                resp.headers['Content-Encoding'] = encoding
+            return resp
+        resp = conditional_response(etag, build)
+        resp.vary.add('Accept-Encoding')
+        return resp
+
+
+static_pages = StaticPages(os.path.join(app.root_path, 'static'))
+
+
 # 
 #  APIWeb 
 # 
 
 @app.route('/')
 def index():
-    return send_from_directory('static', 'index.html')
+    return static_pages.send('index.html')
 
 
 @app.route('/api/teachers')
 def get_teachers():
-    teachers = Teacher.query.filter_by(is_active=True).all()
-    return jsonify([t.to_dict() for t in teachers])
+    def build():
+        teachers = Teacher.query.filter_by(is_active=True).all()
+        return jsonify([t.to_dict() for t in teachers])
+    return conditional_response(f'teachers-{read_version("teachers")}', build)
 
 
 @app.route('/api/teachers/<int:teacher_id>/availability')
@@ -1256,58 +3518,82 @@ def check_teacher_availability(teacher_id):
     date = request.args.get('date')
     if not date:
         return jsonify({'error': 'Missing date'}), 400
-    booked = Booking.query.filter(
-        Booking.teacher_id == teacher_id,
-        Booking.date == date,
-        Booking.status == 'confirmed'
-    ).all()
-    booked_times = [b.time for b in booked]
-    all_times = [f'{h:02d}:00' for h in range(9, 21)]
-    available_times = [t for t in all_times if t not in booked_times]
-    return jsonify({'available_times': available_times, 'booked_times': booked_times})
+    version = read_version(availability.version_key(teacher_id, date))
+
+    def build():
+        open_mask, booked_mask = availability.masks(teacher_id, date, version)
+        return jsonify({'available_times': mask_times(open_mask & ~booked_mask),
+                        'booked_times': mask_times(booked_mask)})
+    return conditional_response(f'avail-{teacher_id}-{date}-{version}', build)
+
+
+@app.route('/api/availability')
+def batch_availability():
+    """多位老師 × 日期區間的剩餘時段（teacher_id 省略時為所有開放預約的老師）"""
+    start = request.args.get('start')
+    end = request.args.get('end') or start
+    try:
+        start_d = datetime.strptime(start or '', '%Y-%m-%d').date()
+        end_d = datetime.strptime(end, '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'start / end 格式須為 YYYY-MM-DD'}), 400
+    if end_d < start_d or (end_d - start_d).days > 62:
+        return jsonify({'error': '日期區間需在 62 天以內'}), 400
+
+    teacher_ids = request.args.getlist('teacher_id', type=int)
+    if not teacher_ids:
+        teacher_ids = [t_id for (t_id,) in db.session.query(Teacher.id).filter_by(is_active=True)]
+    dates = [(start_d + timedelta(days=i)).strftime('%Y-%m-%d')
+             for i in range((end_d - start_d).days + 1)]
+    versions = availability.versions([(t_id, d) for t_id in teacher_ids for d in dates])
+    etag = 'avail-' + hashlib.sha1(repr(list(versions.items())).encode()).hexdigest()[:20]
+
+    def build():
+        masks = availability.bulk_masks(teacher_ids, dates, versions)
+        result = []
+        for (t_id, d), (open_mask, booked_mask) in masks.items():
+            free_times = mask_times(open_mask & ~booked_mask)
+            result.append({
+                'teacher_id': t_id,
+                'date': d,
+                'free_count': len(free_times),
+                'free_times': free_times,
+                'booked_times': mask_times(booked_mask)
+            })
+        return jsonify({'start': start_d.strftime('%Y-%m-%d'), 'end': end_d.strftime('%Y-%m-%d'),
+                        'slots': SLOT_TIMES, 'availability': result})
+    return conditional_response(etag, build)
 
 
 @app.route('/api/book', methods=['POST'])
 def create_booking():
     data = request.get_json()
-    teacher = Teacher.query.get(data['teacher_id'])
+    teacher = entity_cache.teacher(data['teacher_id'])
     if not teacher:
         return jsonify({'error': 'Teacher not found'}), 404
     if not check_availability(teacher.id, data['date'], data['time']):
         return jsonify({'error': '此時段已被預約，請選擇其他時間'}), 400
     duration = data.get('duration', 60)
-    total_price = int((duration / 60) * teacher.hourly_rate)
-    booking = Booking(
-        booking_number=generate_booking_number(),
-        teacher_id=teacher.id,
-        customer_name=data['name'],
-        customer_phone=data['phone'],
-        date=data['date'],
-        time=data['time'],
-        duration=duration,
-        total_price=total_price,
-        source='web',
-        note=data.get('note', '')
-    )
-    db.session.add(booking)
-    db.session.commit()
     email = data.get('email', '').strip()
+    # 讀取放在第一個寫入之前，縮短 SQLite 寫入鎖的持有時間
     customer = Customer.query.filter_by(phone=data['phone']).first()
     if not customer:
-        customer = Customer(name=data['name'], phone=data['phone'], email=email)
+        # 先建立客戶，預約時的累計 UPDATE 才有對象；時段衝突時會一起 rollback
+        customer = Customer(name=data['name'], phone=data['phone'], email=email,
+                            total_bookings=0, total_hours=0, total_spent=0)
         db.session.add(customer)
-        db.session.flush()  # 確保 customer 有 id，避免 NoneType 錯誤
-    else:
-        if email and not customer.email:
-            customer.email = email
-    customer.total_bookings += 1
-    customer.total_hours += duration
-    customer.total_spent += total_price
-    db.session.commit()
-
-    # 重新查詢 booking 以載入 teacher 關聯
-    booking = Booking.query.get(booking.id)
+    elif email and not customer.email:
+        customer.email = email
+    try:
+        booking = create_booking_record(
+            teacher, data['date'], data['time'], data['name'], data['phone'],
+            duration=duration, source='web', note=data.get('note', '')
+        )
+    except SlotTaken:
+        return jsonify({'error': '此時段已被預約，請選擇其他時間'}), 400
+    # 確認信寫入 outbox，與預約一起 commit，由背景寄出
     send_booking_email(email, data['name'], booking)
+    db.session.commit()
 
     return jsonify({'success': True, 'booking': booking.to_dict()}), 201
 
@@ -1318,7 +3604,7 @@ def create_booking():
 
 @app.route('/admin')
 def admin_login():
-    return send_from_directory('static', 'admin_login.html')
+    return static_pages.send('admin_login.html')
 
 
 @app.route('/admin/api/login', methods=['POST'])
@@ -1332,20 +3618,110 @@ def admin_login_api():
 
 @app.route('/dashboard')
 def dashboard():
-    return send_from_directory('static', 'admin_dashboard.html')
+    return static_pages.send('admin_dashboard.html')
+
+
+ADMIN_PAGE_SIZE = 50
+ADMIN_MAX_PAGE_SIZE = 200
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def _cursor_int(value):
+    if isinstance(value, bool) or not isinstance(value, int) or not -2 ** 63 <= value < 2 ** 63:
+        raise ValueError(value)
+    return value
+
+
+def _decode_cursor(cursor, types):
+    """解析 cursor，並依 types（每個欄位的轉換函式）檢查欄位數與型別"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError(values)
+        return [convert(value) for convert, value in zip(types, values)]
+    except (ValueError, TypeError):
+        raise InvalidQuery('cursor 無效')
+
+
+def _page_args(model, cursor_types):
+    """共用的 limit / cursor / fields 參數"""
+    limit = request.args.get('limit', ADMIN_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), ADMIN_MAX_PAGE_SIZE)
+    cursor = request.args.get('cursor')
+    fields = {f for f in request.args.get('fields', '').split(',') if f} or None
+    if fields and not fields <= set(model.FIELD_COLUMNS):
+        raise InvalidQuery(f'未知欄位：{", ".join(sorted(fields - set(model.FIELD_COLUMNS)))}')
+    return limit, (_decode_cursor(cursor, cursor_types) if cursor else None), fields
+
+
+def _project(query, model, fields, *always):
+    """只載入 fields 需要的欄位"""
+    if fields is None:
+        return query
+    names = {c for f in fields for c in model.FIELD_COLUMNS[f]} | set(always)
+    return query.options(load_only(*[getattr(model, n) for n in sorted(names)]))
+
+
+def filter_bookings(query, args, model=Booking):
+    """
+    後台預約列表與匯出共用的篩選：date / date_from / date_to / teacher_id / source / status。
+    model 為 Booking 或 BookingArchive
+    """
+    if args.get('date'):
+        query = query.filter(model.date == args['date'])
+    if args.get('date_from'):
+        query = query.filter(model.date >= args['date_from'])
+    if args.get('date_to'):
+        query = query.filter(model.date <= args['date_to'])
+    if args.get('teacher_id'):
+        try:
+            query = query.filter(model.teacher_id == int(args['teacher_id']))
+        except ValueError:
+            raise InvalidQuery('teacher_id 必須是數字')
+    if args.get('source'):
+        query = query.filter(model.source == args['source'])
+    if args.get('status'):
+        query = query.filter(model.status == args['status'])
+    return query
+
+
+@app.errorhandler(InvalidQuery)
+def _handle_bad_request(e):
+    return jsonify({'error': str(e)}), 400
 
 
 @app.route('/admin/api/bookings', methods=['GET'])
 def admin_get_bookings():
+    """
+    預約列表：依 created_at, id 倒序的 keyset 分頁，回傳 next_cursor 供下一頁使用。
+    bookings 與 bookings_archive 各以相同的游標取一頁後合併
+    """
     err = check_admin()
     if err: return err
-    date = request.args.get('date')
-    status = request.args.get('status')
-    query = Booking.query
-    if date: query = query.filter_by(date=date)
-    if status: query = query.filter_by(status=status)
-    bookings = query.order_by(Booking.created_at.desc()).all()
-    return jsonify([b.to_dict() for b in bookings])
+    limit, cursor, fields = _page_args(Booking, (datetime.fromisoformat, _cursor_int))
+    rows = []
+    for model in (Booking, BookingArchive):
+        query = filter_bookings(model.query, request.args, model)
+        if cursor:
+            created_at, last_id = cursor
+            query = query.filter(db.tuple_(model.created_at, model.id) < (created_at, last_id))
+        query = _project(query, model, fields, 'id', 'created_at')
+        if fields is None or 'teacher_name' in fields:
+            query = query.options(selectinload(model.teacher))
+        rows += query.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1).all()
+    rows.sort(key=lambda b: (b.created_at, b.id), reverse=True)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor([rows[-1].created_at.isoformat(), rows[-1].id])
+    return jsonify({'items': [b.to_dict(fields) for b in rows], 'next_cursor': next_cursor})
 
 
 @app.route('/admin/api/bookings/<int:bid>/cancel', methods=['POST'])
@@ -1353,19 +3729,19 @@ def admin_cancel_booking(bid):
     err = check_admin()
     if err: return err
     booking = Booking.query.get_or_404(bid)
-    booking.status = 'cancelled'
-    db.session.commit()
-    # 寄取消通知給 LINE 用戶
+    if not cancel_booking_record(booking):
+        return jsonify({'success': True})
+    # 取消通知（LINE / Email）寫入 outbox，與取消一起 commit
     if booking.line_user_id:
         teacher_name = booking.teacher.name if booking.teacher else ''
-        send_text_message(
-            booking.line_user_id,
-            f'您的預約已取消\n\n預約編號：{booking.booking_number}\n老師：{teacher_name} 老師\n時間：{booking.date} {booking.time}\n\n如需重新預約請傳送「老師名單」'
-        )
-    # 寄取消通知 Email
+        enqueue_line_push(booking.line_user_id, [{
+            'type': 'text',
+            'text': f'您的預約已取消\n\n預約編號：{booking.booking_number}\n老師：{teacher_name} 老師\n時間：{booking.date} {booking.time}\n\n如需重新預約請傳送「老師名單」'
+        }])
     customer = Customer.query.filter_by(phone=booking.customer_phone).first()
     if customer and customer.email:
         send_cancel_email(customer.email, booking.customer_name, booking)
+    db.session.commit()
     return jsonify({'success': True})
 
 
@@ -1387,21 +3763,224 @@ def admin_add_teacher():
         hourly_rate=data.get('hourly_rate', 1000), is_active=True
     )
     db.session.add(teacher)
+    db.session.flush()
+    db.session.add_all(default_schedule(teacher.id))
+    after_commit(lambda: flex_cache.invalidate('teacher_carousel'))
     db.session.commit()
+    materialize_slots([teacher.id])
     return jsonify(teacher.to_dict()), 201
 
 
+_TIME_RE = re.compile(r'^([01]\d|2[0-4]):00$')
+
+
+@app.route('/admin/api/teachers/<int:teacher_id>/schedule', methods=['GET'])
+def admin_get_schedule(teacher_id):
+    """每週排班與今天以後的例外（含全體老師的假日）"""
+    err = check_admin()
+    if err: return err
+    today = datetime.now().strftime('%Y-%m-%d')
+    schedule = TeacherSchedule.query.filter_by(teacher_id=teacher_id) \
+        .order_by(TeacherSchedule.weekday, TeacherSchedule.start_time).all()
+    exceptions = ScheduleException.query.filter(
+        ScheduleException.date >= today,
+        db.or_(ScheduleException.teacher_id.is_(None), ScheduleException.teacher_id == teacher_id)
+    ).order_by(ScheduleException.date).all()
+    return jsonify({'schedule': [s.to_dict() for s in schedule],
+                    'exceptions': [e.to_dict() for e in exceptions]})
+
+
+@app.route('/admin/api/teachers/<int:teacher_id>/schedule', methods=['PUT'])
+def admin_set_schedule(teacher_id):
+    """
+    以 {"schedule": [{"weekday": 0, "start_time": "09:00", "end_time": "12:00"}, ...]}
+    取代整份每週排班，並重新產生未來時段（已預約的時段保留）
+    """
+    err = check_admin()
+    if err: return err
+    if not Teacher.query.get(teacher_id):
+        return jsonify({'error': 'Teacher not found'}), 404
+    rows = []
+    for item in (request.get_json() or {}).get('schedule', []):
+        weekday, start, end = item.get('weekday'), item.get('start_time', ''), item.get('end_time', '')
+        if weekday not in range(7) or not _TIME_RE.match(start) or not _TIME_RE.match(end) \
+                or start >= end:
+            return jsonify({'error': 'weekday 須為 0-6，start_time / end_time 須為整點且開始早於結束'}), 400
+        rows.append(TeacherSchedule(teacher_id=teacher_id, weekday=weekday,
+                                    start_time=start, end_time=end))
+    TeacherSchedule.query.filter_by(teacher_id=teacher_id).delete()
+    db.session.add_all(rows)
+    db.session.commit()
+    inserted, deleted = materialize_slots([teacher_id])
+    return jsonify({'schedule': [r.to_dict() for r in rows],
+                    'slots_added': inserted, 'slots_removed': deleted})
+
+
+@app.route('/admin/api/schedule-exceptions', methods=['POST'])
+def admin_add_schedule_exception():
+    """新增假日 / 請假；teacher_id 省略為所有老師，start_time / end_time 省略為整天"""
+    err = check_admin()
+    if err: return err
+    data = request.get_json() or {}
+    start, end = data.get('start_time'), data.get('end_time')
+    teacher_id = data.get('teacher_id')
+    if teacher_id is not None and (isinstance(teacher_id, bool) or not isinstance(teacher_id, int)
+                                   or not Teacher.query.get(teacher_id)):
+        return jsonify({'error': 'teacher_id 不存在'}), 400
+    try:
+        datetime.strptime(data.get('date', ''), '%Y-%m-%d')
+    except (ValueError, TypeError):
+        return jsonify({'error': 'date 格式須為 YYYY-MM-DD'}), 400
+    if (start or end) and not (start and end and _TIME_RE.match(start) and _TIME_RE.match(end)
+                               and start < end):
+        return jsonify({'error': 'start_time / end_time 須同時提供且為整點'}), 400
+    exception = ScheduleException(teacher_id=teacher_id, date=data['date'],
+                                  start_time=start, end_time=end, reason=data.get('reason', ''))
+    db.session.add(exception)
+    db.session.commit()
+    teacher_ids = [exception.teacher_id] if exception.teacher_id else None
+    inserted, deleted = materialize_slots(teacher_ids)
+    return jsonify(dict(exception.to_dict(), slots_added=inserted, slots_removed=deleted)), 201
+
+
+@app.route('/admin/api/schedule-exceptions/<int:exception_id>', methods=['DELETE'])
+def admin_delete_schedule_exception(exception_id):
+    err = check_admin()
+    if err: return err
+    exception = ScheduleException.query.get(exception_id)
+    if not exception:
+        return jsonify({'error': 'Not found'}), 404
+    teacher_ids = [exception.teacher_id] if exception.teacher_id else None
+    db.session.delete(exception)
+    db.session.commit()
+    inserted, deleted = materialize_slots(teacher_ids)
+    return jsonify({'success': True, 'slots_added': inserted, 'slots_removed': deleted})
+
+
 @app.route('/admin/api/customers', methods=['GET'])
 def admin_get_customers():
+    """
+    客戶列表：依 id 倒序（新客戶在前）的 keyset 分頁。
+    total_spent 會隨預約與取消變動，不能當分頁鍵，否則翻頁時客戶會重複或漏掉
+    """
     err = check_admin()
     if err: return err
-    customers = Customer.query.order_by(Customer.total_spent.desc()).all()
-    return jsonify([{
-        'id': c.id, 'name': c.name, 'phone': c.phone,
-        'email': c.email, 'total_bookings': c.total_bookings,
-        'total_hours': c.total_hours, 'total_spent': c.total_spent,
-        'created_at': c.created_at.strftime('%Y-%m-%d') if c.created_at else ''
-    } for c in customers])
+    limit, cursor, fields = _page_args(Customer, (_cursor_int,))
+    query = Customer.query
+    if cursor:
+        query = query.filter(Customer.id < cursor[0])
+    query = _project(query, Customer, fields, 'id')
+    rows = query.order_by(Customer.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor([rows[-1].id])
+    return jsonify({'items': [c.to_dict(fields) for c in rows], 'next_cursor': next_cursor})
+
+
+EXPORT_CHUNK_ROWS = 1000
+
+
+def _booking_export_columns(model):
+    return [
+        model.id, model.booking_number, model.teacher_id,
+        Teacher.name.label('teacher_name'), model.customer_name, model.customer_phone,
+        model.line_user_id, model.date, model.time, model.duration,
+        model.total_price, model.status, model.source, model.note, model.created_at
+    ]
+
+
+def _select_fields(columns, args):
+    """?fields= 指定的欄位（依指定順序），省略時為全部"""
+    fields = [f for f in args.get('fields', '').split(',') if f]
+    if not fields:
+        return columns
+    by_name = {c.key: c for c in columns}
+    unknown = [f for f in fields if f not in by_name]
+    if unknown:
+        raise InvalidQuery(f'未知欄位：{", ".join(unknown)}')
+    return [by_name[f] for f in fields]
+
+
+def _export_statements(entity, args):
+    """
+    匯出用的 select 清單（只取欄位，不建立 ORM 物件），依序輸出。
+    預約先輸出 bookings_archive 再輸出 bookings，兩者套用與列表相同的篩選
+    """
+    if entity == 'bookings':
+        return [
+            filter_bookings(
+                db.select(*_select_fields(_booking_export_columns(model), args))
+                .outerjoin(Teacher, Teacher.id == model.teacher_id), args, model
+            ).order_by(model.id)
+            for model in (BookingArchive, Booking)
+        ]
+    if entity == 'customers':
+        columns = [
+            Customer.id, Customer.name, Customer.phone, Customer.email, Customer.line_user_id,
+            Customer.total_bookings, Customer.total_hours, Customer.total_spent, Customer.created_at
+        ]
+        order = Customer.id
+    elif entity == 'conversations':
+        columns = [
+            AIConversation.id, AIConversation.line_user_id, AIConversation.user_message,
+            AIConversation.ai_response, AIConversation.intent, AIConversation.booking_id,
+            AIConversation.created_at
+        ]
+        order = AIConversation.id
+    else:
+        return None
+    return [db.select(*_select_fields(columns, args)).order_by(order)]
+
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+@app.route('/admin/api/export/<entity>', methods=['GET'])
+def admin_export(entity):
+    """
+    串流匯出 bookings / customers / conversations（format=csv 或 ndjson）。
+    以 yield_per 分批從資料庫讀取、邊讀邊送，記憶體用量不隨資料量增加。
+    """
+    err = check_admin()
+    if err: return err
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'format 須為 csv 或 ndjson'}), 400
+    stmts = _export_statements(entity, request.args)
+    if stmts is None:
+        return jsonify({'error': f'不支援匯出 {entity}'}), 404
+
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for n, stmt in enumerate(stmts):
+            result = db.session.execute(stmt.execution_options(yield_per=EXPORT_CHUNK_ROWS))
+            keys = list(result.keys())
+            if fmt == 'csv' and n == 0:
+                buf.write('\ufeff')  # 讓 Excel 正確辨識 UTF-8
+                writer.writerow(keys)
+            for rows in result.partitions():
+                for row in rows:
+                    values = [_export_value(v) for v in row]
+                    if fmt == 'csv':
+                        writer.writerow(['' if v is None else v for v in values])
+                    else:
+                        buf.write(json.dumps(dict(zip(keys, values)), ensure_ascii=False))
+                        buf.write('\n')
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        if buf.tell():
+            yield buf.getvalue()
+
+    filename = f'{entity}_{datetime.now().strftime("%Y%m%d%H%M%S")}.{fmt}'
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=f'{mimetype}; charset=utf-8',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 
 @app.route('/admin/api/stats', methods=['GET'])
@@ -1409,17 +3988,157 @@ def admin_get_stats():
     err = check_admin()
     if err: return err
     today = datetime.now().strftime('%Y-%m-%d')
+    total, revenue, conversations, today_count, line_count = db.session.query(
+        func.sum(DailyStat.confirmed_count),
+        func.sum(DailyStat.revenue),
+        func.sum(DailyStat.conversations),
+        func.sum(case((DailyStat.day == today, DailyStat.confirmed_count), else_=0)),
+        func.sum(case((DailyStat.source == 'line', DailyStat.confirmed_count), else_=0))
+    ).one()
     stats = {
-        'total_bookings': Booking.query.filter_by(status='confirmed').count(),
-        'today_bookings': Booking.query.filter_by(date=today, status='confirmed').count(),
+        'total_bookings': total or 0,
+        'today_bookings': today_count or 0,
         'total_customers': Customer.query.count(),
-        'total_revenue': db.session.query(func.sum(Booking.total_price)).filter_by(status='confirmed').scalar() or 0,
-        'line_bookings': Booking.query.filter_by(source='line', status='confirmed').count(),
-        'ai_conversations': AIConversation.query.count()
+        'total_revenue': revenue or 0,
+        'line_bookings': line_count or 0,
+        'ai_conversations': conversations or 0
     }
     return jsonify(stats)
 
 
+FEED_STREAM_SECONDS = int(os.environ.get('FEED_STREAM_SECONDS', '300'))
+FEED_REPLAY_LIMIT = 500
+
+
+def _sse(event_id, kind, payload):
+    return f'id: {event_id}\nevent: {kind}\ndata: {payload}\n\n'
+
+
+@app.route('/admin/api/stream', methods=['GET'])
+def admin_stream():
+    """
+    Server-Sent Events：推送 booking_created / booking_cancelled（含後台統計的差異）。
+    重連時帶 Last-Event-ID 會補送斷線期間的事件，太多無法補齊時送出 reset 讓前端重新載入。
+    每條連線最多 FEED_STREAM_SECONDS 秒，之後由前端重連（不會長期佔住 worker）。
+    """
+    err = check_admin()
+    if err: return err
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    q = booking_feed.subscribe()
+    backlog, reset = [], False
+    if last_id is not None:
+        backlog = [tuple(r) for r in db.session.query(
+            BookingFeedEvent.id, BookingFeedEvent.kind, BookingFeedEvent.payload
+        ).filter(BookingFeedEvent.id > last_id).order_by(BookingFeedEvent.id)
+            .limit(FEED_REPLAY_LIMIT + 1)]
+        reset = len(backlog) > FEED_REPLAY_LIMIT
+        if reset:
+            backlog = []
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            if reset:
+                yield 'event: reset\ndata: {}\n\n'
+            replayed = {ev[0] for ev in backlog}
+            for ev in backlog:
+                yield _sse(*ev)
+            deadline = time.monotonic() + FEED_STREAM_SECONDS
+            while time.monotonic() < deadline:
+                try:
+                    ev = q.get(timeout=min(15.0, max(0.1, deadline - time.monotonic())))
+                except queue.Empty:
+                    if not booking_feed.is_subscribed(q):
+                        return
+                    yield ': ping\n\n'
+                    continue
+                if ev[0] not in replayed:
+                    yield _sse(*ev)
+        finally:
+            booking_feed.unsubscribe(q)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/admin/api/cache-stats', methods=['GET'])
+def admin_get_cache_stats():
+    err = check_admin()
+    if err: return err
+    return jsonify({
+        'flex_cache': flex_cache.stats(),
+        'entity_cache': entity_cache.stats(),
+        'line_api': line_api.stats.snapshot(),
+        'sendgrid_api': sendgrid_api.stats.snapshot()
+    })
+
+
+@metrics.gauge('webhook_events', '佇列中的 webhook 事件數', ('status',))
+def _webhook_event_counts():
+    rows = db.session.query(WebhookEvent.status, func.count()).group_by(WebhookEvent.status).all()
+    return {(status,): count for status, count in rows}
+
+
+@metrics.gauge('outbox_messages', '通知 outbox 各狀態筆數', ('status',))
+def _outbox_counts():
+    rows = db.session.query(OutboxMessage.status, func.count()).group_by(OutboxMessage.status).all()
+    return {(status,): count for status, count in rows}
+
+
+@metrics.gauge('flex_cache', 'Flex 訊息快取', ('field',))
+def _flex_cache_stats():
+    stats = flex_cache.stats()
+    return {(k,): stats[k] for k in ('entries', 'bytes', 'hits', 'misses', 'evictions')}
+
+
+@metrics.gauge('entity_cache', 'Teacher / Customer 快取命中與失效次數', ('kind', 'field'))
+def _entity_cache_stats():
+    stats = entity_cache.stats()
+    values = {('all', 'entries'): stats['entries'], ('all', 'evictions'): stats['evictions']}
+    for kind in EntityCache.STAMPS:
+        for field in ('hits', 'misses', 'invalidations'):
+            values[(kind, field)] = stats[kind][field]
+    return values
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 文字格式；設定 METRICS_TOKEN 時需帶 Authorization: Bearer <token>"""
+    if METRICS_TOKEN and not hmac.compare_digest(
+            request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+        return 'Unauthorized', 401
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/admin/api/outbox', methods=['GET'])
+def admin_get_outbox():
+    """各狀態筆數與最近的訊息（?status=dead 查看無法送出的通知）"""
+    err = check_admin()
+    if err: return err
+    counts = dict(db.session.query(OutboxMessage.status, func.count())
+                  .group_by(OutboxMessage.status).all())
+    query = OutboxMessage.query
+    status = request.args.get('status')
+    if status:
+        query = query.filter_by(status=status)
+    messages = query.order_by(OutboxMessage.id.desc()).limit(100).all()
+    return jsonify({'counts': counts, 'items': [m.to_dict() for m in messages]})
+
+
+@app.route('/admin/api/outbox/<int:mid>/retry', methods=['POST'])
+def admin_retry_outbox(mid):
+    """把 dead 的訊息重新排入佇列"""
+    err = check_admin()
+    if err: return err
+    message = OutboxMessage.query.get_or_404(mid)
+    if message.status != 'dead':
+        return jsonify({'error': '只有 dead 狀態的訊息可以重送'}), 400
+    message.status, message.attempts, message.next_attempt_at = 'pending', 0, datetime.now()
+    after_commit(outbox.notify)
+    db.session.commit()
+    return jsonify({'success': True})
+
+
 @app.route('/admin/api/ai-conversations', methods=['GET'])
 def admin_get_ai_conversations():
     err = check_admin()
@@ -1455,17 +4174,134 @@ def seed():
          'bio': '持TESOL國際英語教學認證，多益教學經驗豐富。', 'hourly_rate': 1000}
     ]
     for data in teachers_data:
-        db.session.add(Teacher(**data))
+        teacher = Teacher(**data)
+        db.session.add(teacher)
+        db.session.flush()
+        db.session.add_all(default_schedule(teacher.id))
     db.session.commit()
     print('')
 
 
+def _add_column(model, name, default_sql=None):
+    """既有資料表缺少欄位時以 ALTER TABLE 補上（db.create_all 不會修改已存在的表），回傳是否有新增"""
+    table = model.__tablename__
+    if name in {c['name'] for c in inspect(db.session.connection()).get_columns(table)}:
+        return False
+    column_type = model.__table__.c[name].type.compile(dialect=db.engine.dialect)
+    default = f' DEFAULT {default_sql}' if default_sql is not None else ''
+    db.session.execute(db.text(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}{default}'))
+    return True
+
+
+def migrate_schema():
+    """
+    補上既有資料表缺少的欄位與索引（db.create_all 只會在建立新表時建索引）。
+    已有重複 confirmed 時段的舊資料會讓 unique index 建立失敗，印出錯誤後略過。
+    """
+    # 預約的 starts_at：既有資料表補欄位並由 date / time 回填，再移除被取代的索引
+    if db.engine.url.get_backend_name() == 'postgresql':
+        starts_at_sql = "CAST(date || ' ' || time AS TIMESTAMP)"
+    else:
+        starts_at_sql = "date || ' ' || time || '\\:00.000000'"  # SQLAlchemy 的 SQLite DateTime 格式
+    for model in (Booking, BookingArchive):
+        if _add_column(model, 'starts_at'):
+            db.session.execute(db.text(f'UPDATE {model.__tablename__} SET starts_at = {starts_at_sql}'))
+            db.session.commit()
+    # webhook 事件的重試次數與時間
+    _add_column(WebhookEvent, 'attempts', '0')
+    _add_column(WebhookEvent, 'next_attempt_at')
+    db.session.commit()
+    # 不再使用的索引：舊的 date / time 排序索引、客戶依 total_spent 分頁的索引
+    for name in ('ix_bookings_line_user_status_date_time', 'ix_bookings_date_status_line_user',
+                 'ix_customers_total_spent_id'):
+        db.session.execute(db.text(f'DROP INDEX IF EXISTS {name}'))
+    db.session.commit()
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=db.engine, checkfirst=True)
+            except (IntegrityError, OperationalError) as e:
+                print(f'索引 {index.name} 建立失敗: {e}')
+
+    # 流水號表是新表時，從既有預約編號接續
+    if BookingSequence.query.first() is None:
+        db.session.execute(db.text(
+            "INSERT INTO booking_sequences (day, last_seq) "
+            "SELECT substr(booking_number, 3, 8), MAX(CAST(substr(booking_number, 11) AS INTEGER)) "
+            "FROM bookings WHERE booking_number LIKE 'BK%' "
+            "GROUP BY substr(booking_number, 3, 8) "
+            "ON CONFLICT (day) DO NOTHING"
+        ))
+        db.session.commit()
+
+    # 統計彙總表是新表時，從既有資料建立
+    if DailyStat.query.first() is None and (Booking.query.first() or AIConversation.query.first()):
+        rebuild_daily_stats()
+
+    # 封存後 ai_conversations.booking_id 可能指向 bookings_archive，移除舊的外鍵
+    if db.engine.url.get_backend_name() == 'postgresql':
+        db.session.execute(db.text(
+            'ALTER TABLE ai_conversations DROP CONSTRAINT IF EXISTS ai_conversations_booking_id_fkey'
+        ))
+        db.session.commit()
+
+    # 排班表是新表時，既有老師套用預設排班（與原本固定的 09:00 - 20:00 時段相同）
+    if TeacherSchedule.query.first() is None:
+        for (teacher_id,) in db.session.query(Teacher.id):
+            db.session.add_all(default_schedule(teacher_id))
+        db.session.commit()
+
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """重新計算 stats_daily 統計彙總表"""
+    print(f'stats_daily 重建完成，共 {rebuild_daily_stats()} 列')
+
+
+@app.cli.command('generate-slots')
+@click.option('--start', type=click.DateTime(['%Y-%m-%d']), default=None, help='起始日（預設今天）')
+@click.option('--weeks', type=int, default=None, help='產生幾週（預設 SLOT_HORIZON_WEEKS）')
+def generate_slots_command(start, weeks):
+    """依排班產生未來的 TimeSlot（可由 cron 每天執行）"""
+    inserted, deleted = materialize_slots(start=start.date() if start else None, weeks=weeks)
+    print(f'時段產生完成，新增 {inserted}、刪除 {deleted}')
+
+
+@app.cli.command('send-reminders')
+@click.option('--date', 'day', default=None, help='上課日期 YYYY-MM-DD（預設明天）')
+def send_reminders_command(day):
+    """為指定日期的 LINE 預約排入課前提醒（已提醒過的不會重複）"""
+    users, multicasts, pushes = send_lesson_reminders(day)
+    print(f'提醒 {users} 位用戶：multicast {multicasts} 筆、push {pushes} 筆')
+
+
+@app.cli.command('archive-bookings')
+@click.option('--days', type=int, default=None, help='封存幾天前的預約（預設 ARCHIVE_AFTER_DAYS）')
+@click.option('--full-vacuum', is_flag=True, help='SQLite：轉為 auto_vacuum=INCREMENTAL 並完整 VACUUM 一次')
+def archive_bookings_command(days, full_vacuum):
+    """把過去的預約搬到 bookings_archive 並回收空間"""
+    moved, pruned = archive_bookings(days)
+    freed = reclaim_space(full=full_vacuum)
+    print(f'封存 {moved} 筆預約、刪除 {pruned} 筆過期時段'
+          + (f'，回收 {freed} 頁' if freed is not None else '，已執行 VACUUM (ANALYZE)'))
+
+
+@app.cli.command('reconcile-customers')
+def reconcile_customers_command():
+    """從 bookings 重新計算客戶的預約數、時數與消費總額"""
+    print(f'客戶累計校正完成，修正 {reconcile_customer_totals()} 位客戶')
+
+
 with app.app_context():
     try:
         db.create_all()
+        migrate_schema()
         print('')
         if Teacher.query.count() == 0:
             seed()
+        materialize_slots()
+        static_pages.warm()
     except Exception as e:
         print(f': {e}')
 
@@ -1473,7 +4309,9 @@ if __name__ == '__main__':
     os.makedirs('static', exist_ok=True)
     with app.app_context():
         db.create_all()
+        migrate_schema()
         seed()
+        materialize_slots()
     print('\n  ')
     print('  http://localhost:5000')
     print('  http://localhost:5000/admin')
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+LINE Messaging API 共用 HTTP client
+
+- 每個 process 一個 keep-alive 連線池（gunicorn fork 後重新建立）
+- 以 semaphore 限制同時對外請求數
+- 429 / 5xx / 連線錯誤自動重試，指數退避並遵守 Retry-After
+- 每個 endpoint 記錄呼叫次數、錯誤、重試與延遲，並可掛上 observer 回呼
+"""
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class CallStats:
+    """各 endpoint 的呼叫統計（thread-safe）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def record(self, endpoint, status, elapsed, retries):
+        with self._lock:
+            s = self._data.setdefault(endpoint, {
+                'calls': 0, 'errors': 0, 'retries': 0,
+                'total_ms': 0.0, 'max_ms': 0.0, 'status': {}
+            })
+            s['calls'] += 1
+            s['retries'] += retries
+            if status is None or status >= 400:
+                s['errors'] += 1
+            ms = elapsed * 1000
+            s['total_ms'] += ms
+            s['max_ms'] = max(s['max_ms'], ms)
+            key = str(status) if status is not None else 'network_error'
+            s['status'][key] = s['status'].get(key, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            out = {}
+            for endpoint, s in self._data.items():
+                out[endpoint] = dict(s, status=dict(s['status']),
+                                     avg_ms=round(s['total_ms'] / s['calls'], 2) if s['calls'] else 0)
+            return out
+
+
+class PooledHTTPClient:
+    """共用連線池 + 重試的 JSON POST client"""
+
+    def __init__(self, base_url, headers=None, pool_size=10, max_concurrency=10,
+                 max_retries=3, backoff=0.5, max_backoff=8.0, max_retry_after=30.0,
+                 timeout=10, name='http'):
+        self.base_url = base_url.rstrip('/')
+        self.headers = dict(headers or {})
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.timeout = timeout
+        self.name = name
+        self.stats = CallStats()
+        self.observers = []  # callback(name, path, status, elapsed, retries)，例如匯出 Prometheus 指標
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size,
+                                          max_retries=0)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.headers.update(self.headers)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def _retry_delay(self, attempt, response):
+        """Retry-After 優先，否則指數退避加 jitter；超過上限回傳 None（不再重試）"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return max(0.0, delay) if delay <= self.max_retry_after else None
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return delay * (0.5 + random.random() / 2)
+
+    def post(self, path, json=None, data=None, headers=None, ok_status=(200,)):
+        """
+        POST 並在可重試的錯誤時重試；data 為已序列化的 body（bytes）。
+        回傳最後一次的 Response；網路錯誤且重試用盡時回傳 None。
+        """
+        url = self.base_url + path
+        attempt = 0
+        start = time.monotonic()
+        response = None
+        while True:
+            error = None
+            with self._semaphore:
+                try:
+                    response = self.session.post(url, json=json, data=data, headers=headers,
+                                                 timeout=self.timeout)
+                except requests.RequestException as e:
+                    response, error = None, e
+            retryable = error is not None or response.status_code in RETRY_STATUS
+            delay = self._retry_delay(attempt, response) if retryable else None
+            if delay is None or attempt >= self.max_retries:
+                break
+            attempt += 1
+            time.sleep(delay)
+
+        status = response.status_code if response is not None else None
+        elapsed = time.monotonic() - start
+        self.stats.record(path, status, elapsed, attempt)
+        for observer in self.observers:
+            observer(self.name, path, status, elapsed, attempt)
+        if response is None:
+            print(f'{self.name} {path} 連線失敗: {error}')
+        elif response.status_code not in ok_status:
+            print(f'{self.name} {path} HTTP {response.status_code}: {response.text[:200]}')
+        return response
+
+
+class LineClient(PooledHTTPClient):
+    """LINE Messaging API（push / multicast / reply）"""
+
+    def __init__(self, access_token, base_url='https://api.line.me', **kwargs):
+        kwargs.setdefault('name', 'LINE')
+        super().__init__(base_url, headers={
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {access_token}'
+        }, **kwargs)
+
+    @staticmethod
+    def serialize(messages):
+        return json.dumps(messages, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def _body(cls, head, messages):
+        """組合 request body；messages 可為 list 或已序列化好的 bytes（Flex 快取）"""
+        if not isinstance(messages, (bytes, bytearray)):
+            messages = cls.serialize(messages)
+        return cls.serialize(head)[:-1] + b',"messages":' + messages + b'}'
+
+    def reply(self, reply_token, messages):
+        return self.post('/v2/bot/message/reply',
+                         data=self._body({'replyToken': reply_token}, messages))
+
+    def push(self, to, messages, retry_key=None):
+        # X-Line-Retry-Key 讓重試不會重複送出；409 代表先前的請求已被接受
+        headers = {'X-Line-Retry-Key': retry_key or str(uuid.uuid4())}
+        return self.post('/v2/bot/message/push', data=self._body({'to': to}, messages),
+                         headers=headers, ok_status=(200, 409))
+
+    MULTICAST_LIMIT = 500  # LINE multicast 每次最多 500 位收件人
+
+    def multicast(self, to, messages, retry_key=None):
+        """同一則訊息送給多位用戶（最多 MULTICAST_LIMIT 位）"""
+        headers = {'X-Line-Retry-Key': retry_key or str(uuid.uuid4())}
+        return self.post('/v2/bot/message/multicast', data=self._body({'to': list(to)}, messages),
+                         headers=headers, ok_status=(200, 409))
+
+    @staticmethod
+    def ok(response):
+        return response is not None and response.status_code in (200, 409)
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+輕量 Prometheus 指標（不依賴 prometheus_client）
+
+- Counter / Histogram 以 dict 累計，每次 observe 只是一次加鎖與數次加法
+- 查詢時才計算的 gauge 以 callback 登記
+- 多個 gunicorn worker：設定 METRICS_DIR 後，各 process 定期把累計值寫成
+  METRICS_DIR/metrics-<pid>.json，/metrics 讀取全部檔案加總後輸出。
+  已結束的 worker 的最後累計值併入 METRICS_DIR/archived.json，worker 重啟後
+  加總值不會變小（Prometheus 不會誤判為 counter 重置）
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(k), v] for k, v in self._values.items()]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [各 bucket 次數..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                data = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-2] += value
+            data[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(k), list(v)] for k, v in self._values.items()]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._gauges = []  # (name, help, labelnames, callback)
+        self._store_dir = None
+        self._flush_pid = None
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, labelnames=()):
+        """登記查詢時才呼叫的 gauge；被裝飾的函式回傳 {labels tuple: value}"""
+        def register(fn):
+            self._gauges.append((name, help_text, tuple(labelnames), fn))
+            return fn
+        return register
+
+    # 
+    # 多 process 彙總
+    # 
+
+    def enable_multiprocess(self, directory, interval=10.0):
+        os.makedirs(directory, exist_ok=True)
+        self._store_dir = directory
+        self._interval = interval
+
+    def start(self):
+        """每個 process 啟動一次定期寫檔的執行緒（未設定 METRICS_DIR 時不做事）"""
+        if not self._store_dir or self._flush_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flush_pid == os.getpid():
+                return
+            self._flush_pid = os.getpid()
+            threading.Thread(target=self._run_flush, daemon=True).start()
+
+    def _run_flush(self):
+        while True:
+            time.sleep(self._interval)
+            try:
+                self.flush()
+            except OSError as e:
+                print(f'指標寫入失敗: {e}')
+
+    def _snapshot(self):
+        return {m.name: m.snapshot() for m in self._metrics}
+
+    def flush(self):
+        path = os.path.join(self._store_dir, f'metrics-{os.getpid()}.json')
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._snapshot(), f)
+        os.replace(tmp, path)
+
+    def _archive(self, path):
+        """把已結束 worker 的檔案併入 archived.json 後刪除；以檔案鎖避免多個 process 重複併入"""
+        archived_path = os.path.join(self._store_dir, 'archived.json')
+        with open(os.path.join(self._store_dir, 'archived.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except FileNotFoundError:
+                return  # 其他 process 已併入
+            except ValueError:
+                snapshot = {}
+            merged = {}
+            _merge(merged, _read(archived_path))
+            _merge(merged, snapshot)
+            tmp = f'{archived_path}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(_unmerge(merged), f)
+            os.replace(tmp, archived_path)
+            os.remove(path)
+
+    def _collect(self):
+        """目前 process 的累計值；multiprocess 模式下加總所有 worker 的檔案與已結束 worker 的累計"""
+        if not self._store_dir:
+            return self._snapshot()
+        self.flush()
+        for filename in os.listdir(self._store_dir):
+            if not (filename.startswith('metrics-') and filename.endswith('.json')):
+                continue
+            pid = int(filename[len('metrics-'):-len('.json')])
+            if pid != os.getpid() and not _pid_alive(pid):
+                try:
+                    self._archive(os.path.join(self._store_dir, filename))
+                except OSError as e:
+                    print(f'指標封存失敗: {e}')
+        merged = {}
+        for filename in os.listdir(self._store_dir):
+            if filename == 'archived.json' or (filename.startswith('metrics-') and filename.endswith('.json')):
+                _merge(merged, _read(os.path.join(self._store_dir, filename)))
+        return _unmerge(merged)
+
+    # 
+    # 輸出
+    # 
+
+    def render(self):
+        snapshot = self._collect()
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for labels, value in sorted(snapshot.get(metric.name, [])):
+                if metric.kind == 'counter':
+                    lines.append(f'{metric.name}{_labels(metric.labelnames, labels)} {_number(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets, value[:-2]):
+                    cumulative += count
+                    le = f'le="{_number(float(bound))}"'
+                    lines.append(f'{metric.name}_bucket{_labels(metric.labelnames, labels, [le])} '
+                                 f'{cumulative}')
+                le = 'le="+Inf"'
+                lines.append(f'{metric.name}_bucket{_labels(metric.labelnames, labels, [le])} {value[-1]}')
+                lines.append(f'{metric.name}_sum{_labels(metric.labelnames, labels)} {_number(value[-2])}')
+                lines.append(f'{metric.name}_count{_labels(metric.labelnames, labels)} {value[-1]}')
+        for name, help_text, labelnames, fn in self._gauges:
+            try:
+                values = fn()
+            except Exception as e:
+                print(f'指標 {name} 讀取失敗: {e}')
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in sorted(values.items()):
+                lines.append(f'{name}{_labels(labelnames, labels)} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _merge(merged, snapshot):
+    """把 snapshot（{name: [[labels, value], ...]}）加總到 merged（{name: {labels tuple: value}}）"""
+    for name, values in snapshot.items():
+        target = merged.setdefault(name, {})
+        for labels, value in values:
+            key = tuple(labels)
+            if isinstance(value, list):
+                current = target.get(key)
+                target[key] = value if current is None else [a + b for a, b in zip(current, value)]
+            else:
+                target[key] = target.get(key, 0) + value
+
+
+def _unmerge(merged):
+    return {name: [[list(k), v] for k, v in values.items()] for name, values in merged.items()}
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+registry = Registry()
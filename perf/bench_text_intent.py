@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+文字訊息解析吞吐量測試
+
+以內建老師名單與訊息樣板組合出語料（預約 / 查詢 / 取消 / 註冊 / 閒聊），
+重複解析並輸出每秒訊息數與單則延遲分位數；先以一組固定案例確認解析結果正確。
+不需要資料庫。
+
+    python perf/bench_text_intent.py --seconds 5
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from text_intent import Intent, TeacherIndex, parse  # noqa: E402
+
+TEACHERS = [(1, '陳志豪'), (2, '林美慧'), (3, '王俊傑'), (4, '張雅婷'),
+            (5, '陳小明'), (6, 'Amy Lin')]
+TODAY = date(2026, 2, 1)
+
+CASES = [
+    ('預約 陳志豪 2/20 15:00', Intent('book', (1,), '2026-02-20', '15:00')),
+    ('我要訂 王老師 2月20日 下午3點', Intent('book', (3,), '2026-02-20', '15:00')),
+    ('約 林老師 2/20 3pm', Intent('book', (2,), '2026-02-20', '15:00')),
+    ('預約 陳老師 明天 10點', Intent('book', (1, 5), '2026-02-02', '10:00')),
+    ('志豪老師 下週三 晚上7點', Intent('book', (1,), '2026-02-04', '19:00')),
+    ('book amy feb 3rd 9am', Intent('book', (6,), '2026-02-03', '09:00')),
+    ('約王俊傑 2026/03/02 十點半', Intent('book', (3,), '2026-03-02', '10:30')),
+    ('王老師 星期一 兩點', Intent('book', (3,), '2026-02-02', '14:00')),
+    ('查詢預約', Intent('query')),
+    ('我的預約', Intent('query')),
+    ('老師名單', Intent('teachers')),
+    ('有哪些老師', Intent('teachers')),
+    ('取消預約 BK202602010001', Intent('cancel', booking_number='BK202602010001')),
+    ('取消 張老師 2/5 11:00', Intent('cancel', (4,), '2026-02-05', '11:00')),
+    ('註冊 張小明 0912345678', Intent('register')),
+    ('你好', Intent(None)),
+]
+
+BOOK_TEMPLATES = ['預約 {t} {d} {h}', '我要訂 {t} {d} {h}', '約 {t} {d} {h}', '{t} {d} {h}',
+                  'book {t} {d} {h}', '想預約{t}，{d}{h}可以嗎？']
+TEACHER_FORMS = ['陳志豪', '陳老師', '林美慧', '美慧老師', '王老師', '張雅婷', 'amy']
+DATE_FORMS = ['2/20', '02/20', '2月20日', '2026/02/20', '明天', '後天', '下週三', '星期五',
+              'feb 20', '20th feb', 'tomorrow', '']
+TIME_FORMS = ['15:00', '3pm', '下午3點', '15點', '十點半', '晚上7點', '10:30am', '兩點', '']
+OTHER = ['查詢預約', '我的預約', '老師名單', '有哪些老師', '取消預約', '取消 BK202602010003',
+         '註冊 王小明 0987654321', '你好', '請問營業時間？', '謝謝', '收到 👍']
+
+
+def build_corpus(size, seed=1):
+    rng = random.Random(seed)
+    combos = list(itertools.product(BOOK_TEMPLATES, TEACHER_FORMS, DATE_FORMS, TIME_FORMS))
+    corpus = []
+    for _ in range(size):
+        if rng.random() < 0.7:
+            tpl, t, d, h = rng.choice(combos)
+            corpus.append(tpl.format(t=t, d=d, h=h))
+        else:
+            corpus.append(rng.choice(OTHER))
+    return corpus
+
+
+def check(index):
+    failures = 0
+    for text, expected in CASES:
+        got = parse(text, index, TODAY)
+        if got != expected:
+            failures += 1
+            print(f'解析錯誤: {text!r}\n  預期 {expected}\n  實際 {got}')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--corpus', type=int, default=5000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index = TeacherIndex(TEACHERS, version=1)
+    build_ms = (time.perf_counter() - start) * 1000
+
+    failures = check(index)
+    print(f'固定案例 {len(CASES) - failures}/{len(CASES)} 通過，索引建立 {build_ms:.2f} ms，'
+          f'{len(index.aliases)} 個別名')
+
+    corpus = build_corpus(args.corpus)
+    latencies = []
+    kinds = {}
+    deadline = time.perf_counter() + args.seconds
+    total = 0
+    while time.perf_counter() < deadline:
+        for text in corpus:
+            t0 = time.perf_counter()
+            intent = parse(text, index, TODAY)
+            latencies.append(time.perf_counter() - t0)
+            kinds[intent.kind] = kinds.get(intent.kind, 0) + 1
+        total += len(corpus)
+    elapsed = sum(latencies)
+    latencies.sort()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1e6
+
+    print(f'{total} 則訊息，{total / elapsed:,.0f} 則/秒')
+    print(f'延遲 p50 {pct(0.5):.1f} µs  p99 {pct(0.99):.1f} µs  max {latencies[-1] * 1e6:.1f} µs')
+    print('意圖分布:', ', '.join(f'{k}={v}' for k, v in sorted(kinds.items(), key=lambda kv: -kv[1])))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
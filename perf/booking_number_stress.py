@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+預約編號並發壓力測試
+
+多個 process（模擬 gunicorn worker）× 多條執行緒同時呼叫 generate_booking_number，
+每次各自 commit，最後檢查編號沒有重複、且流水號連續。
+使用專用的測試日期 (--day)，結束後刪除該日期的流水號。
+
+    python perf/booking_number_stress.py --processes 4 --threads 4 --count 50
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db, generate_booking_number, BookingSequence  # noqa: E402
+
+
+def _worker(day, threads, count, out):
+    with app.app_context():
+        db.engine.dispose(close=False)  # fork 後不可共用父 process 的連線
+    numbers = []
+    lock = threading.Lock()
+
+    def run():
+        with app.app_context():
+            for _ in range(count):
+                number = generate_booking_number(day)
+                db.session.commit()
+                with lock:
+                    numbers.append(number)
+            db.session.remove()
+
+    pool = [threading.Thread(target=run) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    out.put(numbers)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--count', type=int, default=50, help='每條執行緒產生的編號數')
+    parser.add_argument('--day', default='99990101')
+    args = parser.parse_args()
+
+    with app.app_context():
+        BookingSequence.query.filter_by(day=args.day).delete()
+        db.session.commit()
+
+    ctx = multiprocessing.get_context('fork')
+    out = ctx.Queue()
+    procs = [ctx.Process(target=_worker, args=(args.day, args.threads, args.count, out))
+             for _ in range(args.processes)]
+    for p in procs:
+        p.start()
+    numbers = []
+    for _ in procs:
+        numbers.extend(out.get(timeout=300))
+    for p in procs:
+        p.join()
+
+    with app.app_context():
+        BookingSequence.query.filter_by(day=args.day).delete()
+        db.session.commit()
+
+    expected = args.processes * args.threads * args.count
+    seqs = sorted(int(n[10:]) for n in numbers)
+    duplicates = len(numbers) - len(set(numbers))
+    print(f'產生 {len(numbers)}/{expected} 筆，重複 {duplicates} 筆')
+    if len(numbers) != expected or duplicates or seqs != list(range(1, expected + 1)):
+        print('FAIL')
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
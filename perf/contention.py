@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+並發預約競爭測試
+
+對每個資料庫後端，多個 process（模擬 gunicorn worker）× 多條執行緒同時呼叫
+POST /api/book，目標時段刻意集中在少數幾格，檢查：
+  - 沒有 5xx（例如 database is locked）
+  - 每個時段最多一筆 confirmed
+  - 回 201 的次數等於新增的 confirmed 預約數
+並輸出吞吐量與延遲分位數。測試使用 2099 年的日期，前後都會清除。
+
+    python perf/contention.py --backend sqlite:////tmp/contention.db \\
+        --backend postgresql://postgres@localhost/booking_test
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DATES = [f'2099-01-{d:02d}' for d in range(1, 29)]
+
+
+def _cleanup(app_module):
+    m = app_module
+    with m.app.app_context():
+        ids = [b.id for b in m.Booking.query.filter(m.Booking.date.in_(TEST_DATES))]
+        if ids:
+            m.Booking.query.filter(m.Booking.id.in_(ids)).delete(synchronize_session=False)
+        m.Customer.query.filter(m.Customer.phone.like('099%')).delete(synchronize_session=False)
+        m.DailyStat.query.filter(m.DailyStat.day.in_(TEST_DATES)).delete(synchronize_session=False)
+        m.TimeSlot.query.filter(m.TimeSlot.date.in_(TEST_DATES)).delete(synchronize_session=False)
+        m.db.session.commit()
+
+
+def _worker(worker_no, args, slots, out):
+    import app as m
+    with m.app.app_context():
+        m.db.engine.dispose(close=False)  # fork 後不可共用父 process 的連線
+    client = m.app.test_client()
+    results = []
+    lock = threading.Lock()
+
+    def run(thread_no):
+        rng = random.Random(worker_no * 1000 + thread_no)
+        for i in range(args.requests):
+            teacher_id, date, time_ = rng.choice(slots)
+            phone = f'099{worker_no:02d}{thread_no:02d}{i:04d}'
+            t0 = time.perf_counter()
+            r = client.post('/api/book', json={
+                'teacher_id': teacher_id, 'date': date, 'time': time_,
+                'name': f'競爭測試{worker_no}-{thread_no}', 'phone': phone
+            })
+            with lock:
+                results.append((r.status_code, time.perf_counter() - t0))
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    out.put(results)
+
+
+def run_backend(args):
+    """在子 process 內執行（DATABASE_URL 需在 import app 之前設定）"""
+    import app as m
+    _cleanup(m)
+    with m.app.app_context():
+        # 依排班產生測試日期的時段，只在開放的時段中挑選
+        m.materialize_slots(start=date(2099, 1, 1), weeks=4)
+        open_slots = m.db.session.query(m.TimeSlot.teacher_id, m.TimeSlot.date, m.TimeSlot.time) \
+            .filter(m.TimeSlot.date.in_(TEST_DATES)).order_by(m.TimeSlot.id).all()
+        before = m.Booking.query.filter(m.Booking.date.in_(TEST_DATES),
+                                        m.Booking.status == 'confirmed').count()
+    rng = random.Random(0)
+    slots = list({tuple(rng.choice(open_slots)) for _ in range(args.slots)})
+
+    ctx = multiprocessing.get_context('fork')
+    out = ctx.Queue()
+    start = time.perf_counter()
+    procs = [ctx.Process(target=_worker, args=(n, args, slots, out)) for n in range(args.processes)]
+    for p in procs:
+        p.start()
+    results = []
+    for _ in procs:
+        results.extend(out.get(timeout=600))
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - start
+
+    with m.app.app_context():
+        confirmed = m.db.session.query(m.Booking.teacher_id, m.Booking.date, m.Booking.time,
+                                       m.func.count()) \
+            .filter(m.Booking.date.in_(TEST_DATES), m.Booking.status == 'confirmed') \
+            .group_by(m.Booking.teacher_id, m.Booking.date, m.Booking.time).all()
+    _cleanup(m)
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies = sorted(lat for _, lat in results)
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    created = sum(c for *_, c in confirmed) - before
+    double_booked = sum(1 for *_, c in confirmed if c > 1)
+    server_errors = sum(v for k, v in statuses.items() if k >= 500)
+    with m.app.app_context():
+        backend = m.db.engine.url.get_backend_name()
+    print(f'[{backend}] {len(results)} 個請求 / {elapsed:.2f} 秒'
+          f'（{len(results) / elapsed:,.0f} req/s），時段 {len(slots)} 格')
+    print(f'  狀態碼 {dict(sorted(statuses.items()))}，成功預約 {created}，重複時段 {double_booked}')
+    print(f'  延遲 p50 {pct(0.5):.1f} ms  p95 {pct(0.95):.1f} ms  p99 {pct(0.99):.1f} ms  '
+          f'max {latencies[-1] * 1000:.1f} ms')
+    ok = server_errors == 0 and double_booked == 0 and created == statuses.get(201, 0)
+    print('  OK' if ok else '  FAIL')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', action='append',
+                        help='DATABASE_URL，可重複指定；預設只測 sqlite:////tmp/contention.db')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=25, help='每條執行緒送出的預約數')
+    parser.add_argument('--slots', type=int, default=60, help='競爭的時段格數（越少越激烈）')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        sys.path.insert(0, ROOT)
+        sys.exit(0 if run_backend(args) else 1)
+
+    failed = False
+    for url in args.backend or ['sqlite:////tmp/contention.db']:
+        env = dict(os.environ, DATABASE_URL=url, WEBHOOK_ASYNC='0')
+        cmd = [sys.executable, os.path.abspath(__file__), '--run', url,
+               '--processes', str(args.processes), '--threads', str(args.threads),
+               '--requests', str(args.requests), '--slots', str(args.slots)]
+        failed |= subprocess.run(cmd, env=env, cwd=ROOT).returncode != 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+端對端負載測試
+
+啟動 gunicorn，以本機 stub server 取代
+api.line.me 與 SendGrid（可設定延遲與錯誤率），由多個虛擬用戶同時送出：
+
+  webhook_browse  加好友 → 老師名單 → 選老師 → 選日期 → 選時段（簽章正確的 LINE 事件）
+  webhook_book    註冊 → 確認預約 postback
+  web_book        POST /api/book（時段集中在少數幾格，製造搶位）
+
+依情境輸出吞吐量、p50/p95/p99 延遲與錯誤率；webhook 另外量測
+「送出事件 → stub 收到 reply/push」的端對端延遲。
+結束後以管理 API 匯出預約，檢查同一時段是否有多筆 confirmed。
+
+    python perf/loadtest.py --users 50 --duration 30 --workers 4 \\
+        --stub-latency 80 --stub-error-rate 0.02
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHANNEL_SECRET = 'loadtest-secret'
+ADMIN_PASSWORD = 'loadtest-admin'
+TEST_DATES = [f'2099-02-{d:02d}' for d in range(1, 29)]
+SLOT_TIMES = [f'{h:02d}:00' for h in range(9, 21)]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# 
+# Stub server（LINE Messaging API / SendGrid）
+# 
+
+class StubServer:
+    """回應 LINE reply/push 與 SendGrid mail/send，記錄每個 reply token 的到達時間"""
+
+    def __init__(self, latency_ms=0, error_rate=0.0):
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.injected_errors = 0
+        self.delivered = {}  # reply token 或 push 對象 -> 到達時間
+        self.emails = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # header 與 body 分開寫出，避免 delayed ACK 多等 40ms
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                stub.handle(self, body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                pass  # 伺服器關閉時 keep-alive 連線被重設，不列印 traceback
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handle(self, handler, body):
+        if self.latency:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+        path = handler.path
+        with self.lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+            fail = random.random() < self.error_rate
+            if fail:
+                self.injected_errors += 1
+        if fail:
+            self._respond(handler, random.choice([429, 500, 503]), b'{"message":"stub error"}')
+            return
+        now = time.perf_counter()
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = {}
+        with self.lock:
+            if path == '/v2/bot/message/reply':
+                self.delivered.setdefault(payload.get('replyToken'), now)
+            elif path == '/v2/bot/message/push':
+                self.delivered.setdefault(('push', payload.get('to')), now)
+            elif path == '/v3/mail/send':
+                self.emails += len(payload.get('personalizations', []))
+        self._respond(handler, 202 if path == '/v3/mail/send' else 200, b'{}')
+
+    @staticmethod
+    def _respond(handler, status, body):
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+# 
+# 指標
+# 
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.sent_events = {}  # reply token -> (scenario, 送出時間)
+
+    def record(self, scenario, elapsed, ok):
+        with self.lock:
+            self.latencies.setdefault(scenario, []).append(elapsed)
+            if not ok:
+                self.errors[scenario] = self.errors.get(scenario, 0) + 1
+
+    def event_sent(self, scenario, reply_token, at):
+        with self.lock:
+            self.sent_events[reply_token] = (scenario, at)
+
+
+# 
+# 虛擬用戶
+# 
+
+class VirtualUser:
+    def __init__(self, base_url, recorder, teachers, rng, contested_slots, think_time=0.0):
+        self.base_url = base_url
+        self.think_time = think_time
+        self.recorder = recorder
+        self.teachers = teachers
+        self.rng = rng
+        self.contested_slots = contested_slots
+        self.session = requests.Session()
+        self.user_id = 'U' + uuid.uuid4().hex
+        self.registered = False
+
+    def _event(self, kind, **fields):
+        event = {
+            'type': kind,
+            'mode': 'active',
+            'timestamp': int(time.time() * 1000),
+            'source': {'type': 'user', 'userId': self.user_id},
+            'webhookEventId': uuid.uuid4().hex,
+            'deliveryContext': {'isRedelivery': False},
+            'replyToken': uuid.uuid4().hex,
+        }
+        event.update(fields)
+        return event
+
+    def text(self, text):
+        return self._event('message', message={'type': 'text', 'id': uuid.uuid4().hex[:16],
+                                               'text': text})
+
+    def postback(self, data):
+        return self._event('postback', postback={'data': data})
+
+    def think(self):
+        """模擬用戶在兩次操作之間的停頓"""
+        if self.think_time:
+            time.sleep(self.think_time * self.rng.uniform(0.5, 1.5))
+
+    def send_events(self, scenario, events):
+        body = json.dumps({'destination': 'Uloadtest', 'events': events},
+                          ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        signature = base64.b64encode(
+            hmac.new(CHANNEL_SECRET.encode('utf-8'), body, hashlib.sha256).digest()).decode()
+        start = time.perf_counter()
+        for event in events:
+            self.recorder.event_sent(scenario, event['replyToken'], start)
+        try:
+            r = self.session.post(self.base_url + '/webhook/line', data=body, timeout=30, headers={
+                'Content-Type': 'application/json', 'X-Line-Signature': signature})
+            ok = r.status_code == 200
+        except requests.RequestException:
+            ok = False
+        self.recorder.record(scenario, time.perf_counter() - start, ok)
+
+    def webhook_browse(self):
+        teacher_id = self.rng.choice(self.teachers)
+        date = self.rng.choice(TEST_DATES)
+        steps = [
+            [self._event('follow')],
+            [self.text('老師名單')],
+            [self.postback(f'action=select_teacher&teacher_id={teacher_id}')],
+            [self.postback(f'action=select_date&teacher_id={teacher_id}&date={date}')],
+            [self.postback(f'action=select_time&teacher_id={teacher_id}&date={date}'
+                           f'&time={self.rng.choice(SLOT_TIMES)}')],
+        ]
+        for events in steps:
+            self.send_events('webhook_browse', events)
+            self.think()
+
+    def webhook_book(self):
+        if not self.registered:
+            phone = '098' + ''.join(self.rng.choice('0123456789') for _ in range(7))
+            self.send_events('webhook_book', [self.text(f'註冊 壓測{self.user_id[-4:]} {phone}')])
+            self.registered = True
+            self.think()
+        teacher_id, date, time_ = self.rng.choice(self.contested_slots)
+        self.send_events('webhook_book', [self.postback(
+            f'action=confirm_booking&teacher_id={teacher_id}&date={date}&time={time_}')])
+
+    def web_book(self):
+        teacher_id, date, time_ = self.rng.choice(self.contested_slots)
+        start = time.perf_counter()
+        try:
+            r = self.session.post(self.base_url + '/api/book', timeout=30, json={
+                'teacher_id': teacher_id, 'date': date, 'time': time_,
+                'name': f'壓測{self.user_id[-4:]}',
+                'phone': '097' + ''.join(self.rng.choice('0123456789') for _ in range(7)),
+                'email': f'{self.user_id[-8:]}@example.com'
+            })
+            ok = r.status_code in (201, 400)  # 400 = 時段已被預約，屬預期結果
+        except requests.RequestException:
+            ok = False
+        self.recorder.record('web_book', time.perf_counter() - start, ok)
+
+
+# 
+# 伺服器
+# 
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, stub):
+    port = _free_port()
+    env = dict(os.environ,
+               DATABASE_URL=args.database_url,
+               LINE_API_BASE=stub.url, SENDGRID_API_BASE=stub.url,
+               LINE_CHANNEL_ACCESS_TOKEN='loadtest', LINE_CHANNEL_SECRET=CHANNEL_SECRET,
+               SENDGRID_API_KEY='loadtest', MAIL_USER='loadtest@example.com',
+               ADMIN_PASSWORD=ADMIN_PASSWORD, WEBHOOK_ASYNC='1')
+    # 先建立資料表並依排班產生測試日期的時段
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'generate-slots',
+                    '--start', TEST_DATES[0], '--weeks', '4'],
+                   cwd=ROOT, env=env, stdout=subprocess.DEVNULL, check=True)
+    cmd = [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+           '--workers', str(args.workers), '--threads', str(args.threads),
+           '--log-level', 'warning']
+    log = open(os.path.join(tempfile.gettempdir(), 'loadtest-server.log'), 'w')
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f'伺服器啟動失敗，請查看 {log.name}')
+        try:
+            # 全新資料庫由其中一個 worker 建立初始老師，等到有資料才開始
+            if requests.get(url + '/api/teachers', timeout=1).json():
+                return proc, url
+        except (requests.RequestException, ValueError):
+            pass
+        time.sleep(0.3)
+    proc.terminate()
+    raise SystemExit('伺服器啟動逾時')
+
+
+def double_bookings(base_url):
+    """以匯出 API 讀取測試日期內的 confirmed 預約，回傳重複時段數"""
+    r = requests.get(base_url + '/admin/api/export/bookings', timeout=120,
+                     headers={'X-Admin-Password': ADMIN_PASSWORD},
+                     params={'format': 'ndjson', 'status': 'confirmed',
+                             'date_from': TEST_DATES[0], 'date_to': TEST_DATES[-1]})
+    r.raise_for_status()
+    seen = {}
+    for line in r.iter_lines():
+        if line:
+            b = json.loads(line)
+            key = (b['teacher_id'], b['date'], b['time'])
+            seen[key] = seen.get(key, 0) + 1
+    return sum(1 for c in seen.values() if c > 1), len(seen)
+
+
+# 
+# 主程式
+# 
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50, help='同時進行的虛擬用戶數')
+    parser.add_argument('--think-time', type=float, default=500,
+                        help='同一用戶兩次操作之間的平均停頓（毫秒）；設為 0 則連續送出')
+    parser.add_argument('--duration', type=float, default=20, help='送出流量的秒數')
+    parser.add_argument('--mix', default='webhook_browse=3,webhook_book=1,web_book=2',
+                        help='情境權重')
+    parser.add_argument('--slots', type=int, default=40, help='搶位時段格數')
+    parser.add_argument('--stub-latency', type=float, default=50, help='stub 回應延遲（毫秒）')
+    parser.add_argument('--stub-error-rate', type=float, default=0.0,
+                        help='stub 回 429/5xx 的機率')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker 數')
+    parser.add_argument('--threads', type=int, default=4, help='每個 gunicorn worker 的執行緒數')
+    parser.add_argument('--database-url',
+                        default=f'sqlite:///{tempfile.gettempdir()}/loadtest-{os.getpid()}.db')
+    parser.add_argument('--drain', type=float, default=30,
+                        help='流量結束後等待 webhook 回覆的秒數上限')
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    stub = StubServer(args.stub_latency, args.stub_error_rate)
+    stub.start()
+    proc, base_url = start_server(args, stub)
+    try:
+        teachers = [t['id'] for t in requests.get(base_url + '/api/teachers', timeout=10).json()]
+        rng = random.Random(0)
+        contested = list({(rng.choice(teachers), rng.choice(TEST_DATES), rng.choice(SLOT_TIMES))
+                          for _ in range(args.slots)})
+        recorder = Recorder()
+        stop_at = time.perf_counter() + args.duration
+
+        def run_user(n):
+            user_rng = random.Random(n)
+            user = VirtualUser(base_url, recorder, teachers, user_rng, contested,
+                               args.think_time / 1000)
+            names, weights = list(mix), list(mix.values())
+            while time.perf_counter() < stop_at:
+                getattr(user, user_rng.choices(names, weights)[0])()
+                user.think()
+
+        print(f'{args.users} 個虛擬用戶（停頓 {args.think_time:.0f} ms），{args.duration:.0f} 秒，gunicorn {args.workers}x{args.threads}，'
+              f'stub 延遲 {args.stub_latency:.0f} ms / 錯誤率 {args.stub_error_rate:.1%}')
+        started = time.perf_counter()
+        threads = [threading.Thread(target=run_user, args=(n,)) for n in range(args.users)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        # 等待背景 worker 把佇列中的事件處理完
+        drain_deadline = time.perf_counter() + args.drain
+        while time.perf_counter() < drain_deadline:
+            with stub.lock:
+                pending = [tok for tok in recorder.sent_events if tok not in stub.delivered]
+            if not pending:
+                break
+            time.sleep(0.5)
+
+        print(f'\n{"情境":<16}{"請求":>8}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"錯誤率":>8}')
+        for scenario, lats in sorted(recorder.latencies.items()):
+            errors = recorder.errors.get(scenario, 0)
+            print(f'{scenario:<16}{len(lats):>8}{len(lats) / elapsed:>9.1f}'
+                  f'{percentile(lats, 0.5) * 1000:>9.1f}{percentile(lats, 0.95) * 1000:>9.1f}'
+                  f'{percentile(lats, 0.99) * 1000:>9.1f}{errors / len(lats):>8.1%}')
+
+        e2e = {}
+        missing = {}
+        with stub.lock:
+            for token, (scenario, sent_at) in recorder.sent_events.items():
+                if token in stub.delivered:
+                    e2e.setdefault(scenario, []).append(stub.delivered[token] - sent_at)
+                else:
+                    missing[scenario] = missing.get(scenario, 0) + 1
+        print(f'\n{"webhook 端對端":<16}{"事件":>8}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"未回覆":>8}')
+        for scenario in sorted(set(e2e) | set(missing)):
+            lats = e2e.get(scenario, [])
+            total = len(lats) + missing.get(scenario, 0)
+            print(f'{scenario:<16}{total:>8}{percentile(lats, 0.5) * 1000:>9.1f}'
+                  f'{percentile(lats, 0.95) * 1000:>9.1f}{percentile(lats, 0.99) * 1000:>9.1f}'
+                  f'{missing.get(scenario, 0) / total if total else 0:>8.1%}')
+
+        doubles, booked = double_bookings(base_url)
+        print(f'\nstub 呼叫 {dict(sorted(stub.calls.items()))}，注入錯誤 {stub.injected_errors}，'
+              f'寄出 Email {stub.emails}')
+        print(f'已預約時段 {booked}，重複預約 {doubles}')
+        sys.exit(1 if doubles else 0)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+查詢計畫檢查
+
+實際呼叫 LINE「我的預約」、可用時段與後台預約列表的程式路徑，記錄它們送出的 SQL，
+再以 EXPLAIN（SQLite 為 EXPLAIN QUERY PLAN）確認使用了預期的索引：
+  - 我的預約：ix_bookings_line_user_status_starts_at，且排序不需額外的暫存 B-tree
+  - 可用時段：time_slots 的 uq_time_slots_teacher_date_time；
+    產生時段時查 confirmed 預約用 ix_bookings_teacher_date_status_time
+    （或同樣以 teacher_id, date 開頭、只含 confirmed 的 uq_bookings_teacher_slot_confirmed）
+  - 後台列表：ix_bookings_created_at_id / ix_bookings_archive_created_at_id
+並確認防止重複預約的 partial unique index 存在。PostgreSQL 的測試表通常很小，
+規劃器會偏好全表掃描，因此檢查時關閉 enable_seqscan。
+
+    python perf/query_plans.py --backend sqlite:////tmp/query_plans.db \\
+        --backend postgresql://postgres@localhost/booking_test
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_PASSWORD = 'query-plans'
+
+
+def _capture(m, table, call):
+    """執行 call，回傳第一個 FROM table 的 SELECT 與參數"""
+    pattern = re.compile(rf'\bFROM {table}\b', re.I)
+    captured = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and pattern.search(statement):
+            captured.append((statement, parameters))
+
+    m.event.listen(m.Engine, 'before_cursor_execute', listener)
+    try:
+        call()
+    finally:
+        m.event.remove(m.Engine, 'before_cursor_execute', listener)
+    if not captured:
+        raise AssertionError(f'沒有查詢 {table}')
+    return captured[0]
+
+
+def _plan(m, statement, parameters):
+    conn = m.db.session.connection()
+    if m.db.engine.url.get_backend_name() == 'sqlite':
+        rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+        return '\n'.join(row[-1] for row in rows)
+    conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+    rows = conn.exec_driver_sql(f'EXPLAIN {statement}', parameters).fetchall()
+    return '\n'.join(row[0] for row in rows)
+
+
+def run_backend():
+    """在子 process 內執行（DATABASE_URL 需在 import app 之前設定）"""
+    import app as m
+    client = m.app.test_client()
+    client.environ_base['HTTP_X_ADMIN_PASSWORD'] = ADMIN_PASSWORD
+    day = (date.today() + timedelta(days=1)).strftime('%Y-%m-%d')
+    checks = []
+
+    def check(name, table, call, indexes, sorted_by_index=False):
+        indexes = (indexes,) if isinstance(indexes, str) else indexes
+        with m.app.app_context():
+            statement, parameters = _capture(m, table, call)
+            plan = _plan(m, statement, parameters)
+            m.db.session.rollback()
+        ok = any(index in plan for index in indexes)
+        if sorted_by_index and 'TEMP B-TREE' in plan:
+            ok = False
+        checks.append(ok)
+        print(f'  {"OK  " if ok else "FAIL"} {name}：預期 {" 或 ".join(indexes)}')
+        if not ok:
+            print('       ' + plan.replace('\n', '\n       '))
+
+    check('我的預約', 'bookings',
+          lambda: m.upcoming_bookings(m.Booking.query.filter_by(line_user_id='U-plan', status='confirmed')),
+          'ix_bookings_line_user_status_starts_at', sorted_by_index=True)
+    check('可用時段', 'time_slots',
+          lambda: m.availability._load(1, day), 'uq_time_slots_teacher_date_time')
+    check('產生時段（已預約）', 'bookings',
+          lambda: m.materialize_slots(teacher_ids=[1], weeks=1),
+          ('ix_bookings_teacher_date_status_time', 'uq_bookings_teacher_slot_confirmed'))
+    check('後台列表', 'bookings',
+          lambda: client.get('/admin/api/bookings?limit=20'), 'ix_bookings_created_at_id')
+    check('後台列表（封存）', 'bookings_archive',
+          lambda: client.get('/admin/api/bookings?limit=20'), 'ix_bookings_archive_created_at_id')
+
+    with m.app.app_context():
+        indexes = {i['name'] for i in m.inspect(m.db.engine).get_indexes('bookings')}
+        backend = m.db.engine.url.get_backend_name()
+    ok = 'uq_bookings_teacher_slot_confirmed' in indexes
+    checks.append(ok)
+    print(f'  {"OK  " if ok else "FAIL"} 重複預約：uq_bookings_teacher_slot_confirmed 存在')
+    print(f'[{backend}] {"OK" if all(checks) else "FAIL"}')
+    return all(checks)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', action='append',
+                        help='DATABASE_URL，可重複指定；預設只測 sqlite:////tmp/query_plans.db')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        sys.path.insert(0, ROOT)
+        sys.exit(0 if run_backend() else 1)
+
+    failed = False
+    for url in args.backend or ['sqlite:////tmp/query_plans.db']:
+        env = dict(os.environ, DATABASE_URL=url, WEBHOOK_ASYNC='0', ADMIN_PASSWORD=ADMIN_PASSWORD,
+                   REMINDER_TIMES='', ARCHIVE_TIMES='')
+        cmd = [sys.executable, os.path.abspath(__file__), '--run', url]
+        failed |= subprocess.run(cmd, env=env, cwd=ROOT).returncode != 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+LINE 文字訊息解析
+
+- 意圖：老師名單 / 查詢預約 / 取消預約 / 註冊 / 預約
+- 日期：2026/02/20、2/20、2月20日、今天、明天、下週三、Feb 20、tomorrow ...
+- 時間：15:00、3pm、下午3點、三點半、15點 ...
+- 老師：全名、名字、姓 + 老師（同姓多位老師時回傳全部候選）
+
+不存取資料庫；老師名稱索引由呼叫端在老師資料變動時重建。
+"""
+import re
+import unicodedata
+from datetime import date as date_cls, timedelta
+from typing import NamedTuple, Optional, Tuple
+
+
+class Intent(NamedTuple):
+    kind: Optional[str]                 # teachers, query, cancel, register, book；無法辨識為 None
+    teacher_ids: Tuple[int, ...] = ()   # 多於一個代表名稱有歧義
+    date: Optional[str] = None          # YYYY-MM-DD
+    time: Optional[str] = None          # HH:MM
+    booking_number: Optional[str] = None
+
+
+class TeacherIndex:
+    """老師名稱 → id 的別名索引，以單一預先編譯的 regex 比對（長的別名優先）"""
+
+    def __init__(self, teachers, version=None):
+        self.version = version
+        aliases = {}
+        surnames = {}
+        for teacher_id, name in teachers:
+            name = normalize(name).strip()
+            if not name:
+                continue
+            for alias in self._aliases(name):
+                aliases.setdefault(alias, set()).add(teacher_id)
+            if not name.isascii() and len(name) >= 2:
+                surnames.setdefault(name[0], set()).add(teacher_id)
+        for surname, ids in surnames.items():
+            for suffix in ('老師', '老师'):
+                aliases.setdefault(surname + suffix, set()).update(ids)
+        self.aliases = {alias: tuple(sorted(ids)) for alias, ids in aliases.items()}
+        if self.aliases:
+            pattern = '|'.join(re.escape(a) for a in sorted(self.aliases, key=len, reverse=True))
+            self._pattern = re.compile(pattern)
+        else:
+            self._pattern = None
+
+    @staticmethod
+    def _aliases(name):
+        names = [name]
+        if name.isascii():
+            first = name.split()[0]
+            if first != name:
+                names.append(first)
+        elif len(name) >= 3:
+            names.append(name[1:])  # 名字（去掉姓）
+        out = []
+        for n in names:
+            out += [n, n + '老師', n + '老师']
+        return out
+
+    def match(self, text):
+        """回傳 (teacher_ids, (start, end))；找不到時為 ((), None)"""
+        if self._pattern is None:
+            return (), None
+        m = self._pattern.search(text)
+        if not m:
+            return (), None
+        return self.aliases[m.group(0)], m.span()
+
+
+def normalize(text):
+    """全形轉半形、英文小寫"""
+    return unicodedata.normalize('NFKC', text).lower()
+
+
+# 
+# 意圖關鍵字
+# 
+
+_TEACHERS_RE = re.compile(r'老師名單|老师名单|有哪些老師|有哪些老师|老師列表|師資|\bteachers\b|teacher list')
+_QUERY_RE = re.compile(r'查詢預約|查询预约|我的預約|我的预约|查預約|預約查詢|my bookings?')
+_CANCEL_RE = re.compile(r'取消|cancel')
+_BOOK_RE = re.compile(r'預約|预约|預訂|预订|預定|预定|訂|订|約|约|book|reserve')
+_BOOKING_NUMBER_RE = re.compile(r'bk\d{12}')
+
+# 
+# 日期
+# 
+
+_MONTHS = {m: i + 1 for i, m in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'])}
+_MONTH_NAMES = r'\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)(?:uary|ruary|ch|il|e|y|ust|tember|t|ober|ember)?\b\.?'
+_WEEKDAYS_ZH = {'一': 0, '二': 1, '三': 2, '四': 3, '五': 4, '六': 5, '日': 6, '天': 6}
+_WEEKDAYS_EN = {d: i for i, d in enumerate(['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun'])}
+_RELATIVE_DAYS = {'今天': 0, '今日': 0, 'today': 0, '明天': 1, '明日': 1, 'tomorrow': 1,
+                  '後天': 2, '后天': 2, '大後天': 3, '大后天': 3}
+
+_DATE_PATTERNS = [
+    ('ymd', re.compile(r'(?<!\d)(\d{4})\s*[/\-.年]\s*(\d{1,2})\s*[/\-.月]\s*(\d{1,2})\s*[日號号]?')),
+    ('md', re.compile(r'(?<![\d/])(\d{1,2})\s*/\s*(\d{1,2})(?![\d/])')),
+    ('md', re.compile(r'(?<!\d)(\d{1,2})\s*月\s*(\d{1,2})\s*[日號号]?')),
+    ('en_md', re.compile(_MONTH_NAMES + r'\s*(\d{1,2})(?:st|nd|rd|th)?\b')),
+    ('en_dm', re.compile(r'\b(\d{1,2})(?:st|nd|rd|th)?\s*' + _MONTH_NAMES)),
+    ('relative', re.compile('|'.join(sorted(_RELATIVE_DAYS, key=len, reverse=True)))),
+    ('weekday', re.compile(r'(下下|下|這|这|本)?\s*(?:週|周|星期|禮拜|礼拜)\s*([一二三四五六日天])')),
+    ('en_weekday', re.compile(r'\b(next\s+)?(mon|tue|wed|thu|fri|sat|sun)(?:day|sday|nesday|rsday|urday)?\b')),
+]
+
+
+def _resolve_month_day(month, day, today):
+    """沒有年份時取今天以後最近的一天"""
+    try:
+        d = date_cls(today.year, month, day)
+    except ValueError:
+        return None
+    if d < today:
+        try:
+            d = date_cls(today.year + 1, month, day)
+        except ValueError:
+            return None
+    return d
+
+
+def parse_date(text, today):
+    """回傳 (date, span)；text 需先 normalize"""
+    for kind, pattern in _DATE_PATTERNS:
+        m = pattern.search(text)
+        if not m:
+            continue
+        d = None
+        if kind == 'ymd':
+            try:
+                d = date_cls(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+            except ValueError:
+                d = None
+        elif kind == 'md':
+            d = _resolve_month_day(int(m.group(1)), int(m.group(2)), today)
+        elif kind == 'en_md':
+            d = _resolve_month_day(_MONTHS[m.group(1)], int(m.group(2)), today)
+        elif kind == 'en_dm':
+            d = _resolve_month_day(_MONTHS[m.group(2)], int(m.group(1)), today)
+        elif kind == 'relative':
+            d = today + timedelta(days=_RELATIVE_DAYS[m.group(0)])
+        elif kind == 'weekday':
+            prefix, weekday = m.group(1), _WEEKDAYS_ZH[m.group(2)]
+            week_start = today - timedelta(days=today.weekday())
+            weeks = {'下': 1, '下下': 2}.get(prefix, 0)
+            d = week_start + timedelta(days=7 * weeks + weekday)
+            if not prefix and d < today:
+                d += timedelta(days=7)
+        elif kind == 'en_weekday':
+            weekday = _WEEKDAYS_EN[m.group(2)]
+            d = today + timedelta(days=(weekday - today.weekday()) % 7)
+            if m.group(1):
+                d += timedelta(days=7)
+        if d is not None:
+            return d, m.span()
+    return None, None
+
+
+# 
+# 時間
+# 
+
+_ZH_NUMBERS = {'零': 0, '一': 1, '二': 2, '兩': 2, '两': 2, '三': 3, '四': 4, '五': 5,
+               '六': 6, '七': 7, '八': 8, '九': 9, '十': 10}
+_PERIODS = r'(早上|上午|中午|下午|傍晚|晚上|am|pm)?'
+_TIME_PATTERNS = [
+    ('hm', re.compile(_PERIODS + r'\s*(?<!\d)(\d{1,2})\s*:\s*(\d{2})(?!\d)\s*(am|pm)?')),
+    ('zh', re.compile(_PERIODS + r'\s*(\d{1,2}|[零一二兩两三四五六七八九十]{1,3})\s*[點点時时]\s*(半|(\d{1,2})\s*分?)?')),
+    ('ampm', re.compile(r'(?<![\d:/])(\d{1,2})\s*(am|pm)\b')),
+]
+
+
+def _zh_number(s):
+    if s.isdigit():
+        return int(s)
+    if s == '十':
+        return 10
+    if s.startswith('十'):
+        return 10 + _ZH_NUMBERS.get(s[1:], 0)
+    if len(s) == 2 and s.endswith('十'):
+        return _ZH_NUMBERS[s[0]] * 10
+    if len(s) == 3 and s[1] == '十':
+        return _ZH_NUMBERS[s[0]] * 10 + _ZH_NUMBERS[s[2]]
+    return _ZH_NUMBERS.get(s) if len(s) == 1 else None
+
+
+def _apply_period(hour, period):
+    if period is None and 1 <= hour < 9:
+        return hour + 12  # 未說明上下午時，營業時間外的早晨時數視為下午（兩點 → 14:00）
+    if period in ('下午', '傍晚', '晚上', 'pm') and hour < 12:
+        return hour + 12
+    if period == '中午' and hour < 11:
+        return hour + 12
+    if period in ('am', '早上', '上午') and hour == 12:
+        return 0
+    return hour
+
+
+def parse_time(text):
+    """回傳 (HH:MM, span)；text 需先 normalize"""
+    for kind, pattern in _TIME_PATTERNS:
+        m = pattern.search(text)
+        if not m:
+            continue
+        if kind == 'hm':
+            hour, minute = int(m.group(2)), int(m.group(3))
+            hour = _apply_period(hour, m.group(4) or m.group(1))
+        elif kind == 'zh':
+            hour = _zh_number(m.group(2))
+            if hour is None:
+                continue
+            minute = 30 if m.group(3) == '半' else int(m.group(4) or 0)
+            hour = _apply_period(hour, m.group(1))
+        else:
+            hour, minute = _apply_period(int(m.group(1)), m.group(2)), 0
+        if 0 <= hour < 24 and 0 <= minute < 60:
+            return f'{hour:02d}:{minute:02d}', m.span()
+    return None, None
+
+
+def _blank(text, span):
+    """把已解析的片段換成空白，避免重複比對"""
+    if span is None:
+        return text
+    return text[:span[0]] + ' ' * (span[1] - span[0]) + text[span[1]:]
+
+
+# 
+# 主要入口
+# 
+
+def parse(text, index, today):
+    """解析一則文字訊息，回傳 Intent"""
+    text = normalize(text).strip()
+    if text.startswith('註冊') or text.startswith('注册'):
+        return Intent('register')
+    if _TEACHERS_RE.search(text):
+        return Intent('teachers')
+
+    teacher_ids, span = index.match(text) if index is not None else ((), None)
+    rest = _blank(text, span)
+    booking_number = _BOOKING_NUMBER_RE.search(rest)
+    if booking_number:
+        rest = _blank(rest, booking_number.span())
+        booking_number = booking_number.group(0).upper()
+    d, span = parse_date(rest, today)
+    t, _ = parse_time(_blank(rest, span))
+    date = d.isoformat() if d else None
+
+    if _CANCEL_RE.search(text):
+        return Intent('cancel', teacher_ids, date, t, booking_number)
+    if _QUERY_RE.search(text):
+        return Intent('query')
+    if _BOOK_RE.search(rest) or (teacher_ids and (date or t)):
+        return Intent('book', teacher_ids, date, t)
+    return Intent(None)